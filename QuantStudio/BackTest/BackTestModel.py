@@ -1,22 +1,31 @@
 # coding=utf-8
 import os
+import io
+import json
 import time
+import pickle
 import shutil
+import tempfile
+import itertools
+import hashlib
+import logging
 import datetime as dt
 import webbrowser
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
 from progressbar import ProgressBar
-from traits.api import List, Instance, Str
+from traits.api import HasTraits, List, Instance, Str, Bool, File, Float
 from traitsui.api import View, Item, Group
 from traitsui.menu import OKButton, CancelButton
 from lxml import etree
 
 from QuantStudio import __QS_Error__, __QS_Object__, __QS_MainPath__
-from QuantStudio.FactorDataBase.FactorDB import FactorDB
+from QuantStudio.FactorDataBase.FactorDB import FactorDB, FactorTable, setReadProfiler
+from QuantStudio.FactorDataBase.FDBFun import readBatchData
 from QuantStudio.Tools.AuxiliaryFun import startMultiProcess
-from QuantStudio.Tools.QSObjects import QSPipe
+from QuantStudio.Tools.QSObjects import QSMMAPPipe
 
 class BaseModule(__QS_Object__):
     """回测模块"""
@@ -40,6 +49,41 @@ class BaseModule(__QS_Object__):
     def __QS_move__(self, idt, **kwargs):
         self._iDT = idt
         return 0
+    # 批量模式下需要读取的数据, 在 __QS_start__ 之后调用, 返回 None 表示该模块不支持批量模式, 需要逐时点计算
+    # 返回: [(因子表对象, [因子名], [ID], [时点], {参数})], 格式同 FDBFun.readBatchData 的 requests
+    def __QS_batchRequests__(self, dts):
+        return None
+    # 批量模式下对整个测试区间一次性计算, 替代逐时点的 __QS_move__
+    # data: [Panel(item=[因子], major_axis=[时点], minor_axis=[ID])], 与 __QS_batchRequests__ 的返回一一对应
+    def __QS_batch__(self, dts, data):
+        if dts: self._iDT = dts[-1]
+        return 0
+    # 估计模块在整个测试区间上的计算耗时(秒), 用于多进程回测时在子进程之间分配模块, 返回 None 表示由模型估计
+    def __QS_estimateCost__(self, dts):
+        return None
+    # 获取模块的运行状态, 用于保存检查点, 返回: 可以 pickle 的对象
+    # 默认保存除模型, 因子表等系统对象以外的私有属性和用户数据 UserData, 属性中的子模块(或子模块的列表, 如策略的账户)递归保存各自的状态
+    # 状态中包含其他不可 pickle 对象的模块需要重载
+    def __QS_getState__(self):
+        State, SubStates = {}, {}
+        for iKey, iVal in self.__dict__.items():
+            if iKey=="_Model": continue
+            if isinstance(iVal, BaseModule): SubStates[iKey] = iVal.__QS_getState__()
+            elif isinstance(iVal, (list, tuple)) and iVal and all(isinstance(jVal, BaseModule) for jVal in iVal): SubStates[iKey] = [jVal.__QS_getState__() for jVal in iVal]
+            elif (iKey=="UserData") or (iKey.startswith("_") and ("__" not in iKey) and (iKey not in ("_LabelTrait", "_ArgOrder", "_ConfigFile")) and (not isinstance(iVal, (__QS_Object__, logging.Logger)))): State[iKey] = iVal
+        if SubStates: State["__QS_SubStates__"] = SubStates
+        return State
+    # 从检查点恢复模块的运行状态, 在 __QS_start__ 之后调用, state: __QS_getState__ 的返回
+    def __QS_setState__(self, state):
+        state = state.copy()
+        SubStates = state.pop("__QS_SubStates__", {})
+        self.__dict__.update(state)
+        for iKey, iState in SubStates.items():
+            iVal = getattr(self, iKey)
+            if isinstance(iVal, BaseModule): iVal.__QS_setState__(iState)
+            else:
+                for jVal, jState in zip(iVal, iState): jVal.__QS_setState__(jState)
+        return 0
     # 测试结束后的整理函数
     def __QS_end__(self):
         self._isStarted = False
@@ -60,20 +104,190 @@ class BaseModule(__QS_Object__):
 
 
 
+# 回测结果的磁盘缓冲, 按时点追加记录 Series(数值, index=[ID]), 缓冲的元素个数超过 buffer_size 后以列式数组(ID 编码, 数值, 记录长度)写入临时目录,
+# 需要时通过 toDataFrame 还原成 DataFrame(index=[时点], columns=[ID]), 内存占用只和 ID 个数及缓冲大小有关, 不随回测长度增长
+class OutputSpool(object):
+    def __init__(self, buffer_size=1000000):
+        self._BufferSize = buffer_size
+        self._DirPath = None# 临时目录, 第一次写入时创建
+        self._Files = []# 已经写入的文件
+        self._IDs = []# 出现过的 ID, 按编码排列
+        self._IDCode = {}# {ID: 编码}
+        self._DTs = []# 所有记录的时点
+        self._Codes, self._Values, self._Lengths = [], [], []# 缓冲区中的记录
+        self._nBuffer = 0# 缓冲区中的元素个数
+    def __len__(self):
+        return len(self._DTs)
+    def append(self, idt, data):
+        Codes = np.empty(data.shape[0], dtype=np.int64)
+        for i, iID in enumerate(data.index):
+            iCode = self._IDCode.get(iID)
+            if iCode is None:
+                iCode = self._IDCode[iID] = len(self._IDs)
+                self._IDs.append(iID)
+            Codes[i] = iCode
+        self._DTs.append(idt)
+        self._Codes.append(Codes)
+        self._Values.append(np.asarray(data.values, dtype=np.float64))
+        self._Lengths.append(Codes.shape[0])
+        self._nBuffer += Codes.shape[0]
+        if self._nBuffer>=self._BufferSize: self._flush()
+        return 0
+    def _flush(self):
+        if not self._Lengths: return 0
+        if self._DirPath is None: self._DirPath = tempfile.mkdtemp()
+        FilePath = self._DirPath+os.sep+str(len(self._Files))+".npz"
+        np.savez(FilePath, codes=np.concatenate(self._Codes), values=np.concatenate(self._Values), lengths=np.array(self._Lengths, dtype=np.int64))
+        self._Files.append(FilePath)
+        self._Codes, self._Values, self._Lengths, self._nBuffer = [], [], [], 0
+        return 0
+    def _iterChunks(self):
+        for iFilePath in self._Files:
+            with np.load(iFilePath) as iData:
+                yield (iData["codes"], iData["values"], iData["lengths"])
+        if self._Lengths: yield (np.concatenate(self._Codes), np.concatenate(self._Values), np.array(self._Lengths, dtype=np.int64))
+    # 还原成 DataFrame(index=[时点], columns=[ID]), 列按 ID 第一次出现的顺序排列, 记录中没有的 ID 为 nan
+    def toDataFrame(self):
+        Data, RowInd = np.full((len(self._DTs), len(self._IDs)), np.nan), 0
+        for iCodes, iValues, iLengths in self._iterChunks():
+            Data[np.repeat(np.arange(RowInd, RowInd+iLengths.shape[0]), iLengths), iCodes] = iValues
+            RowInd += iLengths.shape[0]
+        return pd.DataFrame(Data, index=self._DTs, columns=list(self._IDs))
+    # 删除临时文件并清空记录
+    def clear(self):
+        if self._DirPath is not None: shutil.rmtree(self._DirPath, ignore_errors=True)
+        self.__init__(buffer_size=self._BufferSize)
+        return 0
+
+# 回测性能分析器, 记录每个模块各阶段(start, batch, move, end, output)和因子表遍历(move)的耗时及调用次数, 以及通过因子表读取数据(read)和过滤 ID(getFilteredID)的耗时和字节数
+# max_events: 时间线保存的最大事件数, 超出后只累计统计量
+class BackTestProfiler(object):
+    def __init__(self, max_events=1000000):
+        self._Stats = OrderedDict()# {(对象名, 阶段): [耗时, 调用次数, 读取字节数]}
+        self._Events = []# [(对象名, 阶段, 开始时间, 结束时间)]
+        self._MaxEvents = max_events
+        self._StartT = time.perf_counter()
+        self.CurModule = None# 当前正在计算的模块名, 数据读取计入该模块
+        self._ReadDepth = 0# 当前嵌套的读取层数, 因子表读取时内部触发的读取只计入最外层
+    def record(self, name, phase, start_t, end_t, nbytes=0):
+        iStats = self._Stats.get((name, phase))
+        if iStats is None: iStats = self._Stats[(name, phase)] = [0.0, 0, 0]
+        iStats[0] += end_t - start_t
+        iStats[1] += 1
+        iStats[2] += nbytes
+        if len(self._Events)<self._MaxEvents: self._Events.append((name, phase, start_t, end_t))
+        return 0
+    # 调用 fun 并记录耗时
+    def call(self, name, phase, fun, *args, **kwargs):
+        StartT = time.perf_counter()
+        Rslt = fun(*args, **kwargs)
+        self.record(name, phase, StartT, time.perf_counter())
+        return Rslt
+    # 调用 fun 读取因子表 ft 的数据并记录耗时和字节数, 有当前模块时计入该模块, 否则计入因子表
+    def callRead(self, ft, phase, fun, *args, **kwargs):
+        if self._ReadDepth>0: return fun(*args, **kwargs)
+        self._ReadDepth += 1
+        StartT = time.perf_counter()
+        try:
+            Rslt = fun(*args, **kwargs)
+        finally:
+            self._ReadDepth -= 1
+        self.record((self.CurModule if self.CurModule is not None else ft.Name), phase, StartT, time.perf_counter(), nbytes=getattr(getattr(Rslt, "values", None), "nbytes", 0))
+        return Rslt
+    # 汇总表, DataFrame(index=[(对象名, 阶段)], columns=["耗时", "调用次数", "平均耗时", "读取字节数"]), 按耗时降序排列
+    def summary(self):
+        if not self._Stats: return pd.DataFrame(columns=["耗时", "调用次数", "平均耗时", "读取字节数"])
+        Rslt = pd.DataFrame(list(self._Stats.values()), index=pd.MultiIndex.from_tuples(list(self._Stats.keys()), names=["对象", "阶段"]), columns=["耗时", "调用次数", "读取字节数"])
+        Rslt.insert(2, "平均耗时", Rslt["耗时"] / Rslt["调用次数"])
+        return Rslt.sort_values(by="耗时", ascending=False)
+    # 保存 Chrome Trace 格式(chrome://tracing)的时间线文件
+    def saveChromeTrace(self, file_path):
+        PID = os.getpid()
+        Events = [{"name":iName, "cat":iPhase, "ph":"X", "ts":(iStartT-self._StartT)*1e6, "dur":(iEndT-iStartT)*1e6, "pid":PID, "tid":0} for iName, iPhase, iStartT, iEndT in self._Events]
+        with open(file_path, "w", encoding="utf-8") as File:
+            json.dump({"traceEvents":Events, "displayTimeUnit":"ms"}, File, ensure_ascii=False)
+        return 0
+
+# 单个时点内的数据读取代理, 合并各模块在同一时点对遍历模式下的因子表发出的相同读取请求
+# 按 (因子表, 因子, ID, 时点, 参数) 缓存读取结果, 按 (因子表, 时点, ID, 筛选条件, 参数) 缓存筛选后的 ID, 每个时点开始时清空
+class _StepReadBroker(object):
+    def __init__(self, profiler=None):
+        self._DataCache = {}# {(因子名, 因子表 id, (ID), (时点), 参数): array(shape=(时点数, ID数))}
+        self._IDCache = {}# {(因子表 id, 时点, (ID), 筛选条件, 参数): [ID]}
+        self._Profiler = profiler
+    def clear(self):
+        self._DataCache.clear()
+        self._IDCache.clear()
+        return 0
+    def readData(self, ft, factor_names, ids, dts, args={}):
+        if self._Profiler is None: return self._readData(ft, factor_names=factor_names, ids=ids, dts=dts, args=args)
+        return self._Profiler.callRead(ft, "read", self._readData, ft, factor_names=factor_names, ids=ids, dts=dts, args=args)
+    def _readData(self, ft, factor_names, ids, dts, args={}):
+        if not factor_names: return ft._readData_ErgodicMode(factor_names=factor_names, ids=ids, dts=dts, args=args)
+        Key = (id(ft), tuple(ids), tuple(dts), repr(sorted(args.items())))
+        MissingFactorNames = [iFactorName for iFactorName in factor_names if (iFactorName,)+Key not in self._DataCache]
+        if MissingFactorNames:
+            Data = ft._readData_ErgodicMode(factor_names=MissingFactorNames, ids=ids, dts=dts, args=args)
+            isMixed = ((len(MissingFactorNames)>1) and (Data.values.dtype==np.dtype("O")))
+            for i, iFactorName in enumerate(MissingFactorNames):
+                iData = Data.iloc[i]
+                if isMixed: iData = iData.infer_objects()
+                self._DataCache[(iFactorName,)+Key] = iData.values
+        return pd.Panel({iFactorName: pd.DataFrame(self._DataCache[(iFactorName,)+Key], index=dts, columns=ids) for iFactorName in factor_names}, items=factor_names, major_axis=dts, minor_axis=ids)# 逐个因子构造, 保留各因子的数据类型
+    def getFilteredID(self, ft, idt, ids=None, id_filter_str=None, args={}):
+        Key = (id(ft), idt, (None if ids is None else tuple(ids)), id_filter_str, repr(sorted(args.items())))
+        IDs = self._IDCache.get(Key)
+        if IDs is None: IDs = self._IDCache[Key] = ft._getFilteredID(idt=idt, ids=ids, id_filter_str=id_filter_str, args=args)
+        return list(IDs)
+
+# 启动模块, 返回: (需要遍历的因子表, 逐时点计算的模块, [(批量模式的模块, 数据请求)])
+def _startModules(mdl, modules, profiler=None):
+    FTs, LoopModules, BatchModules = set(), [], []
+    for jModule in modules:
+        if profiler is None: jFTs = jModule.__QS_start__(mdl=mdl, dts=mdl._QS_TestDateTimes)
+        else: jFTs = profiler.call(mdl._getModuleLabel(jModule), "start", jModule.__QS_start__, mdl=mdl, dts=mdl._QS_TestDateTimes)
+        jRequests = (jModule.__QS_batchRequests__(dts=mdl._QS_TestDateTimes) if mdl.BatchMode else None)
+        if jRequests is None:
+            LoopModules.append(jModule)
+            if jFTs is not None: FTs.update(set(jFTs))
+        else:
+            BatchModules.append((jModule, list(jRequests)))
+    return (FTs, LoopModules, BatchModules)
+
+# 批量模式的模块一次性读取全部数据并计算, 所有模块的数据请求合并后调用 readBatchData
+def _runBatchModules(mdl, batch_modules, profiler=None):
+    if not batch_modules: return 0
+    Requests = []
+    for jModule, jRequests in batch_modules: Requests += jRequests
+    if profiler is None: Data = readBatchData(Requests)
+    else: Data = profiler.call("readBatchData", "read", readBatchData, Requests)
+    StartInd = 0
+    for jModule, jRequests in batch_modules:
+        if profiler is None: jModule.__QS_batch__(dts=mdl._QS_TestDateTimes, data=Data[StartInd:StartInd+len(jRequests)])
+        else: profiler.call(mdl._getModuleLabel(jModule), "batch", jModule.__QS_batch__, dts=mdl._QS_TestDateTimes, data=Data[StartInd:StartInd+len(jRequests)])
+        StartInd += len(jRequests)
+    return 0
+
 def _runModel(args):
     Sub2MainQueue, OutputPipe = args.pop("Sub2MainQueue"), args.pop("OutputPipe")
-    FTs = set()
-    for j in args["module_inds"]:
-        jFTs = args["mdl"].Modules[j].__QS_start__(mdl=args["mdl"], dts=args["mdl"]._QS_TestDateTimes)
-        if jFTs is not None: FTs.update(set(jFTs))
-    for jFT in FTs: jFT.start(dts=args["mdl"]._QS_TestDateTimes)
+    if "module_partition" in args: args["module_inds"] = args["module_partition"][int(args["PID"].split("-")[-1])]
+    FTs, LoopModules, BatchModules = _startModules(args["mdl"], [args["mdl"].Modules[j] for j in args["module_inds"]])
+    _runBatchModules(args["mdl"], BatchModules)
+    for jFT in FTs:
+        jFT.start(dts=args["mdl"]._QS_TestDateTimes)
+        jFT.alignDateTime(args["mdl"]._QS_TestDateTimes)
+    ReadBroker = _StepReadBroker()
+    for jFT in FTs: jFT.ErgodicMode._ReadBroker = ReadBroker
     Sub2MainQueue.put(0)
-    for i, iDT in enumerate(args["mdl"]._QS_TestDateTimes):
-        args["mdl"]._TestDateTimeIndex = i
-        args["mdl"]._TestDateIndex.loc[iDT.date()] = i
-        for jFT in FTs: jFT.move(iDT)
-        for j in args["module_inds"]: args["mdl"].Modules[j].__QS_move__(iDT)
-        Sub2MainQueue.put(1)
+    try:
+        for i, iDT in enumerate(args["mdl"]._QS_TestDateTimes):
+            args["mdl"]._TestDateTimeIndex = i
+            ReadBroker.clear()
+            for jFT in FTs: jFT.move(iDT, dt_index=i)
+            for jModule in LoopModules: jModule.__QS_move__(iDT)
+            Sub2MainQueue.put(1)
+    finally:
+        for jFT in FTs: jFT.ErgodicMode._ReadBroker = None
     for j in args["module_inds"]: args["mdl"].Modules[j].__QS_end__()
     for jFT in FTs: jFT.end()
     Output = {}
@@ -84,20 +298,105 @@ def _runModel(args):
     OutputPipe.put(Output)
     return 0
 
+# 复制参数扫描的模板模块, 模块的参数和状态(包括子模块)通过 pickle 深复制, 因子表, 因子库和回测模型保持引用
+class _ModulePickler(pickle.Pickler):
+    def __init__(self, file, refs):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._Refs = refs
+    def persistent_id(self, obj):
+        if isinstance(obj, (FactorTable, FactorDB, BackTestModel)):
+            self._Refs[id(obj)] = obj
+            return id(obj)
+        return None
+class _ModuleUnpickler(pickle.Unpickler):
+    def __init__(self, file, refs):
+        super().__init__(file)
+        self._Refs = refs
+    def persistent_load(self, pid):
+        return self._Refs[pid]
+# pickle 不保存 add_trait 添加的参数定义, 复制后重新添加, 以保留参数的取值校验
+def _restoreInstanceTraits(src, dst, visited):
+    if id(src) in visited: return 0
+    visited.add(id(src))
+    if isinstance(src, __QS_Object__):
+        for iName, iTrait in src._instance_traits().items():
+            if iName not in dst._instance_traits(): HasTraits.add_trait(dst, iName, iTrait)
+        Pairs = [(src.__dict__[iKey], dst.__dict__[iKey]) for iKey in src.__dict__ if iKey in dst.__dict__]
+    elif isinstance(src, dict): Pairs = zip(src.values(), dst.values())
+    elif isinstance(src, (list, tuple)): Pairs = zip(src, dst)
+    else: return 0
+    for iSrc, iDst in Pairs:
+        if (iSrc is not iDst) and isinstance(iSrc, (__QS_Object__, dict, list, tuple)): _restoreInstanceTraits(iSrc, iDst, visited)
+    return 0
+def _copyModule(template):
+    Buffer, Refs = io.BytesIO(), {}
+    _ModulePickler(Buffer, Refs).dump(template)
+    Buffer.seek(0)
+    Module = _ModuleUnpickler(Buffer, Refs).load()
+    _restoreInstanceTraits(template, Module, set())
+    return Module
+
+# 参数扫描的结果集, 每组参数的结果存为结果目录下的一个文件, 按需读入内存
+# index: DataFrame(index=[参数组序号], columns=[参数名]), output_dir: 结果目录
+class SweepResult(object):
+    def __init__(self, index, output_dir):
+        self._Index = index
+        self._OutputDir = output_dir
+    # 参数组合表, DataFrame(index=[参数组序号], columns=[参数名])
+    @property
+    def Index(self):
+        return self._Index
+    @property
+    def OutputDir(self):
+        return self._OutputDir
+    def __len__(self):
+        return self._Index.shape[0]
+    # 读取第 i 组参数的结果集
+    def __getitem__(self, i):
+        if i not in self._Index.index: raise __QS_Error__("参数组序号 %s 不存在!" % (str(i), ))
+        with open(self._OutputDir+os.sep+str(i)+".pkl", "rb") as File:
+            return pickle.load(File)
+    # 按参数查找参数组序号, params: {参数名: 参数值}, 返回: [参数组序号]
+    def query(self, **params):
+        Mask = pd.Series(True, index=self._Index.index)
+        for iArgName, iVal in params.items(): Mask &= (self._Index[iArgName]==iVal)
+        return self._Index.index[Mask].tolist()
+    # 删除结果目录
+    def clear(self):
+        if os.path.isdir(self._OutputDir): shutil.rmtree(self._OutputDir)
+        return 0
+
 class BackTestModel(__QS_Object__):
     """回测模型"""
     Modules = List(BaseModule)# 已经添加的测试模块, [测试模块对象]
+    BatchMode = Bool(False, arg_type="Bool", label="批量模式", order=0)# 实现了 __QS_batchRequests__ 的模块是否一次性计算整个测试区间, 默认逐时点计算
+    CheckpointFile = File(arg_type="File", label="检查点文件", order=1)# 为空时不保存检查点
+    CheckpointInterval = Float(600, arg_type="Double", label="检查点间隔", order=2)# 单位: 秒
+    Profile = Bool(False, arg_type="Bool", label="性能分析", order=3)# 单进程运行时记录各模块各阶段的耗时
+    TraceFile = File(arg_type="File", label="时间线文件", order=4)# 性能分析的 Chrome Trace 时间线文件, 为空时不保存
     def __init__(self, sys_args={}, config_file=None, **kwargs):
         self._QS_TestDateTimes = []# 测试时间点序列, [datetime.datetime]
         self._TestDateTimeIndex = -1# 测试时间点索引
-        self._TestDateIndex = pd.Series([], dtype=np.int64)# 测试日期最后一个时间点位于 _QS_TestDateTimes 中的索引
+        self._TestDates = np.array([], dtype="O")# 测试日期序列, array([datetime.date])
+        self._TestDateLastIndex = np.array([], dtype=np.int64)# 测试日期最后一个时间点位于 _QS_TestDateTimes 中的索引, array(int), 与 _TestDates 一一对应
+        self._TestDatePosition = np.array([], dtype=np.int64)# 测试时间点所在日期位于 _TestDates 中的索引, array(int), 与 _QS_TestDateTimes 一一对应
         self._Output = {}# 生成的结果集
         self.UserData = {}# 用户数据存放
+        self._Profiler = None# 最近一次运行的性能分析器
         return super().__init__(sys_args=sys_args, config_file=config_file, **kwargs)
     # 当前时点, datetime.datetime
     @property
     def DateTime(self):
         return self._QS_TestDateTimes[self._TestDateTimeIndex]
+    # 最近一次运行的性能分析器, BackTestProfiler, 没有开启性能分析时为 None
+    @property
+    def Profiler(self):
+        return self._Profiler
+    # 模块在性能分析中的名称
+    def _getModuleLabel(self, module):
+        for j, jModule in enumerate(self.Modules):
+            if jModule is module: return str(j)+"-"+module.Name
+        return module.Name
     # 当前时间点在整个回测时间序列中的位置索引, int
     @property
     def DateTimeIndex(self):
@@ -109,7 +408,23 @@ class BackTestModel(__QS_Object__):
     # 截止到当前日期序列在时间点序列中的索引, Series(int, index=[日期])
     @property
     def DateIndexSeries(self):
-        return self._TestDateIndex
+        if self._TestDateTimeIndex<0: return pd.Series([], dtype=np.int64)
+        nDate = self._TestDatePosition[self._TestDateTimeIndex] + 1
+        DateIndex = self._TestDateLastIndex[:nDate].copy()
+        DateIndex[-1] = self._TestDateTimeIndex
+        return pd.Series(DateIndex, index=self._TestDates[:nDate])
+    # 根据测试时间点序列预先生成日期索引
+    def _initDateIndex(self):
+        self._TestDateTimeIndex = -1
+        Dates = np.array([iDT.date() for iDT in self._QS_TestDateTimes], dtype="O")
+        if Dates.shape[0]==0:
+            self._TestDates, self._TestDateLastIndex, self._TestDatePosition = Dates, np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+            return 0
+        isLast = np.r_[Dates[1:]!=Dates[:-1], True]
+        self._TestDateLastIndex = np.arange(Dates.shape[0])[isLast]
+        self._TestDates = Dates[isLast]
+        self._TestDatePosition = np.r_[0, np.cumsum(isLast[:-1])]
+        return 0
     def getViewItems(self, context_name=""):
         Prefix = (context_name+"." if context_name else "")
         Groups, Context = [], {}
@@ -119,42 +434,168 @@ class BackTestModel(__QS_Object__):
             Context.update(jContext)
             Context[Prefix+"Module"+str(j)] = jModule
         return (Groups, Context)
+    # 检查点对应的测试标识, 测试时点序列和模块一致时才能从检查点恢复
+    def _genCheckpointKey(self):
+        DTs = self._QS_TestDateTimes
+        return hashlib.sha1(repr((len(DTs), DTs[:1], DTs[-1:], [iModule.Name for iModule in self.Modules])).encode("utf-8")).hexdigest()
+    # 保存检查点, 写入临时文件后替换, 保证检查点文件总是完整的
+    def _saveCheckpoint(self, modules):
+        Checkpoint = {"Key":self._genCheckpointKey(), "DateTimeIndex":self._TestDateTimeIndex, "UserData":self.UserData,
+                      "States":[iModule.__QS_getState__() for iModule in modules]}
+        with open(self.CheckpointFile+".tmp", "wb") as File:
+            pickle.dump(Checkpoint, File, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.CheckpointFile+".tmp", self.CheckpointFile)
+        return 0
+    # 从检查点恢复, 返回: 检查点所在时点的索引, 没有可用的检查点时返回 -1
+    def _loadCheckpoint(self, modules):
+        if (not self.CheckpointFile) or (not os.path.isfile(self.CheckpointFile)): return -1
+        with open(self.CheckpointFile, "rb") as File:
+            Checkpoint = pickle.load(File)
+        if (Checkpoint["Key"]!=self._genCheckpointKey()) or (len(Checkpoint["States"])!=len(modules)): raise __QS_Error__("检查点文件: '%s' 与当前的测试时点或模块不一致!" % (self.CheckpointFile, ))
+        for iModule, iState in zip(modules, Checkpoint["States"]): iModule.__QS_setState__(iState)
+        self.UserData = Checkpoint["UserData"]
+        return Checkpoint["DateTimeIndex"]
     # 运行模型
-    def run(self, dts, subprocess_num=0):
+    # subprocess_num: 子进程数, pilot_num: 多进程回测前试运行的时点数, 用于估计各模块的计算量
+    # resume: 是否从检查点文件恢复, 只支持单进程运行, 已经完成的时点不再重新计算
+    def run(self, dts, subprocess_num=0, pilot_num=0, resume=False):
+        if resume and (subprocess_num>0): raise __QS_Error__("从检查点恢复只支持单进程运行!")
         self._QS_TestDateTimes = sorted(dts)
-        if subprocess_num>0: return self._runMultiProcs(subprocess_num)
+        self._initDateIndex()
+        self._Profiler = None
+        if subprocess_num>0: return self._runMultiProcs(subprocess_num, pilot_num=pilot_num)
         TotalStartT = time.perf_counter()
         print("==========历史回测==========", "1. 初始化", sep="\n", end="\n")
         self.UserData = {}# 清空上次运行生成的用户数据
-        FTs = set()
-        for jModule in self.Modules:
-            jFTs = jModule.__QS_start__(mdl=self, dts=self._QS_TestDateTimes)
-            if jFTs is not None: FTs.update(set(jFTs))
-        for jFT in FTs: jFT.start(dts=self._QS_TestDateTimes)
-        print(("耗时 : %.2f" % (time.perf_counter()-TotalStartT, )), "2. 循环计算", sep="\n", end="\n")
+        self._Profiler = Profiler = (BackTestProfiler() if self.Profile else None)
+        if Profiler is None: return self._runSingleProc(resume, TotalStartT)
+        setReadProfiler(Profiler)# 性能分析期间记录模块对因子表的所有读取, 包括非遍历模式的读取
+        try:
+            return self._runSingleProc(resume, TotalStartT)
+        finally:
+            setReadProfiler(None)
+    # 单进程运行模型, 在 run 中完成初始化后调用
+    def _runSingleProc(self, resume, total_start_t):
+        Profiler = self._Profiler
+        FTs, LoopModules, BatchModules = _startModules(self, self.Modules, profiler=Profiler)
+        print(("耗时 : %.2f" % (time.perf_counter()-total_start_t, )), "2. 循环计算", sep="\n", end="\n")
         StartT = time.perf_counter()
-        with ProgressBar(max_value=len(self._QS_TestDateTimes)) as ProgBar:
-            for i, iDT in enumerate(self._QS_TestDateTimes):
-                self._TestDateTimeIndex = i
-                self._TestDateIndex.loc[iDT.date()] = i
-                for jFT in FTs: jFT.move(iDT)
-                for jModule in self.Modules: jModule.__QS_move__(iDT)
-                ProgBar.update(i+1)
+        _runBatchModules(self, BatchModules, profiler=Profiler)
+        StartInd = (self._loadCheckpoint(LoopModules) + 1 if resume else 0)
+        for jFT in FTs:
+            jFT.start(dts=self._QS_TestDateTimes)
+            jFT.alignDateTime(self._QS_TestDateTimes)
+        ReadBroker = _StepReadBroker(profiler=Profiler)
+        for jFT in FTs: jFT.ErgodicMode._ReadBroker = ReadBroker
+        if Profiler is not None: LoopLabels = [self._getModuleLabel(jModule) for jModule in LoopModules]
+        CheckpointT = time.perf_counter()
+        try:# 异常退出时也要解除因子表与读取代理的关联, 避免之后直接读取因子表时仍然经过代理
+            with ProgressBar(max_value=len(self._QS_TestDateTimes)) as ProgBar:
+                for i in range(StartInd, len(self._QS_TestDateTimes)):
+                    iDT = self._QS_TestDateTimes[i]
+                    self._TestDateTimeIndex = i
+                    ReadBroker.clear()
+                    if Profiler is None:
+                        for jFT in FTs: jFT.move(iDT, dt_index=i)
+                        for jModule in LoopModules: jModule.__QS_move__(iDT)
+                    else:
+                        for jFT in FTs: Profiler.call(jFT.Name, "move", jFT.move, iDT, dt_index=i)
+                        for j, jModule in enumerate(LoopModules):
+                            Profiler.CurModule = LoopLabels[j]
+                            Profiler.call(LoopLabels[j], "move", jModule.__QS_move__, iDT)
+                        Profiler.CurModule = None
+                    if self.CheckpointFile and (time.perf_counter()-CheckpointT>=self.CheckpointInterval):
+                        self._saveCheckpoint(LoopModules)
+                        CheckpointT = time.perf_counter()
+                    ProgBar.update(i+1)
+        finally:
+            for jFT in FTs: jFT.ErgodicMode._ReadBroker = None
+        if self.CheckpointFile and os.path.isfile(self.CheckpointFile): os.remove(self.CheckpointFile)
         print(("耗时 : %.2f" % (time.perf_counter()-StartT, )), "3. 结果生成", sep="\n", end="\n")
         StartT = time.perf_counter()
-        for jModule in self.Modules: jModule.__QS_end__()
+        for jModule in self.Modules:
+            if Profiler is None: jModule.__QS_end__()
+            else: Profiler.call(self._getModuleLabel(jModule), "end", jModule.__QS_end__)
         for jFT in FTs: jFT.end()
-        print(("耗时 : %.2f" % (time.perf_counter()-StartT, )), ("总耗时 : %.2f" % (time.perf_counter()-TotalStartT, )), "="*28, sep="\n", end="\n")
+        print(("耗时 : %.2f" % (time.perf_counter()-StartT, )), ("总耗时 : %.2f" % (time.perf_counter()-total_start_t, )), "="*28, sep="\n", end="\n")
         self._Output = self.output()
+        if (Profiler is not None) and self.TraceFile: Profiler.saveChromeTrace(self.TraceFile)
         return 0
-    def _runMultiProcs(self, subprocess_num):
+    # 在模块的副本上试运行前 pilot_num 个时点, 返回: (array(每个模块单个时点的平均耗时), [每个模块使用的因子表集合])
+    # 副本在试运行后直接丢弃, 不调用 __QS_end__, 模块自身和模型的用户数据不受影响; pilot_num 为 0 时只启动副本以获取使用的因子表, 耗时返回 None
+    def _pilotRun(self, pilot_num):
+        DTs = (self._QS_TestDateTimes[:pilot_num] if pilot_num>0 else self._QS_TestDateTimes)
+        Modules = [_copyModule(jModule) for jModule in self.Modules]
+        UserData, self.UserData = self.UserData, {}
+        FTs, ModuleFTs, LoopInds, BatchModules, Costs = set(), [], [], [], np.zeros(len(Modules))
+        try:
+            for j, jModule in enumerate(Modules):
+                jFTs = jModule.__QS_start__(mdl=self, dts=DTs)
+                jRequests = (jModule.__QS_batchRequests__(dts=DTs) if self.BatchMode else None)
+                if jRequests is None:
+                    ModuleFTs.append(set(jFTs) if jFTs is not None else set())
+                    FTs.update(ModuleFTs[-1])
+                    LoopInds.append(j)
+                else:# 批量模式的模块不遍历因子表, 按数据请求中的因子表分组
+                    jRequests = list(jRequests)
+                    ModuleFTs.append(set(iRequest[0] for iRequest in jRequests))
+                    BatchModules.append((j, jRequests))
+            if pilot_num<=0: return (None, ModuleFTs)
+            for j, jRequests in BatchModules:
+                jStartT = time.perf_counter()
+                Modules[j].__QS_batch__(dts=DTs, data=readBatchData(jRequests))
+                Costs[j] += time.perf_counter() - jStartT
+            for jFT in FTs: jFT.start(dts=DTs)
+            try:
+                for i, iDT in enumerate(DTs):
+                    self._TestDateTimeIndex = i
+                    for jFT in FTs: jFT.move(iDT)
+                    for j in LoopInds:
+                        jStartT = time.perf_counter()
+                        Modules[j].__QS_move__(iDT)
+                        Costs[j] += time.perf_counter() - jStartT
+            finally:
+                for jFT in FTs: jFT.end()
+        finally:
+            self.UserData = UserData
+            self._TestDateTimeIndex = -1
+        return (Costs / max(1, len(DTs)), ModuleFTs)
+    # 根据估计的计算量在 n_prc 个子进程之间分配模块, 返回: [[模块索引]]
+    # 模块自己声明的计算量优先, 其次是试运行的测量值, 都没有时每个模块计为 1;
+    # 使用相同因子表的模块在合并后的计算量不超过单个进程平均负荷的前提下分到同一组, 以共享因子表的遍历缓存
+    def _scheduleModules(self, n_prc, pilot_num=0):
+        nModule = len(self.Modules)
+        Costs, ModuleFTs = self._pilotRun(pilot_num)
+        Costs = (Costs * len(self._QS_TestDateTimes) if Costs is not None else np.ones(nModule))
+        for j, jModule in enumerate(self.Modules):
+            jCost = jModule.__QS_estimateCost__(dts=self._QS_TestDateTimes)
+            if jCost is not None: Costs[j] = jCost
+        AvgCost = Costs.sum() / n_prc
+        Groups, GroupFTs, GroupCosts = [], [], []
+        for j in np.argsort(-Costs, kind="stable"):
+            for k in range(len(Groups)):
+                if (GroupFTs[k] & ModuleFTs[j]) and (GroupCosts[k]+Costs[j]<=AvgCost):
+                    Groups[k].append(j)
+                    GroupFTs[k] |= ModuleFTs[j]
+                    GroupCosts[k] += Costs[j]
+                    break
+            else:
+                Groups.append([j])
+                GroupFTs.append(set(ModuleFTs[j]))
+                GroupCosts.append(Costs[j])
+        Partition, Loads = [[] for i in range(n_prc)], np.zeros(n_prc)
+        for k in np.argsort(-np.array(GroupCosts), kind="stable"):
+            iPrc = np.argmin(Loads)
+            Partition[iPrc] += Groups[k]
+            Loads[iPrc] += GroupCosts[k]
+        return [sorted(int(j) for j in iInds) for iInds in Partition]
+    def _runMultiProcs(self, subprocess_num, pilot_num=0):
         nPrcs = min(subprocess_num, len(self.Modules))
-        Args = {"mdl":self, "module_inds":np.arange(len(self.Modules)).tolist(), "OutputPipe":QSPipe()}
         TotalStartT = time.perf_counter()
         print("==========历史回测==========", "1. 初始化", sep="\n", end="\n")
+        Args = {"mdl":self, "module_partition":self._scheduleModules(nPrcs, pilot_num=pilot_num), "OutputPipe":QSMMAPPipe()}
         Procs, Main2SubQueue, Sub2MainQueue = startMultiProcess(pid="0", n_prc=nPrcs, target_fun=_runModel,
-                                                                arg=Args, partition_arg=["module_inds"],
-                                                                main2sub_queue=None, sub2main_queue="Single")
+                                                                arg=Args, main2sub_queue=None, sub2main_queue="Single")
         nTask = nPrcs * len(self._QS_TestDateTimes)
         InitStage, CalcStage, EndStage = 0, 0, 0
         self._Output = {}
@@ -182,12 +623,45 @@ class BackTestModel(__QS_Object__):
                 EndStage += 1
                 self._Output.update(Args["OutputPipe"].get())
         for iPID, iPrcs in Procs.items(): iPrcs.join()
+        Args["OutputPipe"].close()
         return 0
+    # 参数扫描, 以 template 为模板对 param_grid 中的每组参数生成一个模块, 所有模块放入同一个模型中运行, 共享因子表的遍历缓存和单时点读取代理
+    # template: 模板模块, param_grid: {参数名: [参数值]}, 取笛卡尔积; subprocess_num: 子进程数, 模块在子进程之间分配
+    # batch_size: 每次运行的模块数, 每批运行结束后结果写入 output_dir 并释放内存
+    # 返回: SweepResult
+    def sweep(self, dts, template, param_grid, subprocess_num=0, batch_size=10, output_dir=None):
+        batch_size = int(batch_size)
+        if batch_size<=0: raise __QS_Error__("参数扫描的 batch_size 必须为正整数!")
+        ArgNames = list(param_grid.keys())
+        Params = list(itertools.product(*[param_grid[iArgName] for iArgName in ArgNames]))
+        Index = pd.DataFrame(Params, columns=ArgNames)
+        if output_dir is None: output_dir = tempfile.mkdtemp()
+        elif not os.path.isdir(output_dir): os.makedirs(output_dir)
+        nVariant = Index.shape[0]
+        Modules = self.Modules
+        try:
+            for iStartInd in range(0, nVariant, batch_size):
+                iInds = Index.index[iStartInd:iStartInd+batch_size]
+                iModules = []
+                for j in iInds:
+                    jModule = _copyModule(template)
+                    for k, kArgName in enumerate(ArgNames): jModule[kArgName] = Params[j][k]
+                    iModules.append(jModule)
+                self.Modules = iModules
+                self.run(dts, subprocess_num=subprocess_num)
+                for k, j in enumerate(iInds):
+                    with open(output_dir+os.sep+str(j)+".pkl", "wb") as File:
+                        pickle.dump(self._Output.get(str(k)+"-"+iModules[k].Name, {}), File)
+                self._Output = {}
+        finally:
+            self.Modules = Modules
+        return SweepResult(Index, output_dir)
     # 计算并输出测试的结果集
     def output(self, recalculate=False):
         self._Output = {}
         for j, jModule in enumerate(self.Modules):
-            iOutput = jModule.output(recalculate=recalculate)
+            if self._Profiler is None: iOutput = jModule.output(recalculate=recalculate)
+            else: iOutput = self._Profiler.call(str(j)+"-"+jModule.Name, "output", jModule.output, recalculate=recalculate)
             if iOutput: self._Output[str(j)+"-"+jModule.Name] = iOutput
         return self._Output
     # 对象的 HTML 表示
@@ -15,7 +15,7 @@ from QuantStudio import __QS_Error__
 from QuantStudio.Tools.AuxiliaryFun import getFactorList, searchNameInStrList, distributeEqual
 from QuantStudio.Tools.DataPreprocessingFun import prepareRegressData
 from QuantStudio.Tools.StrategyTestFun import calcPortfolioReturn, calcTurnover, calcMaxDrawdownRate
-from QuantStudio.BackTest.BackTestModel import BaseModule
+from QuantStudio.BackTest.BackTestModel import BaseModule, OutputSpool
 from QuantStudio.PortfolioConstructor import BasePC
 from QuantStudio.BackTest.SectionFactor.IC import _QS_formatMatplotlibPercentage, _QS_formatPandasPercentage
 
@@ -65,13 +65,15 @@ class QuantilePortfolio(BaseModule):
     def __QS_start__(self, mdl, dts, **kwargs):
         if self._isStarted: return ()
         super().__QS_start__(mdl=mdl, dts=dts, **kwargs)
+        self._clearSpools()
         self._Output = {"净值":[[1] for i in range(self.GroupNum)]}
-        self._Output["投资组合"] = [[] for i in range(self.GroupNum)]
+        self._Output["投资组合"] = [OutputSpool() for i in range(self.GroupNum)]
         self._Output["换手率"] = [[] for i in range(self.GroupNum)]
         self._Output["市场净值"] = [1]
         self._Output["调仓日"] = []
         self._Output["QP_P_CurPos"] = [pd.Series() for i in range(self.GroupNum)]
         self._Output["QP_P_MarketPos"] = pd.Series()
+        self._Output["QP_P_LastPortfolio"] = [None for i in range(self.GroupNum)]
         self._CurCalcInd = 0
         return (self._FactorTable, )
     def __QS_move__(self, idt, **kwargs):
@@ -117,14 +119,14 @@ class QuantilePortfolio(BaseModule):
                 iPortfolio = WeightData[iSubIDs]
                 iPortfolio = iPortfolio/iPortfolio.sum()
                 iPortfolio = iPortfolio[pd.notnull(iPortfolio)]
-                self._Output["投资组合"][i].append(iPortfolio)
+                self._Output["投资组合"][i].append(idt, iPortfolio)
                 self._Output["QP_P_CurPos"][i] = iPortfolio*iWealth/Price
                 self._Output["QP_P_CurPos"][i] = self._Output["QP_P_CurPos"][i][pd.notnull(self._Output["QP_P_CurPos"][i])]
-                nPortfolio = len(self._Output["投资组合"][i])
-                if nPortfolio>1:
-                    self._Output["换手率"][i][-1] = calcTurnover(self._Output["投资组合"][i][-2],self._Output["投资组合"][i][-1])
-                elif nPortfolio==1:
+                if self._Output["QP_P_LastPortfolio"][i] is not None:
+                    self._Output["换手率"][i][-1] = calcTurnover(self._Output["QP_P_LastPortfolio"][i], iPortfolio)
+                else:
                     self._Output["换手率"][i][-1] = 1
+                self._Output["QP_P_LastPortfolio"][i] = iPortfolio
         else:
             Portfolio = [{} for i in range(self.GroupNum)]
             IndustryData = self._FactorTable.readData(dts=[idt], ids=IDs, factor_names=[self.ClassFactor]).iloc[0, 0, :]
@@ -141,14 +143,14 @@ class QuantilePortfolio(BaseModule):
                 iPortfolio = pd.Series(Portfolio[i])
                 iPortfolio = iPortfolio/iPortfolio.sum()
                 iPortfolio = iPortfolio[pd.notnull(iPortfolio)]
-                self._Output["投资组合"][i].append(iPortfolio)
+                self._Output["投资组合"][i].append(idt, iPortfolio)
                 self._Output["QP_P_CurPos"][i] = iPortfolio*iWealth/Price
                 self._Output["QP_P_CurPos"][i] = self._Output["QP_P_CurPos"][i][pd.notnull(self._Output["QP_P_CurPos"][i])]
-                nPortfolio = len(self._Output["投资组合"][i])
-                if nPortfolio>1:
-                    self._Output["换手率"][i][-1] = calcTurnover(self._Output["投资组合"][i][-2],self._Output["投资组合"][i][-1])
-                elif nPortfolio==1:
+                if self._Output["QP_P_LastPortfolio"][i] is not None:
+                    self._Output["换手率"][i][-1] = calcTurnover(self._Output["QP_P_LastPortfolio"][i], iPortfolio)
+                else:
                     self._Output["换手率"][i][-1] = 1
+                self._Output["QP_P_LastPortfolio"][i] = iPortfolio
         if self.MarketIDFilter:
             IDs = self._FactorTable.getFilteredID(idt=idt, id_filter_str=self.MarketIDFilter)
         WeightData = WeightData[IDs]
@@ -159,11 +161,27 @@ class QuantilePortfolio(BaseModule):
         self._Output["QP_P_MarketPos"] = self._Output["QP_P_MarketPos"][pd.notnull(self._Output["QP_P_MarketPos"])]
         self._Output["调仓日"].append(idt)
         return 0
+    # 删除上次测试中没有还原的投资组合磁盘缓冲
+    def _clearSpools(self):
+        Portfolio = getattr(self, "_Output", {}).get("投资组合", {})
+        for iSpool in (Portfolio.values() if isinstance(Portfolio, dict) else Portfolio):
+            if isinstance(iSpool, OutputSpool): iSpool.clear()
+        return 0
+    # 投资组合在第一次访问结果集时才从磁盘缓冲还原成 DataFrame, 之后删除缓冲
+    def output(self, recalculate=False):
+        Portfolio = self._Output.get("投资组合")
+        if isinstance(Portfolio, dict):
+            for iKey, iSpool in Portfolio.items():
+                if isinstance(iSpool, OutputSpool):
+                    Portfolio[iKey] = iSpool.toDataFrame()
+                    iSpool.clear()
+        return self._Output
     def __QS_end__(self):
         if not self._isStarted: return 0
         super().__QS_end__()
         self._Output.pop("QP_P_CurPos")
         self._Output.pop("QP_P_MarketPos")
+        self._Output.pop("QP_P_LastPortfolio")
         for i in range(self.GroupNum):
             self._Output["净值"][i].pop(0)
         self._Output["净值"] = pd.DataFrame(np.array(self._Output["净值"]).T, index=self._Model.DateTimeSeries)
@@ -173,7 +191,7 @@ class QuantilePortfolio(BaseModule):
         self._Output["收益率"]["L-S"] = self._Output["收益率"].iloc[:, 0] - self._Output["收益率"].iloc[:, -2]
         self._Output["净值"]["L-S"] = (1 + self._Output["收益率"]["L-S"]).cumprod()
         self._Output["换手率"] = pd.DataFrame(np.array(self._Output["换手率"]).T, index=self._Model.DateTimeSeries)
-        self._Output["投资组合"] = {str(i): pd.DataFrame(self._Output["投资组合"][i], index=self._Output["调仓日"]) for i in range(self.GroupNum)}
+        self._Output["投资组合"] = {str(i): iSpool for i, iSpool in enumerate(self._Output["投资组合"])}# 保留磁盘缓冲, 在 output 中再还原
         self._Output["超额收益率"] = self._Output["收益率"].copy()
         self._Output["超额净值"] = self._Output["超额收益率"].copy()
         for i in self._Output["超额收益率"]:
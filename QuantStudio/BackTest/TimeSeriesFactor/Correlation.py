@@ -86,6 +86,34 @@ class TimeSeriesCorrelation(BaseModule):
             if self._Output["收益率"].shape[0]>=self.MinSummaryWindow:
                 self._Output["滚动相关性"][iFactorName][idt] = pd.DataFrame(np.c_[self._Output["因子值"][iFactorName][StartInd:], self._Output["收益率"][StartInd:]]).corr(method=self.CorrMethod, min_periods=self.MinSummaryWindow).values[:FactorData.shape[1], FactorData.shape[1]:]
         return 0
+    # 计算时点序列及每个计算时点对应的 (计算时点, 收益起始时点, 因子时点) 在其中的位置
+    def _getBatchIndex(self, dts):
+        if self.CalcDTs:
+            BaseDTs = list(self.CalcDTs)
+            CalcInd = pd.Series(np.arange(len(BaseDTs)), index=BaseDTs).reindex(index=dts).dropna().values.astype(np.int64)
+        else:
+            BaseDTs = list(dts)
+            CalcInd = np.arange(len(BaseDTs))
+        LastInd = CalcInd - self.ForecastPeriod
+        PreInd = LastInd - self.Lag
+        Mask = ((PreInd>=0) & (LastInd>=0))
+        return (BaseDTs, CalcInd[Mask], LastInd[Mask], PreInd[Mask])
+    def __QS_batchRequests__(self, dts):
+        BaseDTs, CalcInd, LastInd, PreInd = self._getBatchIndex(dts)
+        return [(self._PriceTable, [self.PriceFactor], self._Output["证券ID"], BaseDTs, {}),
+                (self._FactorTable, list(self.TestFactors), self._Output["因子ID"], BaseDTs, {})]
+    def __QS_batch__(self, dts, data):
+        super().__QS_batch__(dts=dts, data=data)
+        BaseDTs, CalcInd, LastInd, PreInd = self._getBatchIndex(dts)
+        Price, FactorData = data[0].iloc[0].values, data[1].values
+        self._Output["收益率"] = _calcReturn(np.stack([Price[LastInd], Price[CalcInd]]), return_type=self.ReturnType)[0]
+        nFactorID = FactorData.shape[2]
+        for i, iFactorName in enumerate(self.TestFactors):
+            self._Output["因子值"][iFactorName] = FactorData[i][PreInd]
+            for j in range(int(self.MinSummaryWindow)-1, CalcInd.shape[0]):
+                jStartInd = int(max(0, j + 1 - self.SummaryWindow))
+                self._Output["滚动相关性"][iFactorName][BaseDTs[CalcInd[j]]] = pd.DataFrame(np.c_[self._Output["因子值"][iFactorName][jStartInd:j+1], self._Output["收益率"][jStartInd:j+1]]).corr(method=self.CorrMethod, min_periods=self.MinSummaryWindow).values[:nFactorID, nFactorID:]
+        return 0
     def __QS_end__(self):
         if not self._isStarted: return 0
         super().__QS_end__()
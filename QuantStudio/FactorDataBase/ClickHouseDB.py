@@ -14,176 +14,12 @@ from QuantStudio.Tools.AuxiliaryFun import genAvailableName
 from QuantStudio.Tools.DataPreprocessingFun import fillNaByLookback
 from QuantStudio.Tools.QSObjects import QSSQLObject
 from QuantStudio import __QS_Error__, __QS_ConfigPath__
-from QuantStudio.FactorDataBase.SQLDB import SQLDB, _adjustData
+from QuantStudio.FactorDataBase.SQLDB import SQLDB
 
 def _identifyDataType(db_type, dtypes):
     if np.dtype("O") in dtypes.values: return "String"
     else: return "double"
 
-class _WideTable(FactorTable):
-    """SQLDB 宽因子表"""
-    TableType = Enum("宽表", arg_type="SingleOption", label="因子表类型", order=0)
-    LookBack = Float(0, arg_type="Integer", label="回溯天数", order=1)
-    FilterCondition = Str("", arg_type="String", label="筛选条件", order=2)
-    #DTField = Enum("dt", arg_type="SingleOption", label="时点字段", order=3)
-    #IDField = Enum("code", arg_type="SingleOption", label="ID字段", order=4)
-    def __init__(self, name, fdb, sys_args={}, **kwargs):
-        self._DataType = fdb._TableFactorDict[name]
-        self._DBDataType = fdb._TableFieldDataType[name]
-        self._DBTableName = fdb.TablePrefix+fdb.InnerPrefix+name
-        return super().__init__(name=name, fdb=fdb, sys_args=sys_args, **kwargs)
-    def __QS_initArgs__(self):
-        super().__QS_initArgs__()
-        Fields = ["dt"] + self._DBDataType[self._DBDataType.str.contains("date")].index.tolist()
-        self.add_trait("DTField", Enum(*Fields, arg_type="SingleOption", label="时点字段", order=4))
-        StrMask = (self._DBDataType.str.contains("char") | self._DBDataType.str.contains("text"))
-        Fields = ["code"] + self._DBDataType[StrMask].index.tolist()
-        self.add_trait("IDField", Enum(*Fields, arg_type="SingleOption", label="ID字段", order=5))
-    @property
-    def FactorNames(self):
-        return self._DataType.index.tolist()+["dt", "code"]
-    def getFactorMetaData(self, factor_names=None, key=None, args={}):
-        if factor_names is None: factor_names = self.FactorNames
-        if key=="DataType": return self._DataType.append(pd.Series(["string", "string"], index=["dt","code"])).loc[factor_names]
-        if key is None: return pd.DataFrame(self._DataType.append(pd.Series(["string", "string"], index=["dt","code"])).loc[factor_names], columns=["DataType"])
-        else: return pd.Series([None]*len(factor_names), index=factor_names, dtype=np.dtype("O"))
-    def getID(self, ifactor_name=None, idt=None, args={}):
-        IDField = args.get("ID字段", self.IDField)
-        DTField = args.get("时点字段", self.DTField)
-        SQLStr = "SELECT DISTINCT "+self._DBTableName+"."+IDField+" "
-        SQLStr += "FROM "+self._DBTableName+" "
-        SQLStr += "WHERE "+self._DBTableName+"."+IDField+" IS NOT NULL "
-        if idt is not None: SQLStr += "AND "+self._DBTableName+"."+DTField+"='"+idt.strftime("%Y-%m-%d %H:%M:%S.%f")+"' "
-        if ifactor_name is not None: SQLStr += "AND "+self._DBTableName+"."+ifactor_name+" IS NOT NULL "
-        FilterStr = args.get("筛选条件", self.FilterCondition)
-        if FilterStr: SQLStr += "AND "+FilterStr.format(Table=self._DBTableName)+" "
-        SQLStr += "ORDER BY "+self._DBTableName+"."+IDField
-        return [iRslt[0] for iRslt in self._FactorDB.fetchall(SQLStr)]
-    def getDateTime(self, ifactor_name=None, iid=None, start_dt=None, end_dt=None, args={}):
-        IDField = args.get("ID字段", self.IDField)
-        DTField = args.get("时点字段", self.DTField)
-        SQLStr = "SELECT DISTINCT "+self._DBTableName+"."+DTField+" "
-        SQLStr += "FROM "+self._DBTableName+" "
-        SQLStr += "WHERE "+self._DBTableName+"."+DTField+" IS NOT NULL "
-        if iid is not None: SQLStr += "AND "+self._DBTableName+"."+IDField+"='"+iid+"' "
-        if start_dt is not None: SQLStr += "AND "+self._DBTableName+"."+DTField+">='"+start_dt.strftime("%Y-%m-%d %H:%M:%S.%f")+"' "
-        if end_dt is not None: SQLStr += "AND "+self._DBTableName+"."+DTField+"<='"+end_dt.strftime("%Y-%m-%d %H:%M:%S.%f")+"' "
-        if ifactor_name is not None: SQLStr += "AND "+self._DBTableName+"."+ifactor_name+" IS NOT NULL "
-        FilterStr = args.get("筛选条件", self.FilterCondition)
-        if FilterStr: SQLStr += "AND "+FilterStr.format(Table=self._DBTableName)+" "
-        SQLStr += "ORDER BY "+self._DBTableName+"."+DTField
-        if self._FactorDB.DBType!="sqlite3": return [iRslt[0] for iRslt in self._FactorDB.fetchall(SQLStr)]
-        else: return [dt.datetime.strptime(iRslt[0], "%Y-%m-%d %H:%M:%S.%f") for iRslt in self._FactorDB.fetchall(SQLStr)]
-    def __QS_genGroupInfo__(self, factors, operation_mode):
-        ArgConditionGroup = {}
-        ArgNames = self.ArgNames
-        ArgNames.remove("回溯天数")
-        ArgNames.remove("因子值类型")
-        ArgNames.remove("遍历模式")
-        for iFactor in factors:
-            iArgConditions = (";".join([iArgName+":"+str(iFactor[iArgName]) for iArgName in ArgNames]))
-            if iArgConditions not in ArgConditionGroup:
-                ArgConditionGroup[iArgConditions] = {"FactorNames":[iFactor.Name], 
-                                                     "RawFactorNames":{iFactor._NameInFT}, 
-                                                     "StartDT":operation_mode._FactorStartDT[iFactor.Name], 
-                                                     "args":iFactor.Args.copy()}
-            else:
-                ArgConditionGroup[iArgConditions]["FactorNames"].append(iFactor.Name)
-                ArgConditionGroup[iArgConditions]["RawFactorNames"].add(iFactor._NameInFT)
-                ArgConditionGroup[iArgConditions]["StartDT"] = min(operation_mode._FactorStartDT[iFactor.Name], ArgConditionGroup[iArgConditions]["StartDT"])
-                ArgConditionGroup[iArgConditions]["args"]["回溯天数"] = max(ArgConditionGroup[iArgConditions]["args"]["回溯天数"], iFactor.LookBack)
-        EndInd = operation_mode.DTRuler.index(operation_mode.DateTimes[-1])
-        Groups = []
-        for iArgConditions in ArgConditionGroup:
-            StartInd = operation_mode.DTRuler.index(ArgConditionGroup[iArgConditions]["StartDT"])
-            Groups.append((self, ArgConditionGroup[iArgConditions]["FactorNames"], list(ArgConditionGroup[iArgConditions]["RawFactorNames"]), operation_mode.DTRuler[StartInd:EndInd+1], ArgConditionGroup[iArgConditions]["args"]))
-        return Groups
-    def _genNullIDSQLStr(self, factor_names, ids, end_date, args={}):
-        IDField = args.get("ID字段", self.IDField)
-        DTField = args.get("时点字段", self.DTField)
-        DT2Str = args.get("时间转字符串", self.DT2Str)
-        SubSQLStr = "SELECT "+IDField+", "
-        SubSQLStr += "MAX("+DTField+") "
-        SubSQLStr += "FROM "+self._DBTableName+" "
-        SubSQLStr += "WHERE "+DTField+"<'"+end_date.strftime("%Y-%m-%d:%H:%M:%S.%f")+"' "
-        SubSQLStr += "AND ("+genSQLInCondition(IDField, ids, is_str=True, max_num=1000)+") "
-        FilterStr = args.get("筛选条件", self.FilterCondition)
-        if FilterStr: SubSQLStr += "AND "+FilterStr.format(Table=self._DBTableName)+" "
-        SubSQLStr += "GROUP BY "+IDField
-        SQLStr = "SELECT "+DTField+", "
-        SQLStr += IDField+", "
-        for iField in factor_names:
-            if iField=="dt": iDBDataType = "DateTime"
-            elif iField=="code": iDBDataType = "String"
-            else: iDBDataType = self._FactorDB._TableFieldDataType[self._Name][iField]            
-            if DT2Str and (iDBDataType.lower().find("date")!=-1):
-                SQLStr += "DATE_FORMAT("+iField+", '%Y-%m-%d %H:%i:%s'), "
-            else:
-                SQLStr += iField+", "
-        SQLStr = SQLStr[:-2]+" FROM "+self._DBTableName+" "
-        SQLStr += "WHERE ("+IDField+", "+DTField+") IN ("+SubSQLStr+") "
-        if FilterStr: SQLStr += "AND "+FilterStr.format(Table=self._DBTableName)+" "
-        return SQLStr
-    def __QS_prepareRawData__(self, factor_names, ids, dts, args={}):
-        if (dts==[]) or (ids==[]): return pd.DataFrame(columns=["QS_DT", "ID"]+factor_names)
-        IDField = args.get("ID字段", self.IDField)
-        DTField = args.get("时点字段", self.DTField)
-        LookBack = args.get("回溯天数", self.LookBack)
-        DT2Str = args.get("时间转字符串", self.DT2Str)
-        if dts is not None:
-            dts = sorted(dts)
-            StartDate, EndDate = dts[0].date(), dts[-1].date()
-            if not np.isinf(LookBack): StartDate -= dt.timedelta(LookBack)
-        else:
-            StartDate = EndDate = None
-        # 形成 SQL 语句, 时点, ID, 因子数据
-        SQLStr = "SELECT "+self._DBTableName+"."+DTField+", "
-        SQLStr += self._DBTableName+"."+IDField+", "
-        for iField in factor_names:
-            if iField=="datetime": iDBDataType = "datetime"
-            elif iField=="code": iDBDataType = "varchar(40)"
-            else: iDBDataType = self._FactorDB._TableFieldDataType[self._Name][iField]
-            if DT2Str and (iDBDataType.lower().find("date")!=-1):
-                SQLStr += "DATE_FORMAT("+self._DBTableName+"."+iField+", '%Y-%m-%d %H:%i:%s'), "
-            else:
-                SQLStr += self._DBTableName+"."+iField+", "
-        SQLStr = SQLStr[:-2]+" FROM "+self._DBTableName+" "
-        if StartDate is not None:
-            SQLStr += "WHERE "+self._DBTableName+"."+DTField+">='"+StartDate.strftime("%Y-%m-%d %H:%M:%S.%f")+"' "
-            SQLStr += "AND "+self._DBTableName+"."+DTField+"<='"+EndDate.strftime("%Y-%m-%d %H:%M:%S.%f")+"' "
-        else:
-            SQLStr += "WHERE "+self._DBTableName+"."+DTField+" IS NOT NULL "
-        if ids is not None:
-            SQLStr += "AND ("+genSQLInCondition(self._DBTableName+"."+IDField, ids, is_str=True, max_num=1000)+") "
-        FilterStr = args.get("筛选条件", self.FilterCondition)
-        if FilterStr: SQLStr += "AND "+FilterStr.format(Table=self._DBTableName)+" "
-        SQLStr += "ORDER BY "+self._DBTableName+"."+DTField+", "+self._DBTableName+"."+IDField
-        if args.get("因子值类型", self.ValueType)!="scalar":
-            SQLStr += ", "+self._DBTableName+"."+factor_names[0]
-        RawData = self._FactorDB.fetchall(SQLStr)
-        if not RawData: RawData = pd.DataFrame(columns=["QS_DT", "ID"]+factor_names)
-        RawData = pd.DataFrame(np.array(RawData), columns=["QS_DT", "ID"]+factor_names)
-        if (StartDate is not None) and np.isinf(LookBack):
-            NullIDs = set(ids).difference(set(RawData[RawData["QS_DT"]==dt.datetime.combine(StartDate, dt.time(0))]["ID"]))
-            if NullIDs:
-                NullRawData = self._FactorDB.fetchall(self._genNullIDSQLStr(factor_names, list(NullIDs), StartDate, args=args))
-                if NullRawData:
-                    NullRawData = pd.DataFrame(np.array(NullRawData, dtype="O"), columns=["QS_DT", "ID"]+factor_names)
-                    RawData = pd.concat([NullRawData, RawData], ignore_index=True)
-                    RawData.sort_values(by=["QS_DT", "ID"])
-        if self._FactorDB.DBType=="sqlite3": RawData["QS_DT"] = [dt.datetime.strptime(iDT, "%Y-%m-%d %H:%M:%S.%f") for iDT in RawData.pop("QS_DT")]
-        return RawData
-    def __QS_calcData__(self, raw_data, factor_names, ids, dts, args={}):
-        if raw_data.shape[0]==0: return pd.Panel(items=factor_names, major_axis=dts, minor_axis=ids)
-        raw_data = raw_data.set_index(["QS_DT", "ID"])
-        DataType = self.getFactorMetaData(factor_names=factor_names, key="DataType", args=args)
-        Data = {}
-        for iFactorName in raw_data.columns:
-            iRawData = raw_data[iFactorName].unstack()
-            if DataType[iFactorName]=="double": iRawData = iRawData.astype("float")
-            Data[iFactorName] = iRawData
-        return _adjustData(Data, args.get("回溯天数", self.LookBack), factor_names, ids, dts)
-
 class ClickHouseDB(SQLDB):
     """ClickHouseDB"""
     DBType = Enum("ClickHouse", arg_type="SingleOption", label="数据库类型", order=0)
@@ -203,17 +39,31 @@ class ClickHouseDB(SQLDB):
         super().__init__(sys_args=sys_args, config_file=(__QS_ConfigPath__+os.sep+"ClickHouseDBConfig.json" if config_file is None else config_file), **kwargs)
         self._TableFactorDict = {}# {表名: pd.Series(数据类型, index=[因子名])}
         self._TableFieldDataType = {}# {表名: pd.Series(数据库数据类型, index=[因子名])}
+        self._Client = None# clickhouse-driver 的原生客户端, 用于按列读取数据
+        self._UseNumpy = False# clickhouse-driver 是否支持直接返回 numpy 数组
         self.Name = "ClickHouseDB"
         return
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_Client"] = None
+        return state
     def _connect(self):
-        self._Connection = None
+        self._Connection = self._Client = None
         if (self.Connector=="clickhouse-driver") or ((self.Connector=="default") and (self.DBType=="ClickHouse")):
             try:
                 import clickhouse_driver
                 if self.DSN:
                     self._Connection = clickhouse_driver.connect(dsn=self.DSN, password=self.Pwd)
+                    self._Client = clickhouse_driver.Client.from_url(self.DSN)
                 else:
                     self._Connection = clickhouse_driver.connect(user=self.User, password=self.Pwd, host=self.IPAddr, port=self.Port, database=self.DBName)
+                    self._Client = clickhouse_driver.Client(user=self.User, password=self.Pwd, host=self.IPAddr, port=self.Port, database=self.DBName)
+                try:
+                    import clickhouse_driver.columns.numpy
+                except ImportError:
+                    self._UseNumpy = False
+                else:
+                    self._UseNumpy = True
             except Exception as e:
                 Msg = ("'%s' 尝试使用 clickhouse-driver 连接(%s@%s:%d)数据库 '%s' 失败: %s" % (self.Name, self.User, self.IPAddr, self.Port, self.DBName, str(e)))
                 self._QS_Logger.error(Msg)
@@ -222,8 +72,31 @@ class ClickHouseDB(SQLDB):
                 self._Connector = "clickhouse-driver"
         self._PID = os.getpid()
         return 0
-    def connect(self):
-        super().connect()
+    def disconnect(self):
+        if self._Client is not None:
+            try:
+                self._Client.disconnect()
+            except Exception as e:
+                self._QS_Logger.warning("'%s' 断开 clickhouse-driver 客户端错误: %s" % (self.Name, str(e)))
+            finally:
+                self._Client = None
+        return super().disconnect()
+    # 通过 clickhouse-driver 的原生客户端按列读取数据, 支持时直接返回 numpy 数组, 不再逐行构造元组
+    def _fetchColumns(self, sql_str, params):
+        if self._Client is None: return super()._fetchColumns(sql_str, params)
+        if os.getpid()!=self._PID: self._connect()# 如果进程号发生变化, 重连
+        if self.AdjustTableName:
+            for iTable in self._AllTables:
+                sql_str = re.sub(iTable, iTable, sql_str, flags=re.IGNORECASE)
+        if params: sql_str, params = self._adaptParamStyle(sql_str, params)
+        Data, ColumnTypes = self._Client.execute(sql_str, (params if params else None), with_column_types=True, columnar=True, settings={"use_numpy": self._UseNumpy})
+        if not Data: return [np.array([], dtype="O") for i in range(len(ColumnTypes))]
+        return [(iCol if isinstance(iCol, np.ndarray) else np.array(iCol, dtype="O")) for iCol in Data]
+    def _getSchemaVersion(self):
+        SQLStr = ("SELECT count(), groupBitXor(cityHash64(table, name, type)) FROM system.columns WHERE database='%s' " % self.DBName)
+        SQLStr += ("AND table LIKE '%s%%'" % self.InnerPrefix)
+        return self._fetchSchemaVersion(SQLStr)
+    def _reflectMeta(self):
         nPrefix = len(self.InnerPrefix)
         SQLStr = ("SELECT table, name, type FROM system.columns WHERE database='%s' " % self.DBName)
         SQLStr += ("AND table LIKE '%s%%' " % self.InnerPrefix)
@@ -233,7 +106,9 @@ class ClickHouseDB(SQLDB):
         else:
             SQLStr += ") "
         SQLStr += "ORDER BY table, name"
-        Rslt = self.fetchall(SQLStr)
+        Cursor = self.cursor(SQLStr)# 结构信息不经过查询缓存
+        Rslt = Cursor.fetchall()
+        Cursor.close()
         if not Rslt:
             self._TableFieldDataType = {}
             self._TableFactorDict = {}
@@ -437,4 +312,5 @@ class ClickHouseDB(SQLDB):
             Cursor.executemany(SQLStr, NewData.reset_index().values.tolist())
         self._Connection.commit()
         Cursor.close()
+        self.invalidateQueryCache()
         return 0
\ No newline at end of file
@@ -1,5 +1,7 @@
 # coding=utf-8
 import os
+import pickle
+import hashlib
 import datetime as dt
 
 import numpy as np
@@ -8,7 +10,7 @@ from traits.api import Str, Bool, Float, Function, Either, List, Enum, on_trait_
 
 from QuantStudio import __QS_Error__
 from QuantStudio.Tools.DateTimeFun import getDateTimeSeries
-from QuantStudio.Tools.DataPreprocessingFun import fillNaByLookback
+from QuantStudio.Tools.DataPreprocessingFun import fillNaByLookback3D
 from QuantStudio.Tools.SQLDBFun import genSQLInCondition
 from QuantStudio.FactorDataBase.FactorDB import FactorTable
 
@@ -64,6 +66,167 @@ def adjustDateTime(data, dts, fillna=False, **kwargs):
             data = data.loc[FactorNames, dts, :]
     return data
 
+# 将窄表格式的原始数据转换成 Panel
+# raw_data: DataFrame(columns=[dt_field, id_field, factor_field, value_field]), data_type: 数据类型, str 或者 {因子名: 数据类型}
+# 一次性对时点, ID, 因子进行编码, 然后将因子值直接写入预先分配的三维数组
+def pivotNarrowData(raw_data, factor_names, factor_field, value_field, dt_field="QS_DT", id_field="ID", data_type="double"):
+    FactorCodes = pd.Index(factor_names).get_indexer(raw_data[factor_field].values)
+    Mask = (FactorCodes>=0)
+    if not np.all(Mask): raw_data, FactorCodes = raw_data[Mask], FactorCodes[Mask]
+    if raw_data.shape[0]==0: return None
+    DTCodes, DTs = pd.factorize(raw_data[dt_field].values, sort=True)
+    IDCodes, IDs = pd.factorize(raw_data[id_field].values, sort=True)
+    nDT, nID = DTs.shape[0], IDs.shape[0]
+    FlatInd = (FactorCodes.astype(np.int64) * nDT + DTCodes) * nID + IDCodes
+    if np.unique(FlatInd).shape[0]<FlatInd.shape[0]: raise __QS_Error__("窄表数据中存在重复的(时点, ID, 因子), 无法转换!")
+    if isinstance(data_type, str): data_type = {iFactorName: data_type for iFactorName in factor_names}
+    isDouble = np.array([(data_type.get(iFactorName, "double")=="double") for iFactorName in factor_names])
+    Values = raw_data[value_field].values
+    if np.all(isDouble):
+        Data = np.full(shape=(len(factor_names), nDT, nID), fill_value=np.nan, dtype=np.float)
+        Data[FactorCodes, DTCodes, IDCodes] = np.array(Values, dtype=np.float)
+        return pd.Panel(Data, items=factor_names, major_axis=pd.Index(DTs), minor_axis=IDs)
+    Data = np.full(shape=(len(factor_names), nDT, nID), fill_value=np.nan, dtype="O")
+    Data[FactorCodes, DTCodes, IDCodes] = Values
+    Data = {iFactorName: pd.DataFrame(Data[i], index=pd.Index(DTs), columns=IDs) for i, iFactorName in enumerate(factor_names)}
+    for i, iFactorName in enumerate(factor_names):
+        if isDouble[i]: Data[iFactorName] = Data[iFactorName].astype("float")
+    return pd.Panel(Data).loc[factor_names]
+
+# 将区间 [start_idx, end_idx) 展开, start_idx, end_idx: 每条记录覆盖的时点位置的起止, array
+# 返回 (记录序号, 时点位置), 一条记录覆盖的每个时点对应一个元素
+def expandInterval(start_idx, end_idx):
+    Len = np.clip(end_idx - start_idx, 0, None)
+    RowIdx = np.repeat(np.arange(Len.shape[0]), Len)
+    Offset = np.arange(RowIdx.shape[0]) - np.repeat(np.cumsum(Len) - Len, Len)
+    return (RowIdx, start_idx[RowIdx] + Offset)
+
+# 计算分析师一致预期数据, 对所有 ID 和日期一次性检索每个目标年度在回溯窗口内的最新记录
+# raw_data: DataFrame(columns=["日期", "ID", "报告期"]+factor_names), 按 ID, 日期排序, 日期和报告期为 "%Y%m%d" 格式的字符串
+# report_ann_data: DataFrame(columns=["ID", "公告日期", "报告期"]), 为 None 时计算 Fwd12M, 否则计算 FY{fy_num}, 没有年报公告数据的 ID 不计算
+# dates: 日期序列, "%Y%m%d" 格式的字符串; 返回: Panel(items=factor_names, major_axis=[日期], minor_axis=[ID])
+def calcAnalystConsensus(raw_data, report_ann_data, factor_names, dates, lookback, fy_num=None):
+    IDs = pd.unique(raw_data["ID"].values)
+    if report_ann_data is not None: IDs = IDs[pd.Index(report_ann_data["ID"].unique()).get_indexer(IDs)>=0]
+    DTs = [dt.datetime.strptime(iDate, "%Y%m%d") for iDate in dates]
+    Data = np.full(shape=(len(factor_names), len(dates), IDs.shape[0]), fill_value=np.nan)
+    IDCodes = pd.Index(IDs).get_indexer(raw_data["ID"].values)
+    Mask = (IDCodes>=0)
+    if (IDs.shape[0]==0) or (not np.any(Mask)): return pd.Panel(Data, items=factor_names, major_axis=DTs, minor_axis=IDs)
+    raw_data, IDCodes = raw_data[Mask], IDCodes[Mask]
+    RawDates = raw_data["日期"].values.astype(np.int64)
+    RawDays = pd.to_datetime(raw_data["日期"].values, format="%Y%m%d").values.astype("datetime64[D]").astype(np.int64)
+    RawYears = np.array([int(iReportDate[:4]) for iReportDate in raw_data["报告期"].values], dtype=np.int64)
+    MinYear, nYear = RawYears.min(), RawYears.max() - RawYears.min() + 1
+    # 记录按 (ID, 报告年度, 日期) 排序, 同一日期保持原有顺序
+    RecKeys = (IDCodes * nYear + (RawYears - MinYear)) * 10**8 + RawDates
+    Order = np.argsort(RecKeys, kind="mergesort")
+    RecKeys = RecKeys[Order]
+    Values = np.array(raw_data[factor_names].values, dtype=np.float)[Order]
+    RawDays = RawDays[Order]
+    QueryDates = np.array(dates, dtype=np.int64).reshape((-1, 1))
+    QueryDays = pd.to_datetime(dates, format="%Y%m%d").values.astype("datetime64[D]").astype(np.int64).reshape((-1, 1))
+    QueryYears = QueryDates // 10**4
+    QueryIDCodes = np.arange(IDs.shape[0]).reshape((1, -1))
+    # 检索目标年度 target_years 在回溯天数内的最新记录, 返回: (是否找到, 记录位置)
+    def _lookup(target_years):
+        GroupKeys = QueryIDCodes * nYear + (target_years - MinYear)
+        Pos = RecKeys.searchsorted(GroupKeys * 10**8 + QueryDates, side="right") - 1
+        Found = ((Pos>=0) & (target_years>=MinYear) & (target_years<MinYear+nYear))
+        Pos[~Found] = 0
+        Found &= (RecKeys[Pos] // 10**8==GroupKeys) & (QueryDays - RawDays[Pos]<=lookback)
+        return (Found, Pos)
+    if report_ann_data is None:# Fwd12M
+        Found1, Pos1 = _lookup(QueryYears)
+        Found2, Pos2 = _lookup(QueryYears + 1)
+        Weight1 = np.zeros(shape=(len(dates), 1))
+        for i, iDT in enumerate(DTs):
+            Weight1[i, 0] = (dt.datetime(iDT.year, 12, 31) - iDT).days
+            if (iDT.month==2) and (iDT.day==29): Weight1[i, 0] /= 366
+            else: Weight1[i, 0] /= (dt.datetime(iDT.year+1, iDT.month, iDT.day) - iDT).days
+        Found = (Found1 & Found2)
+        for k in range(len(factor_names)):
+            Data[k][Found] = (Weight1 * Values[Pos1, k] + (1 - Weight1) * Values[Pos2, k])[Found]
+    else:# FY
+        # 上一年度年报的公告日期, 缺失时以 99999999 表示
+        NoteDates = report_ann_data.drop_duplicates(subset=["ID", "报告期"], keep="first").set_index(["ID", "报告期"])["公告日期"]
+        UniqueYears = np.unique(QueryYears)
+        YearNoteDates = np.full(shape=(UniqueYears.shape[0], IDs.shape[0]), fill_value=99999999, dtype=np.int64)
+        for i, iYear in enumerate(UniqueYears):
+            iNoteDates = NoteDates.reindex(pd.MultiIndex.from_arrays([IDs, [str(iYear-1)+"1231"]*IDs.shape[0]])).values
+            iMask = pd.notnull(iNoteDates)
+            YearNoteDates[i, iMask] = iNoteDates[iMask].astype(np.int64)
+        YearNoteDates = YearNoteDates[UniqueYears.searchsorted(QueryYears[:, 0])]
+        TargetYears = np.where(YearNoteDates>QueryDates, QueryYears - 1, QueryYears) + fy_num
+        Found, Pos = _lookup(TargetYears)
+        for k in range(len(factor_names)):
+            Data[k][Found] = Values[Pos, k][Found]
+    return pd.Panel(Data, items=factor_names, major_axis=DTs, minor_axis=IDs)
+
+# 批量读取数据,将落在同一物理表且查询条件相同的请求合并为一条查询, 取因子的并集和日期范围的包络, 读取后再按请求拆分计算
+# requests: [(因子表对象, [因子名], [ID], [时点], {参数})], 返回: [Panel(item=[因子], major_axis=[时点], minor_axis=[ID])], 与 requests 一一对应
+# 因子表通过 _genRawDataKey(ids, dts, args) 声明可合并的查询, 返回 (查询键, 起始日期, 截止日期), 返回 None 表示不参与合并
+def readBatchData(requests):
+    Rslt, Groups = [None] * len(requests), {}
+    for i, (iFT, iFactorNames, iIDs, iDTs, iArgs) in enumerate(requests):
+        iKey = (iFT._genRawDataKey(iIDs, iDTs, args=iArgs) if hasattr(iFT, "_genRawDataKey") and (not iFT.ErgodicMode._isStarted) else None)
+        if iKey is None:
+            Rslt[i] = iFT.readData(factor_names=iFactorNames, ids=iIDs, dts=iDTs, args=iArgs)
+        elif iKey[0] not in Groups:
+            Groups[iKey[0]] = {"Requests":[i], "FactorNames":list(iFactorNames), "StartDate":iKey[1], "EndDate":iKey[2]}
+        else:
+            iGroup = Groups[iKey[0]]
+            iGroup["Requests"].append(i)
+            iGroup["FactorNames"] += [iFactorName for iFactorName in iFactorNames if iFactorName not in iGroup["FactorNames"]]
+            iGroup["StartDate"], iGroup["EndDate"] = min(iGroup["StartDate"], iKey[1]), max(iGroup["EndDate"], iKey[2])
+    for iKey, iGroup in Groups.items():
+        iFT, _, iIDs, _, iArgs = requests[iGroup["Requests"][0]]
+        iArgs = iArgs.copy()
+        iArgs["回溯天数"] = 0
+        iDTs = [dt.datetime.combine(iGroup["StartDate"], dt.time(0)), dt.datetime.combine(iGroup["EndDate"], dt.time(0))]
+        iRawData = iFT.__QS_prepareRawData__(factor_names=iGroup["FactorNames"], ids=iIDs, dts=iDTs, args=iArgs)
+        CommonCols = iRawData.columns.difference(iGroup["FactorNames"]).tolist()
+        for j in iGroup["Requests"]:
+            jFT, jFactorNames, jIDs, jDTs, jArgs = requests[j]
+            Rslt[j] = jFT.__QS_calcData__(raw_data=iRawData.loc[:, CommonCols+list(jFactorNames)], factor_names=jFactorNames, ids=jIDs, dts=jDTs, args=jArgs)
+    return Rslt
+
+# 记录/回放网络 API 的调用结果, 以调用签名(方法名, 位置参数, 关键字参数)的哈希为键, 每次调用的结果存为缓存目录下的一个文件
+# api: 被代理的 API 对象, 回放模式下可以为 None; mode: "记录" - 调用 API 并写入(覆盖)缓存, "回放" - 只从缓存读取, 缓存缺失时报错
+# passthrough: 不经过缓存直接调用 API 的方法名, 用于不访问网络的本地辅助函数
+class APICacheProxy(object):
+    def __init__(self, api, cache_dir, mode="记录", passthrough=()):
+        if mode not in ("记录", "回放"): raise __QS_Error__("不支持的缓存模式: '%s'" % (mode, ))
+        if not os.path.isdir(cache_dir):
+            if mode=="回放": raise __QS_Error__("缓存目录: '%s' 不存在!" % (cache_dir, ))
+            os.makedirs(cache_dir)
+        self._API = api
+        self._CacheDir = cache_dir
+        self._Mode = mode
+        self._Passthrough = frozenset(passthrough)
+    def _genKey(self, name, args, kwargs):
+        Signature = repr((name, args, sorted(kwargs.items())))
+        return hashlib.sha1(Signature.encode("utf-8")).hexdigest()
+    def _call(self, name, *args, **kwargs):
+        FilePath = self._CacheDir+os.sep+self._genKey(name, args, kwargs)+".pkl"
+        if self._Mode=="回放":
+            if os.path.isfile(FilePath):
+                with open(FilePath, mode="rb") as File:
+                    return pickle.load(File)
+            raise __QS_Error__("回放模式下缓存中不存在调用: %s(%s)" % (name, ", ".join([repr(iArg) for iArg in args]+["%s=%r" % (iKey, iVal) for iKey, iVal in kwargs.items()])))
+        Rslt = getattr(self._API, name)(*args, **kwargs)
+        TempFilePath = FilePath+".tmp"
+        with open(TempFilePath, mode="wb") as File:
+            pickle.dump(Rslt, File, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(TempFilePath, FilePath)
+        return Rslt
+    def __getattr__(self, name):
+        if name.startswith("_"): raise AttributeError(name)
+        if name in self._Passthrough:
+            if self._API is None: raise __QS_Error__("回放模式下无法调用: %s" % (name, ))
+            return getattr(self._API, name)
+        return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+
 def adjustDataDTID(data, look_back, factor_names, ids, dts, only_start_lookback=False, only_lookback_nontarget=False, only_lookback_dt=False, logger=None):
     if look_back==0:
         try:
@@ -117,12 +280,14 @@ def adjustDataDTID(data, look_back, factor_names, ids, dts, only_start_lookback=
                 NewLimits = np.minimum(NewLimits.values*24.0*3600, Limits).reshape((NewLimits.shape[0], 1)).repeat(AdjData.shape[2], axis=1)
                 Limits = pd.DataFrame(0, index=AdjData.major_axis, columns=AdjData.minor_axis)
                 Limits.loc[TargetDTs, :] = NewLimits
-        if np.isinf(look_back) and (not only_lookback_nontarget) and (not only_lookback_dt):
-            for i, iFactorName in enumerate(AdjData.items): AdjData.iloc[i].fillna(method="pad", inplace=True)
+        if isinstance(Limits, pd.DataFrame): Limits = Limits.values
+        Values = AdjData.values
+        FilledValues = fillNaByLookback3D(Values, AdjData.major_axis.values, Limits)
+        if Values.dtype==np.dtype("O"):# 混合类型, 保持每个因子原有的数据类型
+            FilledValues = {iFactorName: pd.DataFrame(FilledValues[i], index=AdjData.major_axis, columns=AdjData.minor_axis).astype(AdjData.iloc[i].values.dtype) for i, iFactorName in enumerate(AdjData.items)}
+            AdjData = pd.Panel(FilledValues).loc[AdjData.items]
         else:
-            AdjData = dict(AdjData)
-            for iFactorName in AdjData: AdjData[iFactorName] = fillNaByLookback(AdjData[iFactorName], lookback=Limits)
-            AdjData = pd.Panel(AdjData).loc[factor_names]
+            AdjData = pd.Panel(FilledValues, items=AdjData.items, major_axis=AdjData.major_axis, minor_axis=AdjData.minor_axis)
     if only_start_lookback:
         AllAdjData.loc[:, dts[0], :] = AdjData.loc[:, dts[0], :]
         return AllAdjData.loc[:, dts]
@@ -898,17 +1063,9 @@ class SQL_NarrowTable(SQL_Table):
         if raw_data.shape[0]==0: return pd.Panel(items=factor_names, major_axis=dts, minor_axis=ids)
         FactorValueField = args.get("因子值字段", self.FactorValueField)
         FactorNameField = args.get("因子名字段", self.FactorNameField)
-        raw_data = raw_data.set_index(["QS_DT", "ID", FactorNameField]).iloc[:, 0]
-        raw_data = raw_data.unstack()
-        isDouble = (self.__QS_identifyDataType__(self._FactorInfo.loc[FactorValueField, "DataType"])=="double")
-        Data = {}
-        for iFactorName in factor_names:
-            if iFactorName in raw_data:
-                iRawData = raw_data[iFactorName].unstack()
-                if isDouble: iRawData = iRawData.astype("float")
-                Data[iFactorName] = iRawData
-        if not Data: return pd.Panel(items=factor_names, major_axis=dts, minor_axis=ids)
-        Data = pd.Panel(Data).loc[factor_names]
+        DataType = self.__QS_identifyDataType__(self._FactorInfo.loc[FactorValueField, "DataType"])
+        Data = pivotNarrowData(raw_data, factor_names, FactorNameField, FactorValueField, data_type=DataType)
+        if Data is None: return pd.Panel(items=factor_names, major_axis=dts, minor_axis=ids)
         LookBack = args.get("回溯天数", self.LookBack)
         return adjustDataDTID(Data, LookBack, factor_names, ids, dts, args.get("只起始日回溯", self.OnlyStartLookBack), logger=self._QS_Logger)
 
@@ -1057,11 +1214,23 @@ class SQL_MappingTable(SQL_Table):
         RawData = pd.DataFrame(np.array(RawData, dtype="O"), columns=["ID", "QS_起始日", "QS_结束日"]+factor_names)
         RawData = self._adjustRawDataByRelatedField(RawData, factor_names)
         return RawData
+    # 计算每条记录覆盖的 (记录序号, 时点位置, ID 位置)
+    def _expandMappingData(self, raw_data, ids, dts):
+        DTs = np.array(dts, dtype="datetime64[ns]")
+        StartDTs = pd.to_datetime(raw_data["QS_起始日"]).values
+        EndDTs = pd.to_datetime(raw_data["QS_结束日"]).values
+        StartIdx = DTs.searchsorted(StartDTs, side="left")
+        EndIdx = DTs.searchsorted(EndDTs - np.timedelta64(int(not self._EndDateIncluded), "D"), side="right")
+        EndIdx[EndDTs<StartDTs] = DTs.shape[0]
+        IDIdx = pd.Index(ids).get_indexer(raw_data["ID"].values)
+        EndIdx[IDIdx<0] = StartIdx[IDIdx<0]
+        RowIdx, DTIdx = expandInterval(StartIdx, EndIdx)
+        return (RowIdx, DTIdx, IDIdx[RowIdx])
     def _calcMultiMappingData(self, raw_data, factor_names, ids, dts, args={}):
         Data, nDT, nFactor = {}, len(dts), len(factor_names)
-        raw_data.set_index(["ID"], inplace=True)
         raw_data["QS_结束日"] = raw_data["QS_结束日"].where(pd.notnull(raw_data["QS_结束日"]), dts[-1]+dt.timedelta(1))
         if args.get("只填起始日", self.OnlyStartFilled):
+            raw_data.set_index(["ID"], inplace=True)
             if self._EndDateIncluded:
                 raw_data["QS_结束日"] = (raw_data["QS_结束日"] + dt.timedelta(1)).astype("O")
             raw_data["QS_起始日"] = raw_data["QS_起始日"].where(raw_data["QS_起始日"]>=dts[0], dts[0])
@@ -1097,33 +1266,33 @@ class SQL_MappingTable(SQL_Table):
                 Data[iID] = iData
             return pd.Panel(Data).swapaxes(0, 2).loc[:, :, ids]
         else:
-            DeltaDT = dt.timedelta(int(not self._EndDateIncluded))
-            for iID in raw_data.index.unique():
-                iRawData = raw_data.loc[[iID]].set_index(["QS_起始日", "QS_结束日"])
-                iData = pd.DataFrame([([],)*nFactor]*nDT, index=dts, columns=factor_names, dtype="O")
-                for jStartDate, jEndDate in iRawData.index.drop_duplicates():
-                    ijRawData = iRawData.loc[jStartDate]
-                    if pd.notnull(jEndDate):
-                        ijRawData = ijRawData.loc[pd.notnull(ijRawData.index), factor_names]
-                        ijRawData = ijRawData.loc[[jEndDate]].values.T.tolist()
-                    else:
-                        ijRawData = ijRawData.loc[pd.isnull(ijRawData.index), factor_names].values.T.tolist()
-                    if jEndDate<jStartDate:
-                        ijOldData = iData.loc[jStartDate:]
-                        iData.loc[jStartDate:] += pd.DataFrame([ijRawData] * ijOldData.shape[0], index=ijOldData.index, columns=ijOldData.columns, dtype="O")
-                    else:
-                        jEndDate -= DeltaDT
-                        ijOldData = iData.loc[jStartDate:jEndDate]
-                        iData.loc[jStartDate:jEndDate] += pd.DataFrame([ijRawData] * ijOldData.shape[0], index=ijOldData.index, columns=ijOldData.columns, dtype="O")
-                Data[iID] = iData
-            return pd.Panel(Data).swapaxes(0, 2).loc[:, :, ids]
+            # 同一 ID 下按 (起始日, 结束日) 首次出现的顺序拼接因子值
+            PairCodes = pd.MultiIndex.from_arrays([raw_data["ID"].values, raw_data["QS_起始日"].values, raw_data["QS_结束日"].values]).factorize()[0]
+            raw_data = raw_data.iloc[np.argsort(PairCodes, kind="mergesort")]
+            RowIdx, DTIdx, IDIdx = self._expandMappingData(raw_data, ids, dts)
+            nID = len(ids)
+            CellIdx = DTIdx * nID + IDIdx
+            Order = np.argsort(CellIdx, kind="mergesort")
+            CellIdx, RowIdx = CellIdx[Order], RowIdx[Order]
+            Cells, StartInd = np.unique(CellIdx, return_index=True)
+            EndInd = np.r_[StartInd[1:], CellIdx.shape[0]]
+            Values = raw_data.loc[:, factor_names].values[RowIdx]
+            IDIdx = pd.Index(ids).get_indexer(pd.unique(raw_data["ID"].values))
+            IDIdx = IDIdx[IDIdx>=0]
+            Data = np.full(shape=(nFactor, nDT, nID), fill_value=np.nan, dtype="O")
+            # 有数据的 ID 初始化为空列表, 每个单元格是独立的列表对象
+            Data[:, :, IDIdx] = np.frompyfunc(lambda x: [], 1, 1)(np.empty(shape=(nFactor, nDT, IDIdx.shape[0]), dtype="O"))
+            for k in range(nFactor):
+                kData = Data[k].reshape((nDT*nID, ))
+                for i, iCell in enumerate(Cells): kData[iCell] = Values[StartInd[i]:EndInd[i], k].tolist()
+            return pd.Panel(Data, items=factor_names, major_axis=dts, minor_axis=ids)
     def __QS_calcData__(self, raw_data, factor_names, ids, dts, args={}):
         if raw_data.shape[0]==0: return pd.Panel(items=factor_names, major_axis=dts, minor_axis=ids)
         if args.get("多重映射", self.MultiMapping): return self._calcMultiMappingData(raw_data, factor_names, ids, dts, args=args)
-        raw_data.set_index(["ID"], inplace=True)
         Data, nFactor = {}, len(factor_names)
         raw_data["QS_结束日"] = raw_data["QS_结束日"].where(pd.notnull(raw_data["QS_结束日"]), dts[-1]+dt.timedelta(1))
         if args.get("只填起始日", self.OnlyStartFilled):
+            raw_data.set_index(["ID"], inplace=True)
             if self._EndDateIncluded:
                 raw_data["QS_结束日"] = (raw_data["QS_结束日"] + dt.timedelta(1)).astype("O")
             raw_data["QS_起始日"] = raw_data["QS_起始日"].where(raw_data["QS_起始日"]>=dts[0], dts[0])
@@ -1154,17 +1323,11 @@ class SQL_MappingTable(SQL_Table):
                 Data[iID] = iData
             return pd.Panel(Data).swapaxes(0, 2).loc[:, :, ids]
         else:
-            DeltaDT = dt.timedelta(int(not self._EndDateIncluded))
-            for iID in raw_data.index.unique():
-                iRawData = raw_data.loc[[iID]]
-                iData = pd.DataFrame(index=dts, columns=factor_names)
-                for j in range(iRawData.shape[0]):
-                    ijRawData = iRawData.iloc[j]
-                    jStartDate, jEndDate = ijRawData["QS_起始日"], ijRawData["QS_结束日"]
-                    if jEndDate<jStartDate:
-                        iData.loc[jStartDate:] = np.repeat(ijRawData[factor_names].values.reshape((1, nFactor)), iData.loc[jStartDate:].shape[0], axis=0)
-                    else:
-                        jEndDate -= DeltaDT
-                        iData.loc[jStartDate:jEndDate] = np.repeat(ijRawData[factor_names].values.reshape((1, nFactor)), iData.loc[jStartDate:jEndDate].shape[0], axis=0)
-                Data[iID] = iData
-            return pd.Panel(Data).swapaxes(0, 2).loc[:, :, ids]
+            # 同一单元格被多条记录覆盖时, 后面的记录覆盖前面的记录
+            RowIdx, DTIdx, IDIdx = self._expandMappingData(raw_data, ids, dts)
+            LastRowIdx = np.full(shape=(len(dts), len(ids)), fill_value=-1, dtype=np.int64)
+            np.maximum.at(LastRowIdx, (DTIdx, IDIdx), RowIdx)
+            Mask = (LastRowIdx>=0)
+            Data = np.full(shape=(nFactor, len(dts), len(ids)), fill_value=np.nan, dtype="O")
+            Data[:, Mask] = raw_data.loc[:, factor_names].values[LastRowIdx[Mask]].T
+            return pd.Panel(Data, items=factor_names, major_axis=dts, minor_axis=ids)
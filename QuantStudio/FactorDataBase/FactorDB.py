@@ -24,6 +24,13 @@ from QuantStudio.Tools.AuxiliaryFun import genAvailableName, startMultiProcess,
 from QuantStudio.Tools.FileFun import listDirDir, getShelveFileSuffix
 from QuantStudio.Tools.DataPreprocessingFun import fillNaByLookback
 
+# 数据读取的性能分析器, 回测模型开启性能分析时设置, 记录非遍历模式下的因子表读取(read)和所有的 ID 过滤(getFilteredID)
+# 分析器需要实现 callRead(因子表, 阶段, fun, *args, **kwargs)
+_ReadProfiler = None
+def setReadProfiler(profiler):
+    global _ReadProfiler
+    _ReadProfiler = profiler
+    return 0
 
 # 因子库, 只读, 接口类
 # 数据库由若干张因子表组成
@@ -135,9 +142,12 @@ class _ErgodicMode(__QS_Object__):
         super().__init__(sys_args=sys_args, **kwargs)
         self._isStarted = False
         self._CurDT = None
+        self._ReadBroker = None# 回测模型设置的单时点读取代理, 合并同一时点内的相同读取请求
+        self._AlignIndex = None# 回测模型预先计算的对齐映射, 测试时点序列中的每个时点在 _DateTimes 中对应的最近(不晚于该时点)的位置, array(int)
     def __getstate__(self):
         state = self.__dict__.copy()
         if "_CacheDataProcess" in state: state["_CacheDataProcess"] = None
+        state["_ReadBroker"] = None
         return state
 # 基于 mmap 的缓冲数据, 如果开启遍历模式, 那么限制缓冲的因子个数, ID 个数, 时间点长度, 缓冲区里是因子的部分数据
 def _prepareMMAPFactorCacheData(ft, mmap_cache):
@@ -456,6 +466,11 @@ class FactorTable(__QS_Object__):
         return eval(CompiledIDFilterStr)
     # 获取过滤后的 ID
     def getFilteredID(self, idt, ids=None, id_filter_str=None, args={}):
+        if self.ErgodicMode._isStarted and (self.ErgodicMode._ReadBroker is not None): Fun = (lambda **kwargs: self.ErgodicMode._ReadBroker.getFilteredID(self, **kwargs))
+        else: Fun = self._getFilteredID
+        if _ReadProfiler is None: return Fun(idt=idt, ids=ids, id_filter_str=id_filter_str, args=args)
+        return _ReadProfiler.callRead(self, "getFilteredID", Fun, idt=idt, ids=ids, id_filter_str=id_filter_str, args=args)
+    def _getFilteredID(self, idt, ids=None, id_filter_str=None, args={}):
         if not id_filter_str: return self.getID(idt=idt, args=args)
         if ids is None: ids = self.getID(idt=idt, args=args)
         CompiledIDFilterStr, IDFilterFactors = testIDFilterStr(id_filter_str, self.FactorNames)
@@ -474,12 +489,35 @@ class FactorTable(__QS_Object__):
         return None
     # 读取数据, 返回: Panel(item=[因子], major_axis=[时间点], minor_axis=[ID])
     def readData(self, factor_names, ids, dts, args={}):
-        if self.ErgodicMode._isStarted: return self._readData_ErgodicMode(factor_names=factor_names, ids=ids, dts=dts, args=args)
-        return self.__QS_calcData__(raw_data=self.__QS_prepareRawData__(factor_names=factor_names, ids=ids, dts=dts, args=args), factor_names=factor_names, ids=ids, dts=dts, args=args)
+        if self.ErgodicMode._isStarted:
+            if self.ErgodicMode._ReadBroker is not None: return self.ErgodicMode._ReadBroker.readData(self, factor_names=factor_names, ids=ids, dts=dts, args=args)
+            return self._readData_ErgodicMode(factor_names=factor_names, ids=ids, dts=dts, args=args)
+        Fun = (lambda: self.__QS_calcData__(raw_data=self.__QS_prepareRawData__(factor_names=factor_names, ids=ids, dts=dts, args=args), factor_names=factor_names, ids=ids, dts=dts, args=args))
+        if _ReadProfiler is None: return Fun()
+        return _ReadProfiler.callRead(self, "read", Fun)
     # ------------------------------------遍历模式------------------------------------
+    # 读取的时点在缓冲数据中的行位置, 每个时点对应因子表中不晚于它的最新时点, 读取当前时点时直接使用 move 中由对齐映射得到的位置
+    # 返回: array(int), 有时点超出缓冲区时返回 None
+    def _getCacheRows(self, dts):
+        if (not self.ErgodicMode._CacheDTs) or (len(dts)==0): return None
+        if (len(dts)==1) and (dts[0]==self.ErgodicMode._CurDT): Inds = np.array([self.ErgodicMode._CurInd])
+        else: Inds = self.ErgodicMode._DateTimes.searchsorted(np.array(dts, dtype="O"), side="right") - 1
+        Rows = Inds - self.ErgodicMode._DateTimes.searchsorted(self.ErgodicMode._CacheDTs[0])
+        if (Rows.min()<0) or (Rows.max()>=len(self.ErgodicMode._CacheDTs)): return None
+        return Rows
+    # 按行位置从缓冲数据中取出 DataFrame(index=dts, columns=cols), 缓冲数据中没有的列为 nan
+    def _takeCacheData(self, cache_data, rows, dts, cols):
+        CacheDTs = self.ErgodicMode._CacheDTs
+        if (cache_data.shape[0]!=len(CacheDTs)) or (cache_data.index[0]!=CacheDTs[0]): cache_data = cache_data.reindex(index=CacheDTs)# 缓冲数据与缓冲时点不一致时先按时点对齐
+        ColPos = cache_data.columns.get_indexer(cols)
+        if np.all(ColPos>=0): Data = cache_data.iloc[rows, ColPos]
+        else: Data = cache_data.iloc[rows].reindex(columns=cols)
+        Data.index = dts
+        return Data
     def _readData_FactorCacheMode(self, factor_names, ids, dts, args={}):
         self.ErgodicMode._FactorReadNum[factor_names] += 1
-        if (self.ErgodicMode.MaxFactorCacheNum<=0) or (not self.ErgodicMode._CacheDTs) or (dts[0]<self.ErgodicMode._CacheDTs[0]) or (dts[-1]>self.ErgodicMode._CacheDTs[-1]):
+        Rows = self._getCacheRows(dts)
+        if (self.ErgodicMode.MaxFactorCacheNum<=0) or (Rows is None):
             #print("超出缓存区读取: "+str(factor_names))# debug
             return self.__QS_calcData__(raw_data=self.__QS_prepareRawData__(factor_names=factor_names, ids=ids, dts=dts, args=args), factor_names=factor_names, ids=ids, dts=dts, args=args)
         Data = {}
@@ -511,14 +549,14 @@ class FactorTable(__QS_Object__):
             Data.update(iData)
             self.ErgodicMode._CacheData.update(iData)
         self.ErgodicMode._Queue2SubProcess.put((None, (CacheFactorNames, PopFactorNames)))
-        Data = pd.Panel(Data)
-        if Data.shape[0]>0: Data = Data.loc[:, dts, ids]
+        Data = pd.Panel({iFactorName: self._takeCacheData(iData, Rows, dts, ids) for iFactorName, iData in Data.items()}, major_axis=dts, minor_axis=ids)
         if not DataFactorNames: return Data.loc[factor_names]
         #print("超出缓存区因子个数读取: "+str(DataFactorNames))# debug
         return self.__QS_calcData__(raw_data=self.__QS_prepareRawData__(factor_names=DataFactorNames, ids=ids, dts=dts, args=args), factor_names=DataFactorNames, ids=ids, dts=dts, args=args).join(Data).loc[factor_names]
     def _readIDData(self, iid, factor_names, dts, args={}):
         self.ErgodicMode._IDReadNum[iid] = self.ErgodicMode._IDReadNum.get(iid, 0) + 1
-        if (self.ErgodicMode.MaxIDCacheNum<=0) or (not self.ErgodicMode._CacheDTs) or (dts[0] < self.ErgodicMode._CacheDTs[0]) or (dts[-1] >self.ErgodicMode._CacheDTs[-1]):
+        Rows = self._getCacheRows(dts)
+        if (self.ErgodicMode.MaxIDCacheNum<=0) or (Rows is None):
             return self.__QS_calcData__(raw_data=self.__QS_prepareRawData__(factor_names=factor_names, ids=[iid], dts=dts, args=args), factor_names=factor_names, ids=[iid], dts=dts, args=args).iloc[:, :, 0]
         IDData = self.ErgodicMode._CacheData.get(iid)
         if IDData is None:# 尚未进入缓存
@@ -538,7 +576,7 @@ class FactorTable(__QS_Object__):
                     self.ErgodicMode._Queue2SubProcess.put((None, (iid, PopID)))
                 else:# 当前读取的 ID 的读取次数没有超过缓存 ID 读取次数的最小值, 放弃缓存该 ID 数据
                     return self.__QS_calcData__(raw_data=self.__QS_prepareRawData__(factor_names=factor_names, ids=[iid], dts=dts, args=args), factor_names=factor_names, ids=[iid], dts=dts, args=args).iloc[:, :, 0]
-        return IDData.loc[dts, factor_names]
+        return self._takeCacheData(IDData, Rows, dts, factor_names)
     def _readData_ErgodicMode(self, factor_names, ids, dts, args={}):
         if self.ErgodicMode.CacheMode=="因子": return self._readData_FactorCacheMode(factor_names=factor_names, ids=ids, dts=dts, args=args)
         return pd.Panel({iID: self._readIDData(iID, factor_names=factor_names, dts=dts, args=args) for iID in ids}).swapaxes(0, 2)
@@ -550,6 +588,7 @@ class FactorTable(__QS_Object__):
         self.ErgodicMode._IDs = (self.getID() if not self.ErgodicMode.ErgodicIDs else list(self.ErgodicMode.ErgodicIDs))
         if not self.ErgodicMode._IDs: raise __QS_Error__("因子表: '%s' 的默认 ID 序列为空, 请设置参数 '遍历模式-遍历ID' !" % self.Name)
         self.ErgodicMode._CurInd = -1# 当前时点在 dts 中的位置, 以此作为缓冲数据的依据
+        self.ErgodicMode._AlignIndex = None
         self.ErgodicMode._DTNum = self.ErgodicMode._DateTimes.shape[0]# 时点数
         self.ErgodicMode._CacheDTs = []# 缓冲的时点序列
         self.ErgodicMode._CacheData = {}# 当前缓冲区
@@ -572,12 +611,17 @@ class FactorTable(__QS_Object__):
             if os.name=="nt": self._MMAPCacheData = mmap.mmap(-1, int(self.ErgodicMode.CacheSize*2**20), tagname=self.ErgodicMode._TagName)# 当前共享内存缓冲区
         self.ErgodicMode._isStarted = True
         return 0
-    # 时间点向前移动, idt: 时间点, datetime.dateime
-    def move(self, idt, **kwargs):
+    # 设置对齐映射, dts: 之后调用 move 时 dt_index 参数所指的时点序列, 需要在 start 之后调用
+    def alignDateTime(self, dts):
+        self.ErgodicMode._AlignIndex = self.ErgodicMode._DateTimes.searchsorted(np.array(dts, dtype="O"), side="right") - 1
+        return 0
+    # 时间点向前移动, idt: 时间点, datetime.dateime, dt_index: idt 在 alignDateTime 设置的时点序列中的位置, 给定时直接查对齐映射
+    def move(self, idt, dt_index=None, **kwargs):
         if idt==self.ErgodicMode._CurDT: return 0
         self.ErgodicMode._CurDT = idt
         PreInd = self.ErgodicMode._CurInd
-        self.ErgodicMode._CurInd = PreInd + np.sum(self.ErgodicMode._DateTimes[PreInd+1:]<=idt)
+        if (dt_index is not None) and (self.ErgodicMode._AlignIndex is not None): self.ErgodicMode._CurInd = int(self.ErgodicMode._AlignIndex[dt_index])
+        else: self.ErgodicMode._CurInd = PreInd + np.sum(self.ErgodicMode._DateTimes[PreInd+1:]<=idt)
         if (self.ErgodicMode.CacheSize>0) and (self.ErgodicMode._CurInd>-1) and ((not self.ErgodicMode._CacheDTs) or (self.ErgodicMode._DateTimes[self.ErgodicMode._CurInd]>self.ErgodicMode._CacheDTs[-1])):# 需要读入缓冲区的数据
             self.ErgodicMode._Queue2SubProcess.put((None, None))
             DataLen = self.ErgodicMode._Queue2MainProcess.get()
@@ -606,6 +650,7 @@ class FactorTable(__QS_Object__):
         self.ErgodicMode._Queue2SubProcess = self.ErgodicMode._Queue2MainProcess = self.ErgodicMode._CacheDataProcess = None
         self.ErgodicMode._isStarted = False
         self.ErgodicMode._CurDT = None
+        self.ErgodicMode._AlignIndex = None
         self._MMAPCacheData = None
         return 0
     def __QS_onBackTestEndEvent__(self, event):
@@ -877,7 +922,7 @@ class CustomFT(FactorTable):
         temp = self.readData(factor_names=IDFilterFactors, ids=ids, dts=[idt], args=args).loc[:, idt, :]
         self._IDFilterStr = OldIDFilterStr
         return eval(CompiledFilterStr)
-    def getFilteredID(self, idt, ids=None, id_filter_str=None, args={}):
+    def _getFilteredID(self, idt, ids=None, id_filter_str=None, args={}):
         OldIDFilterStr = self.setIDFilter(id_filter_str)
         if ids is None: ids = self.getID(idt=idt, args=args)
         if self._IDFilterStr is None:
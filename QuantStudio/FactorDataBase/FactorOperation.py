@@ -10,6 +10,7 @@ from traits.api import Function, Dict, Enum, List, Int, Instance
 
 from QuantStudio import __QS_Error__
 from QuantStudio.FactorDataBase.FactorDB import Factor
+from QuantStudio.FactorDataBase.FDBFun import readBatchData
 from QuantStudio.Tools.AuxiliaryFun import partitionList, partitionListMovingSampling
 
 def _DefaultOperator(f, idt, iid, x, args):
@@ -38,6 +39,19 @@ class DerivativeFactor(Factor):
     def end(self):
         for iDescriptor in self._Descriptors: iDescriptor.end()
         return 0
+    # 读取描述子数据, requests: [(描述子, [ID], [时点])], 返回: [DataFrame(index=[时点], columns=[ID])]
+    # 直接取自因子表的描述子通过 readBatchData 读取, 落在同一物理表的描述子合并为一条查询
+    def _readDescriptorData(self, requests, **kwargs):
+        Rslt, BatchInds, BatchRequests = [None]*len(requests), [], []
+        for i, (iDescriptor, iIDs, iDTs) in enumerate(requests):
+            if (type(iDescriptor).readData is Factor.readData) and (iDescriptor._FactorTable is not None) and (not iDescriptor._isStarted):
+                BatchInds.append(i)
+                BatchRequests.append((iDescriptor._FactorTable, [iDescriptor._NameInFT], iIDs, iDTs, iDescriptor.Args))
+            else:
+                Rslt[i] = iDescriptor.readData(ids=iIDs, dts=iDTs, **kwargs)
+        if BatchRequests:
+            for i, iData in zip(BatchInds, readBatchData(BatchRequests)): Rslt[i] = iData.iloc[0]
+        return Rslt
 
 
 # 单点运算
@@ -55,7 +69,7 @@ class PointOperation(DerivativeFactor):
     DTMode = Enum("单时点", "多时点", arg_type="SingleOption", label="运算时点", order=3)
     IDMode = Enum("单ID", "多ID", arg_type="SingleOption", label="运算ID", order=4)
     def readData(self, ids, dts, **kwargs):
-        StdData = self._calcData(ids=ids, dts=dts, descriptor_data=[iDescriptor.readData(ids=ids, dts=dts, **kwargs).values for iDescriptor in self._Descriptors])
+        StdData = self._calcData(ids=ids, dts=dts, descriptor_data=[iData.values for iData in self._readDescriptorData([(iDescriptor, ids, dts) for iDescriptor in self._Descriptors], **kwargs)])
         return pd.DataFrame(StdData, index=dts, columns=ids)
     def _QS_initOperation(self, start_dt, dt_dict, prepare_ids, id_dict):
         super()._QS_initOperation(start_dt, dt_dict, prepare_ids, id_dict)
@@ -144,10 +158,13 @@ class TimeOperation(DerivativeFactor):
         EndInd = (DTRuler.index(dts[-1]) if dts[-1] in DTRuler else len(DTRuler)-1)
         if StartInd>EndInd: return pd.DataFrame(index=dts, columns=ids)
         nID = len(ids)
-        DescriptorData = []
+        DescriptorData, Requests = [], []
         for i, iDescriptor in enumerate(self._Descriptors):
             iDTs = DTRuler[max(StartInd-self.LookBack[i], 0):EndInd+1]
-            if iDTs: iDescriptorData = iDescriptor.readData(ids=ids, dts=iDTs, **kwargs).values
+            if iDTs: Requests.append((iDescriptor, ids, iDTs))
+        ReadData = iter(self._readDescriptorData(Requests, **kwargs))
+        for i, iDescriptor in enumerate(self._Descriptors):
+            if max(StartInd-self.LookBack[i], 0)<=EndInd: iDescriptorData = next(ReadData).values
             else: iDescriptorData = np.full((0, nID), np.nan)
             if StartInd<self.LookBack[i]:
                 iLookBackData = np.full((self.LookBack[i]-StartInd, nID), np.nan)
@@ -260,11 +277,12 @@ class SectionOperation(DerivativeFactor):
         self.DescriptorSection = [None]*len(self._Descriptors)
     def readData(self, ids, dts, **kwargs):
         SectionIDs = kwargs.pop("section_ids", ids)
-        DescriptorData = []
+        Requests = []
         for i, iDescriptor in enumerate(self._Descriptors):
             iSectionIDs = self.DescriptorSection[i]
             if iSectionIDs is None: iSectionIDs = SectionIDs
-            DescriptorData.append(iDescriptor.readData(ids=iSectionIDs, dts=dts, **kwargs).values)
+            Requests.append((iDescriptor, iSectionIDs, dts))
+        DescriptorData = [iData.values for iData in self._readDescriptorData(Requests, **kwargs)]
         StdData = self._calcData(ids=SectionIDs, dts=dts, descriptor_data=DescriptorData)
         return pd.DataFrame(StdData, index=dts, columns=SectionIDs).loc[:, ids]
     def _QS_initOperation(self, start_dt, dt_dict, prepare_ids, id_dict):
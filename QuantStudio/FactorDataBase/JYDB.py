@@ -3,8 +3,12 @@
 import re
 import os
 import json
+import pickle
 import shelve
+import sqlite3
+import decimal
 import datetime as dt
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
@@ -16,9 +20,10 @@ from QuantStudio.Tools.FileFun import getShelveFileSuffix
 from QuantStudio.Tools.QSObjects import QSSQLObject
 from QuantStudio import __QS_Error__, __QS_LibPath__, __QS_MainPath__, __QS_ConfigPath__
 from QuantStudio.FactorDataBase.FactorDB import FactorDB, FactorTable
-from QuantStudio.FactorDataBase.FDBFun import adjustDateTime, adjustDataDTID
+from QuantStudio.FactorDataBase.FDBFun import adjustDateTime, adjustDataDTID, expandInterval, calcAnalystConsensus
 
 # 将信息源文件中的表和字段信息导入信息文件
+# 信息文件是 pickle 格式的二进制快照, 避免每次启动都重新解析信息源文件
 def _importInfo(info_file, info_resource, logger, out_info=False):
     Suffix = info_resource.split(".")[-1]
     if Suffix in ("xlsx", "xls"):
@@ -39,15 +44,17 @@ def _importInfo(info_file, info_resource, logger, out_info=False):
         raise __QS_Error__(Msg)
     if not out_info:
         try:
-            from QuantStudio.Tools.DataTypeFun import writeNestedDict2HDF5
-            writeNestedDict2HDF5(TableInfo, info_file, "/TableInfo")
-            writeNestedDict2HDF5(FactorInfo, info_file, "/FactorInfo")
-            writeNestedDict2HDF5(ExchangeInfo, info_file, "/ExchangeInfo")
-            writeNestedDict2HDF5(SecurityInfo, info_file, "/SecurityInfo")
+            with open(info_file, "wb") as File:
+                pickle.dump((TableInfo, FactorInfo, ExchangeInfo, SecurityInfo), File, protocol=pickle.HIGHEST_PROTOCOL)
         except Exception as e:
             logger.warning("更新数据库信息文件 '%s' 失败 : %s" % (info_file, str(e)))
     return (TableInfo, FactorInfo, ExchangeInfo, SecurityInfo)
 
+# 读取信息文件
+def _readInfo(info_file):
+    with open(info_file, "rb") as File:
+        return pickle.load(File)
+
 # 更新信息文件
 def _updateInfo(info_file, info_resource, logger, out_info=False):
     if out_info: return _importInfo(info_file, info_resource, logger, out_info=out_info)
@@ -57,13 +64,51 @@ def _updateInfo(info_file, info_resource, logger, out_info=False):
         logger.warning("数据库信息文件: '%s' 有更新, 尝试从中导入新信息." % info_resource)
     else:
         try:
-            from QuantStudio.Tools.DataTypeFun import readNestedDictFromHDF5
-            return (readNestedDictFromHDF5(info_file, ref="/TableInfo"), readNestedDictFromHDF5(info_file, ref="/FactorInfo"), readNestedDictFromHDF5(info_file, ref="/ExchangeInfo"), readNestedDictFromHDF5(info_file, ref="/SecurityInfo"))
+            return _readInfo(info_file)
         except:
             logger.warning("数据库信息文件: '%s' 损坏, 尝试从 '%s' 中导入信息." % (info_file, info_resource))
     if not os.path.isfile(info_resource): raise __QS_Error__("缺失数据库信息源文件: %s" % info_resource)
     return _importInfo(info_file, info_resource, logger, out_info=out_info)
 
+# 本地 sqlite3 镜像库的辅助函数, 镜像库沿用 MySQL 的 SQL 方言, 通过自定义函数补齐 sqlite3 缺少或者行为不同的 CONCAT, DATE_FORMAT, STR_TO_DATE 和 TIME, LEFT 在 sqlite3 中是关键字, 改用 SUBSTR
+# 时间字段在镜像库中以文本存储, 零点时刻只存日期部分, 以保证和 'YYYY-MM-DD' 格式的日期字符串比较时与源库一致
+def _encodeSQLiteValue(value):
+    if isinstance(value, dt.datetime):
+        if value.time()==dt.time(0): return value.strftime("%Y-%m-%d")
+        else: return value.strftime("%Y-%m-%d %H:%M:%S")
+    elif isinstance(value, dt.date): return value.strftime("%Y-%m-%d")
+    elif isinstance(value, decimal.Decimal): return float(value)
+    return value
+def _decodeSQLiteDateTime(value):
+    return _parseSQLiteDateTime(value.decode("utf-8"))
+# 由表达式计算得到的时间列没有 JYDATETIME 类型声明, 以文本返回, 需要转换为 datetime
+def _parseSQLiteDateTime(value):
+    if not isinstance(value, str): return value
+    if len(value)<=10: return dt.datetime.strptime(value, "%Y-%m-%d")
+    else: return dt.datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S")
+def _sqliteConcat(*args):
+    if any(iArg is None for iArg in args): return None
+    return "".join(str(iArg) for iArg in args)
+def _sqliteDateFormat(value, fmt):
+    if value is None: return None
+    return _parseSQLiteDateTime(value).strftime(fmt.replace("%i", "%M").replace("%s", "%S"))
+def _sqliteStrToDate(value, fmt):
+    if value is None: return None
+    try:
+        return _encodeSQLiteValue(dt.datetime.strptime(value, fmt.replace("%i", "%M").replace("%s", "%S")))
+    except ValueError:
+        return None
+# MySQL 的 TIME(数值) 按 HHMMSS 解释数值, TIME(时间) 返回时间部分, sqlite3 自带的 TIME(0) 会返回 '12:00:00'
+def _sqliteTime(value):
+    if value is None: return None
+    if isinstance(value, (int, float)):
+        value = int(value)
+        return "%02d:%02d:%02d" % (value // 10000, value // 100 % 100, value % 100)
+    return _parseSQLiteDateTime(value).strftime("%H:%M:%S")
+# 生成 SQL 中的日期字面量, 镜像库中日期以 'YYYY-MM-DD' 文本存储, 按文本比较时需要使用相同的格式
+def _genDateLiteral(fdb, date):
+    return date.strftime("%Y-%m-%d" if fdb._Connector=="sqlite3" else "%Y%m%d")
+
 # 给 ID 去后缀
 def deSuffixID(ids, sep='.'):
     return [(".".join(iID.split(".")[:-1]) if iID.find(".")!=-1 else iID) for iID in ids]
@@ -86,7 +131,7 @@ class _DBTable(FactorTable):
     PreFilterID = Bool(True, arg_type="Bool", label="预筛选ID", order=201)
     def __init__(self, name, fdb, sys_args={}, **kwargs):
         self._DBTableName = fdb.TablePrefix + fdb._TableInfo.loc[name, "DBTableName"]
-        self._FactorInfo = fdb._FactorInfo.loc[name]
+        self._FactorInfo = fdb._getTableFactorInfo(name)
         self._IDField = self._FactorInfo["DBFieldName"][self._FactorInfo["FieldType"]=="ID"]# ID 字段
         if self._IDField.shape[0]==0:
             self._IDField = None
@@ -130,7 +175,10 @@ class _DBTable(FactorTable):
     def _getIDField(self, args={}):
         if (self._MainTableName is None) or (self._MainTableName==self._DBTableName):
             if _identifyDataType(self._FactorInfo["DataType"][self._FactorInfo["FieldType"]=="ID"].iloc[0])=="double":
-                RawIDField = "CAST("+self._DBTableName+"."+self._IDField+" AS CHAR)"
+                if self._FactorDB._Connector=="sqlite3":# sqlite3 中浮点数转文本会带上小数部分
+                    RawIDField = "CAST(CAST("+self._DBTableName+"."+self._IDField+" AS INTEGER) AS TEXT)"
+                else:
+                    RawIDField = "CAST("+self._DBTableName+"."+self._IDField+" AS CHAR)"
             else:
                 RawIDField = self._DBTableName+"."+self._IDField
         else:
@@ -623,7 +671,7 @@ class _ConstituentTable(_DBTable):
         if ifactor_name is not None: SQLStr += "WHERE "+self._DBTableName+"."+self._FactorInfo.loc[self._GroupField, "DBFieldName"]+"='"+ifactor_name+"' "
         else: SQLStr += "WHERE "+self._DBTableName+"."+self._FactorInfo.loc[self._GroupField, "DBFieldName"]+" IS NOT NULL "
         if idt is not None:
-            idt = idt.strftime("%Y%m%d")
+            idt = _genDateLiteral(self._FactorDB, idt)
             SQLStr += "AND "+self._DBTableName+"."+self._FactorInfo.loc[self._InDateField, "DBFieldName"]+"<='"+idt+"' "
             if kwargs.get("is_current", True):
                 SQLStr += "AND (("+self._DBTableName+"."+self._FactorInfo.loc[self._OutDateField, "DBFieldName"]+">'"+idt+"') "
@@ -647,10 +695,10 @@ class _ConstituentTable(_DBTable):
             if ifactor_name is not None: SQLStr += "AND "+self._DBTableName+"."+self._FactorInfo.loc[self._GroupField, "DBFieldName"]+"='"+ifactor_name+"' "
             SQLStr += "AND "+self._MainTableName+"."+self._MainTableID+"='"+deSuffixID([iid])[0]+"' "
             if start_dt is not None:
-                SQLStr += "AND (("+self._DBTableName+"."+self._FactorInfo.loc[self._OutDateField, "DBFieldName"]+">'"+start_dt.strftime("%Y%m%d")+"') "
+                SQLStr += "AND (("+self._DBTableName+"."+self._FactorInfo.loc[self._OutDateField, "DBFieldName"]+">'"+_genDateLiteral(self._FactorDB, start_dt)+"') "
                 SQLStr += "OR ("+self._DBTableName+"."+self._FactorInfo.loc[self._OutDateField, "DBFieldName"]+" IS NULL))"
             if end_dt is not None:
-                SQLStr += "AND "+self._DBTableName+"."+self._FactorInfo.loc[self._InDateField, "DBFieldName"]+"<='"+end_dt.strftime("%Y%m%d")+"' "
+                SQLStr += "AND "+self._DBTableName+"."+self._FactorInfo.loc[self._InDateField, "DBFieldName"]+"<='"+_genDateLiteral(self._FactorDB, end_dt)+"' "
             SQLStr += self._genConditionSQLStr(args=args)+" "
             SQLStr += "ORDER BY "+self._DBTableName+"."+self._FactorInfo.loc[self._InDateField, "DBFieldName"]
             Data = self._FactorDB.fetchall(SQLStr)
@@ -688,9 +736,9 @@ class _ConstituentTable(_DBTable):
         else:
             SQLStr += "WHERE "+self._MainTableName+"."+self._MainTableID+" IS NOT NULL "
         SQLStr += "AND ("+genSQLInCondition(self._DBTableName+"."+FieldDict[self._GroupField], factor_names, is_str=False, max_num=1000)+") "
-        SQLStr += "AND (("+self._DBTableName+"."+FieldDict[self._OutDateField]+">'"+StartDate.strftime("%Y%m%d")+"') "
+        SQLStr += "AND (("+self._DBTableName+"."+FieldDict[self._OutDateField]+">'"+_genDateLiteral(self._FactorDB, StartDate)+"') "
         SQLStr += "OR ("+self._DBTableName+"."+FieldDict[self._OutDateField]+" IS NULL)) "
-        SQLStr += "AND "+self._DBTableName+"."+FieldDict[self._InDateField]+"<='"+EndDate.strftime("%Y%m%d")+"' "
+        SQLStr += "AND "+self._DBTableName+"."+FieldDict[self._InDateField]+"<='"+_genDateLiteral(self._FactorDB, EndDate)+"' "
         SQLStr += self._genConditionSQLStr(args=args)+" "
         SQLStr += "ORDER BY "+self._DBTableName+"."+FieldDict[self._GroupField]+", ID, "
         SQLStr += self._DBTableName+"."+FieldDict[self._InDateField]
@@ -701,22 +749,21 @@ class _ConstituentTable(_DBTable):
     def __QS_calcData__(self, raw_data, factor_names, ids, dts, args={}):
         StartDate, EndDate = dts[0].date(), dts[-1].date()
         DateSeries = getDateSeries(StartDate, EndDate)
-        Data = {}
-        for iIndexID in factor_names:
-            iRawData = raw_data[raw_data["IndexID"]==int(iIndexID)].set_index(["SecurityID"])
-            iData = pd.DataFrame(0, index=DateSeries, columns=pd.unique(iRawData.index))
-            for jID in iData.columns:
-                jIDRawData = iRawData.loc[[jID]]
-                for k in range(jIDRawData.shape[0]):
-                    kStartDate = jIDRawData["InDate"].iloc[k].date()
-                    kEndDate = (jIDRawData["OutDate"].iloc[k].date()-dt.timedelta(1) if jIDRawData["OutDate"].iloc[k] is not None else dt.date.today())
-                    iData[jID].loc[kStartDate:kEndDate] = 1
-            Data[iIndexID] = iData
-        Data = pd.Panel(Data)
-        if Data.minor_axis.intersection(ids).shape[0]==0: return pd.Panel(0.0, items=factor_names, major_axis=dts, minor_axis=ids)
-        Data = Data.loc[factor_names, :, ids]
-        Data.major_axis = [dt.datetime.combine(iDate, dt.time(0)) for iDate in Data.major_axis]
-        Data.fillna(value=0, inplace=True)
+        Data = np.zeros(shape=(len(factor_names), len(DateSeries), len(ids)))
+        if raw_data.shape[0]>0:
+            FactorIdx = pd.Index([int(iIndexID) for iIndexID in factor_names]).get_indexer(raw_data["IndexID"].astype(np.int64).values)
+            IDIdx = pd.Index(ids).get_indexer(raw_data["SecurityID"].values)
+            Mask = ((FactorIdx>=0) & (IDIdx>=0))
+            # 纳入日期至剔除日期前一日为成份, 剔除日期缺失时至今日为成份
+            Dates = np.array(DateSeries, dtype="datetime64[D]")
+            InDates = pd.to_datetime(raw_data["InDate"]).values.astype("datetime64[D]")
+            OutDates = pd.to_datetime(raw_data["OutDate"]).values.astype("datetime64[D]")
+            OutDates[np.isnat(OutDates)] = np.datetime64(dt.date.today()+dt.timedelta(1), "D")
+            StartIdx = Dates.searchsorted(InDates, side="left")
+            EndIdx = np.where(Mask, Dates.searchsorted(OutDates, side="left"), StartIdx)
+            RowIdx, DTIdx = expandInterval(StartIdx, EndIdx)
+            Data[FactorIdx[RowIdx], DTIdx, IDIdx[RowIdx]] = 1
+        Data = pd.Panel(Data, items=factor_names, major_axis=[dt.datetime.combine(iDate, dt.time(0)) for iDate in DateSeries], minor_axis=ids)
         return adjustDateTime(Data, dts, fillna=True, method="bfill")
 
 
@@ -798,6 +845,14 @@ class _MarketTable(_DBTable):
             StartInd = operation_mode.DTRuler.index(ConditionGroup[iConditions]["StartDT"])
             Groups.append((self, ConditionGroup[iConditions]["FactorNames"], list(ConditionGroup[iConditions]["RawFactorNames"]), operation_mode.DTRuler[StartInd:EndInd+1], ConditionGroup[iConditions]["args"]))
         return Groups
+    # 生成原始数据的查询键, 查询键相同的请求可以由 readBatchData 合并为一条 SQL 语句, 返回: (查询键, 起始日期, 截止日期)
+    def _genRawDataKey(self, ids, dts, args={}):
+        if type(self).__QS_prepareRawData__ is not _MarketTable.__QS_prepareRawData__: return None
+        LookBack = args.get("回溯天数", self.LookBack)
+        if np.isinf(LookBack): return None
+        Conditions = ";".join([iArgName+":"+str(args.get(iArgName, self[iArgName])) for iArgName in self.ArgNames if iArgName not in self._QS_IgnoredGroupArgs])
+        StartDate = dts[0].date() - dt.timedelta(LookBack)
+        return ((id(self._FactorDB), self.Name, Conditions, tuple(ids)), StartDate, dts[-1].date())
     def _genNullIDSQLStr(self, factor_names, ids, end_date, args={}):
         IDField = self._getIDField(args=args)
         DateField = self._DBTableName+"."+self._FactorInfo.loc[args.get("日期字段", self.DateField), "DBFieldName"]
@@ -984,6 +1039,7 @@ class _InfoPublTable(_MarketTable):
                 SQLStr += "AND "+AnnDateField+"<='"+end_dt.strftime(DTFormat)+"' "
         SQLStr += self._genConditionSQLStr(args=args)+" "
         SQLStr += "ORDER BY DT"
+        if self._FactorDB._Connector=="sqlite3": return [_parseSQLiteDateTime(iRslt[0]) for iRslt in self._FactorDB.fetchall(SQLStr)]
         return [iRslt[0] for iRslt in self._FactorDB.fetchall(SQLStr)]
     def _genNullIDSQLStr_InfoPubl(self, factor_names, ids, end_date, args={}):
         EndDateField = self._DBTableName+"."+self._FactorInfo.loc[args.get("日期字段", self.DateField), "DBFieldName"]
@@ -1081,12 +1137,14 @@ class _InfoPublTable(_MarketTable):
         RawData = self._FactorDB.fetchall(SQLStr)
         if not RawData: RawData = pd.DataFrame(columns=["日期", "ID", "MaxEndDate"]+factor_names)
         RawData = pd.DataFrame(np.array(RawData, dtype="O"), columns=["日期", "ID", "MaxEndDate"]+factor_names)
+        if self._FactorDB._Connector=="sqlite3": RawData[["日期", "MaxEndDate"]] = RawData[["日期", "MaxEndDate"]].applymap(_parseSQLiteDateTime)
         if np.isinf(LookBack):
             NullIDs = set(ids).difference(set(RawData[RawData["日期"]==dt.datetime.combine(StartDate,dt.time(0))]["ID"]))
             if NullIDs:
                 NullRawData = self._FactorDB.fetchall(self._genNullIDSQLStr_InfoPubl(factor_names, list(NullIDs), StartDate, args=args))
                 if NullRawData:
                     NullRawData = pd.DataFrame(np.array(NullRawData, dtype="O"), columns=["日期", "ID", "MaxEndDate"]+factor_names)
+                    if self._FactorDB._Connector=="sqlite3": NullRawData[["日期", "MaxEndDate"]] = NullRawData[["日期", "MaxEndDate"]].applymap(_parseSQLiteDateTime)
                     RawData = pd.concat([NullRawData, RawData], ignore_index=True)
                     RawData.sort_values(by=["ID", "日期"])
         if RawData.shape[0]==0: return RawData.loc[:, ["日期", "ID"]+factor_names]
@@ -1349,9 +1407,11 @@ class _TimeSeriesTable(_DBTable):
         RawData = self._FactorDB.fetchall(SQLStr)
         if not RawData: RawData = pd.DataFrame(columns=["日期", "MaxEndDate"]+factor_names)
         RawData = pd.DataFrame(np.array(RawData, dtype="O"), columns=["日期", "MaxEndDate"]+factor_names)
+        if self._FactorDB._Connector=="sqlite3": RawData[["日期", "MaxEndDate"]] = RawData[["日期", "MaxEndDate"]].applymap(_parseSQLiteDateTime)
         if np.isinf(LookBack):
             NullRawData = self._FactorDB.fetchall(self._genNullIDSQLStr_WithPublDate(factor_names, [], StartDate, args=args))
             NullRawData = pd.DataFrame(np.array(NullRawData, dtype="O"), columns=["日期", "MaxEndDate"]+factor_names)
+            if self._FactorDB._Connector=="sqlite3": NullRawData[["日期", "MaxEndDate"]] = NullRawData[["日期", "MaxEndDate"]].applymap(_parseSQLiteDateTime)
             RawData = pd.concat([NullRawData, RawData], ignore_index=True)
             RawData.sort_values(by=["日期"])
         if RawData.shape[0]==0: return RawData.loc[:, ["日期"]+factor_names]
@@ -1681,7 +1741,7 @@ class _FinancialTable(_DBTable):
         if args.get("忽略非季末报告", self.IgnoreNonQuarter) or (not ((args.get("报告期", self.ReportDate)=="所有") and (args.get("计算方法", self.CalcType)=="最新") and (args.get("回溯年数", self.YearLookBack)==0) and (args.get("回溯期数", self.PeriodLookBack)==0))):
             if self._FactorDB.DBType=="SQL Server":
                 SQLStr += " AND TO_CHAR("+ReportDateField+",'MMDD') IN ('0331','0630','0930','1231')"
-            elif self._FactorDB.DBType=="MySQL":
+            elif self._FactorDB.DBType in ("MySQL", "sqlite3"):
                 SQLStr += " AND DATE_FORMAT("+ReportDateField+",'%m%d') IN ('0331','0630','0930','1231')"
             elif self._FactorDB.DBType=="Oracle":
                 SQLStr += " AND TO_CHAR("+ReportDateField+",'MMdd') IN ('0331','0630','0930','1231')"
@@ -1775,45 +1835,92 @@ class _FinancialTable(_DBTable):
         RawData.columns = ["ID", "AnnDate", "ReportDate", "AdjustType"]+factor_names
         RawData = self._adjustRawDataByRelatedField(RawData, factor_names)
         return RawData
-    def _calcData(self, raw_data, periods, factor_name, ids, dts, calc_type, report_date, ignore_missing):
-        if ignore_missing: raw_data = raw_data[pd.notnull(raw_data[factor_name])]
-        # TargetReportDate: 每个 ID 每个公告日对应的最大报告期
-        TargetReportDate = raw_data.loc[:, ["ID", "AnnDate", "ReportDate"]]
-        if report_date=="年报": TargetReportDate.loc[raw_data["ReportPeriod"]!="12-31", "ReportDate"] = dt.datetime(1899,12,31)
-        elif report_date=="中报": TargetReportDate.loc[raw_data["ReportPeriod"]!="06-30", "ReportDate"] = dt.datetime(1899,12,31)
-        elif report_date=="一季报": TargetReportDate.loc[raw_data["ReportPeriod"]!="03-31", "ReportDate"] = dt.datetime(1899,12,31)
-        elif report_date=="三季报": TargetReportDate.loc[raw_data["ReportPeriod"]!="09-30", "ReportDate"] = dt.datetime(1899,12,31)
-        TargetReportDate = TargetReportDate.set_index(["ID"]).groupby(level=0).cummax().reset_index().groupby(by=["ID", "AnnDate"], as_index=False).max()
-        MaxReportDate = TargetReportDate["ReportDate"].copy()
+    # 构建所有因子共享的 (ID, 公告日)-报告期 结构
+    def _genReportPanel(self, raw_data, periods, ids, dts, report_date):
+        IDCodes, IDs = pd.factorize(raw_data["ID"].values)
+        AnnDays = pd.to_datetime(raw_data["AnnDate"]).values.astype("datetime64[D]").astype(np.int64)
+        ReportDTs = pd.DatetimeIndex(pd.to_datetime(raw_data["ReportDate"]))
+        if np.max(periods)>0:# 需要回溯报告期时报告期均为季末, 以季度序号编码, 回溯 N 期即序号减 N
+            RCodes = ReportDTs.year.values.astype(np.int64) * 4 + (ReportDTs.month.values.astype(np.int64) - 1) // 3
+            RCodes -= RCodes.min()
+        else:
+            RCodes = pd.factorize(ReportDTs, sort=True)[0].astype(np.int64)
+        AdjustType = raw_data["AdjustType"].values
+        # 按 ID, 公告日, 报告期, 报表类型排序
+        Order = np.lexsort((AdjustType, RCodes, AnnDays, IDCodes))
+        Panel = {"Order":Order, "IDCodes":IDCodes[Order], "RCodes":RCodes[Order], "ReportPeriod":raw_data["ReportPeriod"].values[Order]}
+        nR = Panel["RCodes"].max() + 1
+        # 事件: 每个 ID 的每个公告日
+        EventKeys = Panel["IDCodes"] * 10**6 + (AnnDays[Order] + 100000)
+        EventFlag = np.r_[True, EventKeys[1:]!=EventKeys[:-1]]
+        Panel["EventStart"] = np.flatnonzero(EventFlag)
+        Panel["EventIdx"] = np.cumsum(EventFlag) - 1
+        Panel["EventIDCodes"] = Panel["IDCodes"][EventFlag]
+        nEvent = Panel["EventStart"].shape[0]
+        Panel["nR"], Panel["nEvent"] = nR, nEvent
+        # 记录按 (ID, 报告期, 公告事件) 排序, 同一公告事件内保持报表类型顺序
+        Panel["RecKeys"] = (Panel["IDCodes"] * nR + Panel["RCodes"]) * (nEvent + 1) + Panel["EventIdx"]
+        Panel["RecOrder"] = np.argsort(Panel["RecKeys"], kind="mergesort")
+        # 报告期筛选
+        PeriodMap = {"年报":"12-31", "中报":"06-30", "一季报":"03-31", "三季报":"09-30"}
+        if isinstance(report_date, str) and (report_date in PeriodMap): Panel["FilterMask"] = (Panel["ReportPeriod"]==PeriodMap[report_date])
+        else: Panel["FilterMask"] = np.full(Order.shape, True)
+        # 时点 × ID 对应的最近公告事件
+        DTDays = np.array(dts, dtype="datetime64[D]").astype(np.int64)
+        QIDCodes = pd.Index(IDs).get_indexer(ids)
+        QueryKeys = QIDCodes.reshape((1, -1)) * 10**6 + (DTDays.reshape((-1, 1)) + 100000)
+        GridEvent = EventKeys[EventFlag].searchsorted(QueryKeys, side="right") - 1
+        GridMask = ((GridEvent>=0) & (QIDCodes.reshape((1, -1))>=0))
+        GridEvent[~GridMask] = 0
+        GridMask &= (Panel["EventIDCodes"][GridEvent]==QIDCodes.reshape((1, -1)))
+        Panel["GridEvent"], Panel["GridMask"] = GridEvent, GridMask
+        return Panel
+    # 查找每个公告事件对应目标报告期的最新记录, 返回: (是否找到, 记录位置); event_idx 为 None 时截止到各自的公告事件, 否则截止到指定的公告事件
+    def _lookupRecord(self, panel, row_mask, target_rcodes, event_idx=None):
+        RecOrder = panel["RecOrder"][row_mask[panel["RecOrder"]]]
+        RecKeys = panel["RecKeys"][RecOrder]
+        TargetKeys = panel["EventIDCodes"] * panel["nR"] + target_rcodes
+        if event_idx is None: event_idx = np.arange(panel["nEvent"])
+        Pos = RecKeys.searchsorted(TargetKeys * (panel["nEvent"] + 1) + event_idx, side="right") - 1
+        Found = ((Pos>=0) & (target_rcodes>=0))
+        Pos[~Found] = 0
+        if RecOrder.shape[0]==0: return np.full(Found.shape, False), Pos
+        Found &= (RecKeys[Pos] // (panel["nEvent"] + 1)==TargetKeys)
+        return Found, RecOrder[Pos]
+    def _calcData(self, values, panel, periods, calc_type, ignore_missing):
+        Values = values[panel["Order"]]
+        NotNull = pd.notnull(Values)
+        RowMask = (NotNull if ignore_missing else np.full(NotNull.shape, True))
+        # 每个 ID 每个公告日对应的最大报告期, 0 表示尚无报告期
+        MaxRCodes = np.where(RowMask & panel["FilterMask"], panel["RCodes"] + 1, 0)
+        MaxRCodes = np.maximum.reduceat(MaxRCodes, panel["EventStart"])
+        Offset = panel["EventIDCodes"] * (panel["nR"] + 1)
+        MaxRCodes = np.maximum.accumulate(MaxRCodes + Offset) - Offset - 1
+        GridMask = panel["GridMask"]
+        EventIdx = np.arange(panel["nEvent"])
         Data = {}
         for i, iPeriod in enumerate(periods):
-            # TargetReportDate: 每个 ID 每个公告日对应的目标报告期
-            if iPeriod>0: TargetReportDate["ReportDate"] = MaxReportDate.apply(RollBackNPeriod_New, args=(iPeriod,))
-            # iData: 每个 ID 每个公告日对应的目标报告期及其因子值
-            iData = TargetReportDate.merge(raw_data, how="left", on=["ID", "ReportDate"], suffixes=("", "_y"))
-            iData = iData[(iData["AnnDate"]>=iData["AnnDate_y"]) | pd.isnull(iData["AnnDate_y"])].sort_values(by=["ID", "AnnDate", "AnnDate_y", "AdjustType"])
+            iTargetRCodes = np.where(MaxRCodes>=0, MaxRCodes - iPeriod, -1)
+            # 目标报告期存在但尚未公告的事件沿用该 ID 上一个有效事件的结果
+            iFound, iPos = self._lookupRecord(panel, RowMask, iTargetRCodes)
+            iExist = self._lookupRecord(panel, RowMask, iTargetRCodes, event_idx=np.full(EventIdx.shape, panel["nEvent"]))[0]
+            iValidEvent = np.maximum.accumulate(np.where(iExist & (~iFound), -1, EventIdx))
+            iValidEvent[iValidEvent<0] = 0
+            iGridMask = (GridMask & (panel["EventIDCodes"][iValidEvent]==panel["EventIDCodes"])[panel["GridEvent"]])
+            iGridEvent = iValidEvent[panel["GridEvent"]]
             if (i==0) and (calc_type!="最新"):
-                iData = iData.loc[:, ["ID", "AnnDate", "ReportPeriod", factor_name]].groupby(by=["ID", "AnnDate"], as_index=True).last()
-                ReportPeriod = iData.loc[:, "ReportPeriod"].where(pd.notnull(iData.loc[:, "ReportPeriod"]), "None").unstack().T
-                iData = iData.loc[:, factor_name].where(pd.notnull(iData.loc[:, factor_name]), np.inf).unstack().T
-                iIndex = iData.index.union(dts).sort_values()
-                Data[iPeriod] = iData.loc[iIndex].fillna(method="pad").loc[dts, ids]
-                ReportPeriod = ReportPeriod.loc[iIndex].fillna(method="pad").loc[dts, ids]
-                Data[iPeriod] = Data[iPeriod].where(Data[iPeriod]!=np.inf, np.nan)
-                ReportPeriod = ReportPeriod.where(ReportPeriod!="None", None)
-            else:
-                iData = iData.loc[:, ["ID", "AnnDate", factor_name]].groupby(by=["ID", "AnnDate"], as_index=True).last()
-                iData = iData.loc[:, factor_name].where(pd.notnull(iData.loc[:, factor_name]), np.inf).unstack().T
-                iIndex = iData.index.union(dts).sort_values()
-                Data[iPeriod] = iData.loc[iIndex].fillna(method="pad").loc[dts, ids]
-                Data[iPeriod] = Data[iPeriod].where(Data[iPeriod]!=np.inf, np.nan)
-            iData = None
+                iReportPeriod = np.where(iFound, panel["ReportPeriod"][iPos], None)
+                ReportPeriod = np.where(iGridMask, iReportPeriod[iGridEvent], None)
+            # 因子值取目标报告期已公告的最新非缺失记录
+            iFound, iPos = self._lookupRecord(panel, NotNull, iTargetRCodes)
+            iData = np.where(iFound, Values[iPos], np.nan)
+            Data[iPeriod] = np.where(iGridMask, iData[iGridEvent], np.nan)
         if calc_type=="最新": return Data[periods[0]]
-        elif calc_type=="单季度":
+        Data = {iPeriod: Data[iPeriod].astype(float) for iPeriod in Data}
+        if calc_type=="单季度":
             Rslt = Data[periods[0]] - Data[periods[1]]
             Mask = (ReportPeriod=="03-31")
             Rslt[Mask] = Data[periods[0]][Mask]
-            Rslt[pd.isnull(ReportPeriod)] = None
         elif calc_type=="TTM":
             Rslt = Data[periods[0]].copy()
             Mask = (ReportPeriod=="03-31")
@@ -1822,7 +1929,7 @@ class _FinancialTable(_DBTable):
             Rslt[Mask] = (Data[periods[0]] + Data[periods[2]] - Data[periods[4]])[Mask]
             Mask = (ReportPeriod=="09-30")
             Rslt[Mask] = (Data[periods[0]] + Data[periods[3]] - Data[periods[4]])[Mask]
-            Rslt[pd.isnull(ReportPeriod)] = None
+        Rslt[pd.isnull(ReportPeriod)] = np.nan
         return Rslt
     def __QS_calcData__(self, raw_data, factor_names, ids, dts, args={}):
         if raw_data.shape[0]==0: return pd.Panel(items=factor_names, major_axis=dts, minor_axis=ids)
@@ -1832,9 +1939,10 @@ class _FinancialTable(_DBTable):
         elif CalcType=="TTM": Periods = np.array([0, 1, 2, 3, 4], dtype=np.int)
         Periods += YearLookBack * 4 + PeriodLookBack
         raw_data["ReportPeriod"] = raw_data["ReportDate"].astype(str).str.slice(start=5)
+        ReportPanel = self._genReportPanel(raw_data, Periods, ids, dts, ReportDate)
         Data = {}
         for iFactorName in factor_names:
-            Data[iFactorName] = self._calcData(raw_data.loc[:, ["ID", "AnnDate", "ReportDate", "AdjustType", "ReportPeriod", iFactorName]], Periods, iFactorName, ids, dts, CalcType, ReportDate, IgnoreMissing)
+            Data[iFactorName] = pd.DataFrame(self._calcData(raw_data[iFactorName].values, ReportPanel, Periods, CalcType, IgnoreMissing), index=dts, columns=ids)
         return pd.Panel(Data).loc[factor_names]
 
 # 财务因子表(旧), Deprecated
@@ -1925,7 +2033,7 @@ class _FinancialTable_Old(_DBTable):
         if self._FactorDB.DBType=="SQL Server":
             SQLStr += "TO_CHAR("+AnnDateField+",'YYYYMMDD'), "
             SQLStr += "TO_CHAR("+ReportDateField+",'YYYYMMDD'), "
-        elif self._FactorDB.DBType=="MySQL":
+        elif self._FactorDB.DBType in ("MySQL", "sqlite3"):
             SQLStr += "DATE_FORMAT("+AnnDateField+",'%Y%m%d'), "
             SQLStr += "DATE_FORMAT("+ReportDateField+",'%Y%m%d'), "
         elif self._FactorDB.DBType=="Oracle":
@@ -1937,7 +2045,7 @@ class _FinancialTable_Old(_DBTable):
         SQLStr += "WHERE ("+genSQLInCondition(self._MainTableName+"."+self._MainTableID, deSuffixID(ids), is_str=self._IDFieldIsStr, max_num=1000)+") "
         if self._FactorDB.DBType=="SQL Server":
             SQLStr += "AND TO_CHAR("+ReportDateField+",'MMDD') IN ('0331','0630','0930','1231') "
-        elif self._FactorDB.DBType=="MySQL":
+        elif self._FactorDB.DBType in ("MySQL", "sqlite3"):
             SQLStr += "AND DATE_FORMAT("+ReportDateField+",'%m%d') IN ('0331','0630','0930','1231') "
         elif self._FactorDB.DBType=="Oracle":
             SQLStr += "AND TO_CHAR("+ReportDateField+",'MMdd') IN ('0331','0630','0930','1231') "
@@ -2388,7 +2496,7 @@ def genANN_ReportSQLStr(db_type, table_prefix, ids, report_period="1231", pre_fi
     if db_type=="SQL Server":
         SQLStr += "TO_CHAR("+DBTableName+".InfoPublDate,'YYYYMMDD'), "
         ReportDateStr = "TO_CHAR("+DBTableName+".EndDate,'YYYYMMDD')"
-    elif db_type=="MySQL":
+    elif db_type in ("MySQL", "sqlite3"):
         SQLStr += "DATE_FORMAT("+DBTableName+".InfoPublDate,'%Y%m%d'), "
         ReportDateStr = "DATE_FORMAT("+DBTableName+".EndDate,'%Y%m%d')"
     elif db_type=="Oracle":
@@ -2465,7 +2573,7 @@ class _AnalystConsensusTable(_DBTable):
         # 形成SQL语句, 日期, ID, 报告期, 数据
         if self._FactorDB.DBType=="SQL Server":
             SQLStr = "SELECT TO_CHAR("+DateField+",'YYYYMMDD'), "
-        elif self._FactorDB.DBType=="MySQL":
+        elif self._FactorDB.DBType in ("MySQL", "sqlite3"):
             SQLStr = "SELECT DATE_FORMAT("+DateField+",'%Y%m%d'), "
         elif self._FactorDB.DBType=="Oracle":
             SQLStr = "SELECT TO_CHAR("+DateField+",'yyyyMMdd'), "
@@ -2521,84 +2629,17 @@ class _AnalystConsensusTable(_DBTable):
         Dates = sorted({iDT.strftime("%Y%m%d") for iDT in dts})
         CalcType, LookBack = args.get("计算方法", self.CalcType), args.get("回溯天数", self.LookBack)
         if CalcType=="Fwd12M":
-            CalcFun, FYNum, ANNReportData = self._calcIDData_Fwd12M, None, None
+            FYNum, ANNReportData = None, None
         else:
-            CalcFun, FYNum = self._calcIDData_FY, int(CalcType[-1])
+            FYNum = int(CalcType[-1])
             ANNReportPath = raw_data.columns.name
             if (ANNReportPath is not None) and os.path.isfile(ANNReportPath+("."+self._ANN_ReportFileSuffix if self._ANN_ReportFileSuffix else "")):
                 with shelve.open(ANNReportPath) as ANN_ReportFile:
                     ANNReportData = ANN_ReportFile["RawData"]
             else:
                 ANNReportData = _prepareReportANNRawData(self._FactorDB, ids, pre_filter_id=args.get("预筛选ID", self.PreFilterID))
-            ANNReportData = ANNReportData.set_index(["ID"])
-        raw_data = raw_data.set_index(["ID"])
-        Data = {}
-        for iID in raw_data.index.unique():
-            if ANNReportData is not None:
-                if iID in ANNReportData.index:
-                    iANNReportData = ANNReportData.loc[[iID]]
-                else:
-                    continue
-            else:
-                iANNReportData = None
-            Data[iID] = CalcFun(Dates, raw_data.loc[[iID]], iANNReportData, factor_names, LookBack, FYNum)
-        Data = pd.Panel(Data, minor_axis=factor_names)
-        Data.major_axis = [dt.datetime.strptime(iDate, "%Y%m%d") for iDate in Dates]
-        Data = Data.swapaxes(0, 2)
+        Data = calcAnalystConsensus(raw_data, ANNReportData, factor_names, Dates, LookBack, FYNum)
         return adjustDataDTID(Data, LookBack, factor_names, ids, dts, logger=self._QS_Logger)
-    def _calcIDData_FY(self, date_seq, raw_data, report_ann_data, factor_names, lookback, fy_num):
-        StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
-        tempInd = -1
-        tempLen = raw_data.shape[0]
-        NoteDate = None
-        for i, iDate in enumerate(date_seq):
-            while (tempInd<tempLen-1) and (iDate>=raw_data['日期'].iloc[tempInd+1]): tempInd = tempInd+1
-            if tempInd<0: continue
-            LastYear = str(int(iDate[0:4])-1)
-            NoteDate = findNoteDate(LastYear+'1231', report_ann_data)
-            if (NoteDate is None) or (NoteDate>iDate):
-                ObjectDate = str(int(LastYear)+fy_num)+'1231'
-            else:
-                ObjectDate = str(int(iDate[0:4])+fy_num)+'1231'
-            iDate = dt.date(int(iDate[0:4]), int(iDate[4:6]), int(iDate[6:])) 
-            for j in range(0, tempInd+1):
-                if raw_data['报告期'].iloc[tempInd-j]==ObjectDate:
-                    FYNoteDate = raw_data['日期'].iloc[tempInd-j]
-                    if (iDate - dt.date(int(FYNoteDate[0:4]), int(FYNoteDate[4:6]), int(FYNoteDate[6:]))).days<=lookback:
-                        StdData[i] = raw_data[factor_names].iloc[tempInd-j].values
-                        break
-        return StdData
-    def _calcIDData_Fwd12M(self, date_seq, raw_data, report_ann_data, factor_names, lookback, fy_num):
-        StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
-        tempInd = -1
-        tempLen = raw_data.shape[0]
-        NoteDate = None
-        for i, iDate in enumerate(date_seq):
-            while (tempInd<tempLen-1) and (iDate>=raw_data['日期'].iloc[tempInd+1]): tempInd = tempInd+1
-            if tempInd<0: continue
-            ObjectDate1 = iDate[0:4]+'1231'
-            ObjectDate2 = str(int(iDate[0:4])+1)+'1231'
-            ObjectData1 = None
-            ObjectData2 = None
-            iDate = dt.date(int(iDate[0:4]), int(iDate[4:6]), int(iDate[6:]))
-            for j in range(0, tempInd+1):
-                if (ObjectData1 is None) and (raw_data['报告期'].iloc[tempInd-j]==ObjectDate1):
-                    NoteDate = raw_data['日期'].iloc[tempInd-j]
-                    if (iDate-dt.date(int(NoteDate[0:4]), int(NoteDate[4:6]), int(NoteDate[6:]))).days<=lookback:
-                        ObjectData1 = raw_data[factor_names].iloc[tempInd-j].values
-                if (ObjectData2 is None) and (raw_data['报告期'].iloc[tempInd-j]==ObjectDate2):
-                    NoteDate = raw_data['日期'].iloc[tempInd-j]
-                    if (iDate-dt.date(int(NoteDate[0:4]), int(NoteDate[4:6]), int(NoteDate[6:]))).days<=lookback:
-                        ObjectData2 = raw_data[factor_names].iloc[tempInd-j].values
-                if (ObjectData1 is not None) and (ObjectData2 is not None):
-                    break
-            if (ObjectData1 is not None) and (ObjectData2 is not None):
-                Weight1 = (dt.date(int(ObjectDate1[0:4]), 12, 31) - iDate).days
-                if (iDate.month==2) and (iDate.day==29): Weight1 = Weight1/366
-                else:
-                    Weight1 = Weight1/(dt.date(iDate.year+1, iDate.month, iDate.day)-iDate).days
-                StdData[i] = Weight1*ObjectData1.astype("float") + (1-Weight1)*ObjectData2.astype("float")
-        return StdData
 
 # f: 该算子所属的因子对象或因子表对象
 # idt: 当前所处的时点
@@ -2653,7 +2694,7 @@ class _AnalystEstDetailTable(_DBTable):
         # 形成SQL语句, 日期, ID, 报告期, 研究机构, 因子数据
         if self._FactorDB.DBType=="SQL Server":
             SQLStr = "SELECT TO_CHAR("+DateField+",'YYYYMMDD'), "
-        elif self._FactorDB.DBType=="MySQL":
+        elif self._FactorDB.DBType in ("MySQL", "sqlite3"):
             SQLStr = "SELECT DATE_FORMAT("+DateField+",'%Y%m%d'), "
         elif self._FactorDB.DBType=="Oracle":
             SQLStr = "SELECT TO_CHAR("+DateField+",'yyyyMMdd'), "
@@ -2697,45 +2738,56 @@ class _AnalystEstDetailTable(_DBTable):
             ANNReportData = _prepareReportANNRawData(self._FactorDB, ids, pre_filter_id=args.get("预筛选ID", self.PreFilterID))
         ANNReportData = ANNReportData.set_index(["ID"])
         AllIDs = set(raw_data.index)
+        DateStrs = [iDate.strftime("%Y%m%d") for iDate in Dates]
+        StartDateStrs = [(iDate - dt.timedelta(Period)).strftime("%Y%m%d") for iDate in Dates]
+        Fields = {}
+        for kFactorName in factor_names:
+            Fields[kFactorName] = ["日期", self._ReportDateField, kFactorName]+AdditionalFields
         Data = {}
         for kFactorName in factor_names:
-            if DataType=="double": kData = np.full(shape=(len(Dates), len(ids)), fill_value=np.nan)
-            else: kData = np.full(shape=(len(Dates), len(ids)), fill_value=None, dtype="O")
-            kFields = ["日期", self._ReportDateField, kFactorName]+AdditionalFields
-            for j, jID in enumerate(ids):
-                if jID not in AllIDs:
-                    x = [pd.DataFrame(columns=kFields)]*len(ForwardYears)
+            if DataType=="double": Data[kFactorName] = np.full(shape=(len(Dates), len(ids)), fill_value=np.nan)
+            else: Data[kFactorName] = np.full(shape=(len(Dates), len(ids)), fill_value=None, dtype="O")
+        for j, jID in enumerate(ids):
+            if jID not in AllIDs:
+                for kFactorName in factor_names:
+                    x = [pd.DataFrame(columns=Fields[kFactorName])]*len(ForwardYears)
                     for i, iDate in enumerate(Dates):
-                        kData[i, j] = Operator(self, iDate, jID, x, ModelArgs)
-                    continue
-                if jID in ANNReportData.index:
-                    jReportNoteDate = ANNReportData.loc[[jID]].reset_index()
+                        Data[kFactorName][i, j] = Operator(self, iDate, jID, x, ModelArgs)
+                continue
+            if jID in ANNReportData.index:
+                jNoteDates = ANNReportData.loc[[jID]].drop_duplicates(subset=["报告期"], keep="first").set_index(["报告期"])["公告日期"]
+            else:
+                jNoteDates = pd.Series()
+            jRawData = raw_data.loc[[jID]]
+            jDates = jRawData["日期"].values
+            # 窗口内的记录在 jRawData 中连续, 窗口和目标报告期不变时复用已经生成的数据
+            jXCache = {}
+            for i, iDate in enumerate(Dates):
+                iStartInd, iEndInd = jDates.searchsorted(StartDateStrs[i], side="right"), jDates.searchsorted(DateStrs[i], side="right")
+                iLastYear = str(iDate.year-1)
+                ijNoteDate = jNoteDates.get(iLastYear+"1231", None)
+                if (ijNoteDate is None) or (ijNoteDate>DateStrs[i]):
+                    iObjectDates = tuple(str(int(iLastYear)+iiNFY)+"1231" for iiNFY in ForwardYears)
                 else:
-                    jReportNoteDate = pd.DataFrame(columns=ANNReportData.columns)
-                jRawData = raw_data.loc[[jID], kFields]
-                ijNoteDate = None
-                for i, iDate in enumerate(Dates):
-                    iStartDate = (iDate - dt.timedelta(Period)).strftime("%Y%m%d")
-                    ijRawData = jRawData[(jRawData["日期"]<=iDate.strftime("%Y%m%d")) & (jRawData["日期"]>iStartDate)]
-                    iLastYear = str(iDate.year-1)
-                    ijNoteDate = findNoteDate(iLastYear+"1231", jReportNoteDate)
-                    x = []
-                    for iiNFY in ForwardYears:
-                        if (ijNoteDate is None) or ((ijNoteDate is not None) and (ijNoteDate>iDate.strftime("%Y%m%d"))):
-                            ObjectDate = str(int(iLastYear)+iiNFY)+"1231"
-                        else:
-                            ObjectDate = str(iDate.year+iiNFY)+"1231"
-                        iijRawData = ijRawData[ijRawData[self._ReportDateField]==ObjectDate].copy()
-                        if iijRawData.shape[0]==0: x.append(iijRawData)
-                        else:
-                            if DeduplicationFields:
-                                ijTemp = iijRawData.groupby(by=DeduplicationFields)[["日期"]].max()
+                    iObjectDates = tuple(str(iDate.year+iiNFY)+"1231" for iiNFY in ForwardYears)
+                iKey = (iStartInd, iEndInd, iObjectDates)
+                if iKey not in jXCache:
+                    ijRawData = jRawData.iloc[iStartInd:iEndInd]
+                    ijX = {kFactorName: [] for kFactorName in factor_names}
+                    for iObjectDate in iObjectDates:
+                        iijRawData = ijRawData[ijRawData[self._ReportDateField]==iObjectDate]
+                        for kFactorName in factor_names:
+                            kiijRawData = iijRawData.loc[:, Fields[kFactorName]].copy()
+                            if (kiijRawData.shape[0]>0) and DeduplicationFields:
+                                ijTemp = kiijRawData.groupby(by=DeduplicationFields)[["日期"]].max()
                                 ijTemp = ijTemp.reset_index()
                                 ijTemp[DeduplicationFields] = ijTemp[DeduplicationFields].astype("O")
-                                iijRawData = pd.merge(ijTemp, iijRawData, how="left", left_on=DeduplicationFields+["日期"], right_on=DeduplicationFields+["日期"])
-                            x.append(iijRawData)
-                    kData[i, j] = Operator(self, iDate, jID, x, ModelArgs)
-            Data[kFactorName] = kData
+                                kiijRawData = pd.merge(ijTemp, kiijRawData, how="left", left_on=DeduplicationFields+["日期"], right_on=DeduplicationFields+["日期"])
+                            ijX[kFactorName].append(kiijRawData)
+                    jXCache[iKey] = ijX
+                # 缓存的数据会被多个时点复用, 传给算子的是副本, 以免算子的修改影响其他时点
+                for kFactorName in factor_names:
+                    Data[kFactorName][i, j] = Operator(self, iDate, jID, [iX.copy() for iX in jXCache[iKey][kFactorName]], ModelArgs)
         return pd.Panel(Data, major_axis=Dates, minor_axis=ids).loc[factor_names, dts]
 
 class _AnalystRatingDetailTable(_DBTable):
@@ -2777,7 +2829,7 @@ class _AnalystRatingDetailTable(_DBTable):
         # 形成SQL语句, 日期, ID, 其他字段
         if self._FactorDB.DBType=="SQL Server":
             SQLStr = "SELECT TO_CHAR("+DateField+",'YYYYMMDD'), "
-        elif self._FactorDB.DBType=="MySQL":
+        elif self._FactorDB.DBType in ("MySQL", "sqlite3"):
             SQLStr = "SELECT DATE_FORMAT("+DateField+",'%Y%m%d'), "
         elif self._FactorDB.DBType=="Oracle":
             SQLStr = "SELECT TO_CHAR("+DateField+",'yyyyMMdd'), "
@@ -2834,13 +2886,16 @@ class _AnalystRatingDetailTable(_DBTable):
             Data[kFactorName] = kData
         return pd.Panel(Data, major_axis=Dates, minor_axis=ids).loc[factor_names, dts]
 
+# 因子表类注册表, {因子表类型: 因子表类}
+_TableClasses = {iName[1:]: iClass for iName, iClass in list(globals().items()) if iName.startswith("_") and isinstance(iClass, type) and issubclass(iClass, _DBTable)}
+
 class JYDB(QSSQLObject, FactorDB):
     """聚源数据库"""
     DBInfoFile = File(label="库信息文件", arg_type="File", order=100)
     FTArgs = Dict(label="因子表参数", arg_type="Dict", order=101)
     def __init__(self, sys_args={}, config_file=None, **kwargs):
         super().__init__(sys_args=sys_args, config_file=(__QS_ConfigPath__+os.sep+"JYDBConfig.json" if config_file is None else config_file), **kwargs)
-        self._InfoFilePath = __QS_LibPath__+os.sep+"JYDBInfo.hdf5"# 数据库信息文件路径
+        self._InfoFilePath = __QS_LibPath__+os.sep+"JYDBInfo.pkl"# 数据库信息文件路径
         if not os.path.isfile(self.DBInfoFile):
             if self.DBInfoFile: self._QS_Logger.warning("找不到指定的库信息文件 : '%s'" % self.DBInfoFile)
             self._InfoResourcePath = __QS_MainPath__+os.sep+"Resource"+os.sep+"JYDBInfo.xlsx"# 默认数据库信息源文件路径
@@ -2848,22 +2903,127 @@ class JYDB(QSSQLObject, FactorDB):
         else:
             self._InfoResourcePath = self.DBInfoFile
             self._TableInfo, self._FactorInfo, self._ExchangeInfo, self._SecurityInfo = _updateInfo(self._InfoFilePath, self._InfoResourcePath, self._QS_Logger, out_info=True)# 数据库表信息, 数据库字段信息
+        self._TableFactorInfo = {}# 缓存的因子表字段信息, {表名: DataFrame}
         self.Name = "JYDB"
         return
+    def _connect(self):
+        if not ((self.Connector=="sqlite3") or ((self.Connector=="default") and (self.DBType=="sqlite3"))): return super()._connect()
+        # 连接由 mirrorTables 生成的本地镜像库
+        sqlite3.register_converter("JYDATETIME", _decodeSQLiteDateTime)
+        try:
+            self._Connection = sqlite3.connect(self.SQLite3File, detect_types=sqlite3.PARSE_DECLTYPES)
+        except Exception as e:
+            Msg = ("'%s' 尝试使用 sqlite3 连接数据库 '%s' 失败: %s" % (self.Name, self.SQLite3File, str(e)))
+            self._QS_Logger.error(Msg)
+            raise e
+        self._Connection.create_function("CONCAT", -1, _sqliteConcat)
+        self._Connection.create_function("DATE_FORMAT", 2, _sqliteDateFormat)
+        self._Connection.create_function("STR_TO_DATE", 2, _sqliteStrToDate)
+        self._Connection.create_function("TIME", 1, _sqliteTime)
+        self._Connector = "sqlite3"
+        self._PID = os.getpid()
+        return 0
     @property
     def TableNames(self):
         if self._TableInfo is not None: return self._TableInfo[pd.notnull(self._TableInfo["TableClass"])].index.tolist()
         else: return []
+    # 返回因子表的字段信息, 首次访问时从库信息中切片并缓存
+    def _getTableFactorInfo(self, table_name):
+        FactorInfo = self._TableFactorInfo.get(table_name)
+        if FactorInfo is None: FactorInfo = self._TableFactorInfo[table_name] = self._FactorInfo.loc[table_name]
+        return FactorInfo
     def getTable(self, table_name, args={}):
         if table_name in self._TableInfo.index:
             TableClass = args.get("因子表类型", self._TableInfo.loc[table_name, "TableClass"])
-            if pd.notnull(TableClass) and (TableClass!=""):
+            if pd.notnull(TableClass) and (TableClass in _TableClasses):
                 Args = self.FTArgs.copy()
                 Args.update(args)
-                return eval("_"+TableClass+"(name='"+table_name+"', fdb=self, sys_args=Args, logger=self._QS_Logger)")
+                return _TableClasses[TableClass](name=table_name, fdb=self, sys_args=Args, logger=self._QS_Logger)
         Msg = ("因子库 ‘%s' 目前尚不支持因子表: '%s'" % (self.Name, table_name))
         self._QS_Logger.error(Msg)
         raise __QS_Error__(Msg)
+    # -----------------------------------------本地镜像---------------------------------
+    # 将因子表涉及的数据库表(包括关联的主表)镜像到本地 sqlite3 文件 target_file, 并建立 ID 和日期字段的索引
+    # 镜像完成后将数据库类型设为 sqlite3, sqlite3文件设为 target_file, 表名前缀设为空, 即可直接读取镜像库
+    # table_names: [因子表名]; start_date, end_date: 镜像的日期范围(datetime.date), 按因子表的日期字段筛选, None 表示不限, 主表总是整表镜像
+    # update_field: 更新时间字段, 再次同步且日期范围不变时只拉取该字段大于上次同步值的记录, 按 ID 字段覆盖写入; 表中缺少更新时间字段或 ID 字段时整表重新拉取
+    # 源库中删除的记录不会在增量同步中删除
+    def mirrorTables(self, target_file, table_names, start_date=None, end_date=None, update_field="XGRQ", batch_size=10000):
+        DBTables = OrderedDict()# {数据库表名: [日期字段, [[索引字段]], {时间类型字段}]}
+        for iTableName in table_names:
+            iFactorInfo = self._getTableFactorInfo(iTableName)
+            iFields = iFactorInfo["DBFieldName"][iFactorInfo["DBFieldName"].astype(str).str.match(r"^\w+$")]
+            iDateField = iFields[iFactorInfo["FieldType"]=="Date"]
+            iDateField = (iDateField.iloc[0] if iDateField.shape[0]>0 else None)
+            iIDField = iFields[iFactorInfo["FieldType"]=="ID"]
+            iIndexFields = [[iField] for iField in (iIDField.iloc[:1].tolist()+([iDateField] if iDateField else []))]
+            if len(iIndexFields)==2: iIndexFields.append([iIndexFields[0][0], iDateField])
+            iDTFields = set(iFields[iFactorInfo["DataType"].astype(str).map(_identifyDataType)=="object"])
+            iDBTableName = self._TableInfo.loc[iTableName, "DBTableName"]
+            iTable = DBTables.setdefault(iDBTableName, [None, [], set()])
+            if iTable[0] is None: iTable[0] = iDateField
+            iTable[1] += [jFields for jFields in iIndexFields if jFields not in iTable[1]]
+            iTable[2] |= iDTFields
+            iMainTableName = self._TableInfo.loc[iTableName, "MainTableName"]
+            if pd.notnull(iMainTableName):
+                iMainTable = DBTables.setdefault(iMainTableName, [None, [], set()])
+                iMainTableID = self._TableInfo.loc[iTableName, "MainTableID"]
+                if [iMainTableID] not in iMainTable[1]: iMainTable[1].append([iMainTableID])
+        Conn = sqlite3.connect(target_file)
+        try:
+            Conn.execute("CREATE TABLE IF NOT EXISTS QS_MirrorInfo (TableName TEXT PRIMARY KEY, StartDate TEXT, EndDate TEXT, LastUpdate TEXT)")
+            for iDBTableName, (iDateField, iIndexFields, iDTFields) in DBTables.items():
+                if iDateField is None: self._mirrorTable(Conn, iDBTableName, None, iIndexFields, iDTFields, None, None, update_field, batch_size)
+                else: self._mirrorTable(Conn, iDBTableName, iDateField, iIndexFields, iDTFields, start_date, end_date, update_field, batch_size)
+        finally:
+            Conn.close()
+        return 0
+    def _mirrorTable(self, conn, db_table_name, date_field, index_fields, dt_fields, start_date, end_date, update_field, batch_size):
+        StartDate = (start_date.strftime("%Y-%m-%d") if start_date is not None else "")
+        EndDate = ((end_date+dt.timedelta(1)).strftime("%Y-%m-%d") if end_date is not None else "")
+        SQLStr = "SELECT * FROM "+self.TablePrefix+db_table_name+" WHERE 1=1 "
+        if StartDate: SQLStr += "AND "+date_field+">='"+StartDate+"' "
+        if EndDate: SQLStr += "AND "+date_field+"<'"+EndDate+"' "
+        Cursor = self.cursor(SQLStr+"AND 1=0")
+        Fields = [iDescription[0] for iDescription in Cursor.description]
+        Cursor.close()
+        UpdateField = {iField.lower(): iField for iField in Fields}.get(update_field.lower())
+        KeyField = {iField.lower(): iField for iField in Fields}.get("id")
+        Info = conn.execute("SELECT StartDate, EndDate, LastUpdate FROM QS_MirrorInfo WHERE TableName=?", (db_table_name, )).fetchone()
+        isIncremental = ((Info is not None) and (Info[0]==StartDate) and (Info[1]==EndDate) and (Info[2] is not None) and (UpdateField is not None) and (KeyField is not None))
+        if isIncremental:
+            SQLStr += "AND "+UpdateField+">'"+Info[2]+"' "
+            LastUpdate = Info[2]
+        else:
+            conn.execute("DROP TABLE IF EXISTS ["+db_table_name+"]")
+            LastUpdate = None
+        Cursor = self.cursor(SQLStr)
+        UpdateIdx = (Fields.index(UpdateField) if UpdateField is not None else None)
+        InsertSQLStr = "INSERT OR REPLACE INTO ["+db_table_name+"] (["+"], [".join(Fields)+"]) VALUES ("+", ".join(["?"]*len(Fields))+")"
+        nRow, isCreated = 0, isIncremental
+        while True:
+            iData = Cursor.fetchmany(batch_size)
+            if not isCreated:# 根据第一批数据和字段信息确定时间类型和数值类型的字段, 数值字段声明为 NUMERIC 以便和文本形式的 ID 比较时与源库一致
+                DTMask = [(iField in dt_fields) or any(isinstance(iRow[j], (dt.date, dt.datetime)) for iRow in iData) for j, iField in enumerate(Fields)]
+                NumMask = [any(isinstance(iRow[j], (int, float, decimal.Decimal)) and (not isinstance(iRow[j], bool)) for iRow in iData) for j in range(len(Fields))]
+                conn.execute("CREATE TABLE ["+db_table_name+"] ("+", ".join("["+iField+"]"+(" JYDATETIME" if DTMask[j] else (" NUMERIC" if NumMask[j] else "")) for j, iField in enumerate(Fields))+")")
+                isCreated = True
+            if not iData: break
+            if UpdateIdx is not None:
+                iMaxUpdate = max((iRow[UpdateIdx] for iRow in iData if iRow[UpdateIdx] is not None), default=None)
+                if iMaxUpdate is not None:
+                    iMaxUpdate = (iMaxUpdate.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3] if isinstance(iMaxUpdate, dt.datetime) else str(iMaxUpdate))
+                    LastUpdate = (iMaxUpdate if LastUpdate is None else max(LastUpdate, iMaxUpdate))
+            conn.executemany(InsertSQLStr, [tuple(_encodeSQLiteValue(iVal) for iVal in iRow) for iRow in iData])
+            nRow += len(iData)
+        Cursor.close()
+        if KeyField is not None: conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS [QS_"+db_table_name+"_"+KeyField+"] ON ["+db_table_name+"] (["+KeyField+"])")
+        for iFields in index_fields:
+            if set(iFields).issubset(Fields): conn.execute("CREATE INDEX IF NOT EXISTS [QS_"+db_table_name+"_"+"_".join(iFields)+"] ON ["+db_table_name+"] (["+"], [".join(iFields)+"])")
+        conn.execute("REPLACE INTO QS_MirrorInfo (TableName, StartDate, EndDate, LastUpdate) VALUES (?, ?, ?, ?)", (db_table_name, StartDate, EndDate, LastUpdate))
+        conn.commit()
+        self._QS_Logger.info("'%s' 调用方法 mirrorTables %s表 '%s', 共 %d 条记录" % (self.Name, ("增量同步" if isIncremental else "镜像"), db_table_name, nRow))
+        return 0
     # -----------------------------------------数据提取---------------------------------
     # 给定起始日期和结束日期, 获取交易所交易日期, 目前支持: "SSE", "SZSE", "SHFE", "DCE", "CZCE", "INE", "CFFEX"
     def getTradeDay(self, start_date=None, end_date=None, exchange="SSE", **kwargs):
@@ -2982,11 +3142,12 @@ class JYDB(QSSQLObject, FactorDB):
             Suffix += "ELSE '"+DefaultSuffix+"' END"
         SQLStr = "SELECT DISTINCT CONCAT(ContractCode, "+Suffix+") AS ID FROM {Prefix}Fut_ContractMain "
         SQLStr += "WHERE "+ExchangeField+" IN ("+",".join(ExchangeCodes)+") "
+        LeftStr = ("SUBSTR(ContractCode, 1, %d)" if self._Connector=="sqlite3" else "LEFT(ContractCode, %d)")
         if future_code:
             if isinstance(future_code, str):
-                SQLStr += "AND LEFT(ContractCode, "+str(len(future_code))+")='"+future_code+"' "
+                SQLStr += "AND "+(LeftStr % len(future_code))+"='"+future_code+"' "
             else:
-                SQLStr += "AND (LEFT(ContractCode, 1) IN ('"+"','".join(future_code)+"') OR LEFT(ContractCode, 2) IN ('"+"','".join(future_code)+"')) "
+                SQLStr += "AND ("+(LeftStr % 1)+" IN ('"+"','".join(future_code)+"') OR "+(LeftStr % 2)+" IN ('"+"','".join(future_code)+"')) "
         ContractType = kwargs.get("contract_type", "月合约")
         if ContractType!="所有": SQLStr += "AND IfReal="+("2" if ContractType=="连续合约" else "1")+" "
         if ContractType!="连续合约":
@@ -2995,11 +3156,11 @@ class JYDB(QSSQLObject, FactorDB):
         SQLStr += "ORDER BY ID"
         if future_code:
             if isinstance(future_code, str):
-                return [iRslt[0] for iRslt in self.fetchall(SQLStr.format(Prefix=self.TablePrefix, Date=date.strftime("%Y%m%d"))) if re.findall("\D+", iRslt[0][:2])[0] == future_code]
+                return [iRslt[0] for iRslt in self.fetchall(SQLStr.format(Prefix=self.TablePrefix, Date=_genDateLiteral(self, date))) if re.findall("\D+", iRslt[0][:2])[0] == future_code]
             else:
-                return [iRslt[0] for iRslt in self.fetchall(SQLStr.format(Prefix=self.TablePrefix, Date=date.strftime("%Y%m%d"))) if re.findall("\D+", iRslt[0][:2])[0] in future_code]
+                return [iRslt[0] for iRslt in self.fetchall(SQLStr.format(Prefix=self.TablePrefix, Date=_genDateLiteral(self, date))) if re.findall("\D+", iRslt[0][:2])[0] in future_code]
         else:
-            return [iRslt[0] for iRslt in self.fetchall(SQLStr.format(Prefix=self.TablePrefix, Date=date.strftime("%Y%m%d")))]
+            return [iRslt[0] for iRslt in self.fetchall(SQLStr.format(Prefix=self.TablePrefix, Date=_genDateLiteral(self, date)))]
     # 获取指定交易所 exchange 的期货代码
     # exchange: 交易所(str)或者交易所列表(list(str))
     # date: 指定日, 默认值 None 表示今天
@@ -10,6 +10,8 @@
 
 import re
 import os
+import pickle
+import hashlib
 import datetime as dt
 from collections import OrderedDict
 
@@ -23,7 +25,7 @@ from QuantStudio.Tools.DataPreprocessingFun import fillNaByLookback
 from QuantStudio.Tools.QSObjects import QSSQLObject
 from QuantStudio import __QS_Error__, __QS_ConfigPath__
 from QuantStudio.FactorDataBase.FactorDB import WritableFactorDB, FactorTable
-from QuantStudio.FactorDataBase.FDBFun import adjustDataDTID
+from QuantStudio.FactorDataBase.FDBFun import adjustDataDTID, pivotNarrowData
 
 def _identifyDataType(db_type, dtypes):
     if db_type!="sqlite3":
@@ -211,10 +213,11 @@ class _WideTable(FactorTable):
             SubSQLStr += "CASE WHEN "+AnnDateField+">="+EndDateField+" THEN "+AnnDateField+" ELSE "+EndDateField+" END AS AnnDate, "
         SubSQLStr += "MAX("+EndDateField+") AS MaxEndDate "
         SubSQLStr += "FROM "+self._DBTableName+" "
-        SubSQLStr += "WHERE ("+AnnDateField+">='"+StartDate.strftime(DTFormat)+"' "
-        SubSQLStr += "OR "+EndDateField+">='"+StartDate.strftime(DTFormat)+"') "
-        SubSQLStr += "AND ("+AnnDateField+"<='"+EndDate.strftime(DTFormat)+"' "
-        SubSQLStr += "AND "+EndDateField+"<='"+EndDate.strftime(DTFormat)+"') "
+        Params = {"StartDate": StartDate.strftime(DTFormat), "EndDate": EndDate.strftime(DTFormat)}
+        SubSQLStr += "WHERE ("+AnnDateField+">=%(StartDate)s "
+        SubSQLStr += "OR "+EndDateField+">=%(StartDate)s) "
+        SubSQLStr += "AND ("+AnnDateField+"<=%(EndDate)s "
+        SubSQLStr += "AND "+EndDateField+"<=%(EndDate)s) "
         FilterStr = args.get("筛选条件", self.FilterCondition)
         if FilterStr: SubSQLStr += "AND "+FilterStr.format(Table=self._DBTableName)+" "
         if args.get("预筛选ID", self.PreFilterID):
@@ -243,9 +246,8 @@ class _WideTable(FactorTable):
         SQLStr += "AND (t.MaxEndDate="+EndDateField+") "
         if FilterStr: SQLStr += "AND "+FilterStr.format(Table=self._DBTableName)+" "
         SQLStr += "ORDER BY ID, DT"
-        RawData = self._FactorDB.fetchall(SQLStr)
-        if not RawData: RawData = pd.DataFrame(columns=["QS_DT", "ID", "MaxEndDate"]+factor_names)
-        RawData = pd.DataFrame(np.array(RawData, dtype="O"), columns=["QS_DT", "ID", "MaxEndDate"]+factor_names)
+        Columns = ["QS_DT", "ID", "MaxEndDate"]+factor_names
+        RawData = pd.DataFrame(OrderedDict(zip(Columns, self._FactorDB.fetchColumns(SQLStr, params=Params))), columns=Columns)
         if np.isinf(LookBack):
             NullIDs = set(ids).difference(set(RawData[RawData["QS_DT"]==dt.datetime.combine(StartDate,dt.time(0))]["ID"]))
             if NullIDs:
@@ -314,9 +316,11 @@ class _WideTable(FactorTable):
                 SQLStr += self._DBTableName+"."+iField+", "
         SQLStr = SQLStr[:-2]+" FROM "+self._DBTableName+" "
         if StartDate is not None:
-            SQLStr += "WHERE "+self._DBTableName+"."+DTField+">='"+StartDate.strftime("%Y-%m-%d %H:%M:%S.%f")+"' "
-            SQLStr += "AND "+self._DBTableName+"."+DTField+"<='"+EndDate.strftime("%Y-%m-%d %H:%M:%S.%f")+"' "
+            Params = {"StartDate": StartDate.strftime("%Y-%m-%d %H:%M:%S.%f"), "EndDate": EndDate.strftime("%Y-%m-%d %H:%M:%S.%f")}
+            SQLStr += "WHERE "+self._DBTableName+"."+DTField+">=%(StartDate)s "
+            SQLStr += "AND "+self._DBTableName+"."+DTField+"<=%(EndDate)s "
         else:
+            Params = {}
             SQLStr += "WHERE "+self._DBTableName+"."+DTField+" IS NOT NULL "
         if (ids is not None) and args.get("预筛选ID", self.PreFilterID):
             SQLStr += "AND ("+genSQLInCondition(self._DBTableName+"."+IDField, ids, is_str=True, max_num=1000)+") "
@@ -327,9 +331,8 @@ class _WideTable(FactorTable):
         SQLStr += "ORDER BY "+self._DBTableName+"."+DTField+", "+self._DBTableName+"."+IDField
         if args.get("因子值类型", self.ValueType)!="scalar":
             SQLStr += ", "+self._DBTableName+"."+factor_names[0]
-        RawData = self._FactorDB.fetchall(SQLStr)
-        if not RawData: RawData = pd.DataFrame(columns=["QS_DT", "ID"]+factor_names)
-        RawData = pd.DataFrame(np.array(RawData), columns=["QS_DT", "ID"]+factor_names)
+        Columns = ["QS_DT", "ID"]+factor_names
+        RawData = pd.DataFrame(OrderedDict(zip(Columns, self._FactorDB.fetchColumns(SQLStr, params=Params))), columns=Columns)
         if (StartDate is not None) and np.isinf(LookBack):
             if ids is None: ids = self.getID(args=args)
             NullIDs = set(ids).difference(set(RawData[RawData["QS_DT"]==dt.datetime.combine(StartDate, dt.time(0))]["ID"]))
@@ -660,16 +663,10 @@ class _NarrowTable(FactorTable):
         else:
             if not raw_data.index.is_unique:
                 return self._calcListData(raw_data, factor_names, ids, dts, args=args)
-        raw_data = raw_data.unstack()
         DataType = self.getFactorMetaData(factor_names=factor_names, key="DataType", args=args)
-        Data = {}
-        for iFactorName in factor_names:
-            if iFactorName in raw_data:
-                iRawData = raw_data[iFactorName].unstack()
-                if DataType[iFactorName]=="double": iRawData = iRawData.astype("float")
-                Data[iFactorName] = iRawData
-        if not Data: return pd.Panel(items=factor_names, major_axis=dts, minor_axis=ids)
-        return _adjustData(Data, args.get("回溯天数", self.LookBack), factor_names, ids, dts)
+        Data = pivotNarrowData(raw_data.reset_index(), factor_names, "QS_Factor", "QS_FactorValue", data_type=DataType.to_dict())
+        if Data is None: return pd.Panel(items=factor_names, major_axis=dts, minor_axis=ids)
+        return _adjustData(dict(Data), args.get("回溯天数", self.LookBack), factor_names, ids, dts)
 
 
 # 截面宽因子表
@@ -718,6 +715,9 @@ class SQLDB(QSSQLObject, WritableFactorDB):
     IgnoreFields = ListStr(arg_type="List", label="忽略字段", order=101)
     InnerPrefix = Str("qs_", arg_type="String", label="内部前缀", order=102)
     FTArgs = Dict(label="因子表参数", arg_type="Dict", order=103)
+    WithoutRowID = Bool(False, arg_type="Bool", label="无ROWID表", order=104)
+    ExplainQuery = Bool(False, arg_type="Bool", label="记录查询计划", order=105)
+    MetaCache = Bool(False, arg_type="Bool", label="元数据缓存", order=106)
     def __init__(self, sys_args={}, config_file=None, **kwargs):
         super().__init__(sys_args=sys_args, config_file=(__QS_ConfigPath__+os.sep+"SQLDBConfig.json" if config_file is None else config_file), **kwargs)
         self._TableFactorDict = {}# {表名: pd.Series(数据类型, index=[因子名])}
@@ -726,6 +726,57 @@ class SQLDB(QSSQLObject, WritableFactorDB):
         return
     def connect(self):
         super().connect()
+        if self.MetaCache:
+            try:
+                SchemaVersion = self._getSchemaVersion()
+            except Exception as e:
+                self._QS_Logger.warning("'%s' 获取数据库结构版本时错误: %s" % (self.Name, str(e)))
+                SchemaVersion = None
+            if SchemaVersion is not None:
+                MetaFile = self._getMetaCacheFile()
+                if os.path.isfile(MetaFile):
+                    try:
+                        with open(MetaFile, mode="rb") as File:
+                            iSchemaVersion, TableFactorDict, TableFieldDataType = pickle.load(File)
+                    except Exception as e:
+                        self._QS_Logger.warning("'%s' 读取元数据缓存时错误: %s" % (self.Name, str(e)))
+                    else:
+                        if iSchemaVersion==SchemaVersion:
+                            self._TableFactorDict, self._TableFieldDataType = TableFactorDict, TableFieldDataType
+                            return 0
+                self._reflectMeta()
+                try:
+                    if not os.path.isdir(self.QueryCacheDir): os.makedirs(self.QueryCacheDir)
+                    with open(MetaFile+".tmp", mode="wb") as File:
+                        pickle.dump((SchemaVersion, self._TableFactorDict, self._TableFieldDataType), File, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(MetaFile+".tmp", MetaFile)
+                except Exception as e:
+                    self._QS_Logger.warning("'%s' 写入元数据缓存时错误: %s" % (self.Name, str(e)))
+                return 0
+        return self._reflectMeta()
+    # 元数据缓存文件路径, 由数据源标识和影响元数据的参数决定
+    def _getMetaCacheFile(self):
+        Identity = "%s|%s|%s|%s|%d|%s|%s|%s|%s|%s" % (self.__class__.__name__, self.DBType, self.DBName, self.IPAddr, self.Port, self.User, self.DSN, os.path.abspath(self.SQLite3File) if self.SQLite3File else "", self.InnerPrefix, ",".join(sorted(self.IgnoreFields)))
+        return self.QueryCacheDir+os.sep+"Meta_"+hashlib.sha1(Identity.encode("utf-8")).hexdigest()+".pkl"
+    # 返回数据库结构的版本标识, 表结构发生变化时该标识随之变化, 返回 None 表示不支持元数据缓存
+    # 版本标识必须反映数据库的当前状态, 查询不经过查询缓存
+    def _getSchemaVersion(self):
+        if self._Connector=="sqlite3":
+            if self.SQLite3File in ("", ":memory:"): return None
+            SQLStr = "PRAGMA schema_version"
+        elif self.DBType=="MySQL":# 增删改字段不会改变表的创建时间, 以字段信息的校验和作为版本标识
+            SQLStr = ("SELECT COUNT(*), SUM(CRC32(CONCAT_WS('|', TABLE_NAME, COLUMN_NAME, DATA_TYPE))) FROM information_schema.COLUMNS WHERE table_schema='%s' " % self.DBName)
+            SQLStr += ("AND TABLE_NAME LIKE '%s%%'" % self.InnerPrefix)
+        else:
+            return None
+        return self._fetchSchemaVersion(SQLStr)
+    def _fetchSchemaVersion(self, sql_str):
+        Cursor = self.cursor(sql_str)
+        Rslt = Cursor.fetchone()
+        Cursor.close()
+        return tuple(Rslt)
+    # 从数据库中读取因子表和字段信息
+    def _reflectMeta(self):
         nPrefix = len(self.InnerPrefix)
         if self._Connector=="sqlite3":
             SQLStr = "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '%s%%' ORDER BY name"
@@ -754,7 +805,9 @@ class SQLDB(QSSQLObject, WritableFactorDB):
             else:
                 SQLStr += ") "
             SQLStr += "ORDER BY TABLE_NAME, COLUMN_NAME"
-            Rslt = self.fetchall(SQLStr)
+            Cursor = self.cursor(SQLStr)# 结构信息不经过查询缓存
+            Rslt = Cursor.fetchall()
+            Cursor.close()
             if not Rslt:
                 self._TableFieldDataType = {}
                 self._TableFactorDict = {}
@@ -770,6 +823,59 @@ class SQLDB(QSSQLObject, WritableFactorDB):
     @property
     def TableNames(self):
         return sorted(self._TableFactorDict)
+    def fetchall(self, sql_str):
+        if self.ExplainQuery and re.match(r"\s*SELECT\b", sql_str, flags=re.IGNORECASE):
+            try:
+                Plan = self.explainQuery(sql_str)
+            except Exception as e:
+                self._QS_Logger.warning("'%s' 调用方法 explainQuery 分析查询计划时错误: %s" % (self.Name, str(e)))
+            else:
+                self._QS_Logger.info("'%s' 查询计划:\n%s\n%s" % (self.Name, sql_str, Plan.to_string()))
+        return super().fetchall(sql_str)
+    # 返回 SQL 查询语句的执行计划, 可以从中查看查询使用的索引
+    def explainQuery(self, sql_str):
+        if self.DBType=="sqlite3":
+            Rslt = pd.DataFrame(super().fetchall("EXPLAIN QUERY PLAN "+sql_str))
+            if Rslt.shape[1]==4: Rslt.columns = ["id", "parent", "notused", "detail"]
+            return Rslt
+        elif self.DBType=="MySQL":
+            Cursor = self.cursor("EXPLAIN "+sql_str)
+            Rslt = pd.DataFrame(Cursor.fetchall(), columns=[iDescription[0] for iDescription in Cursor.description])
+            Cursor.close()
+            return Rslt
+        else:
+            Msg = ("因子库 '%s' 调用方法 explainQuery 错误: 不支持的数据库类型 '%s'" % (self.Name, self.DBType))
+            self._QS_Logger.error(Msg)
+            raise __QS_Error__(Msg)
+    # 返回表的索引信息, {索引名: [字段名]}
+    def _getTableIndex(self, table_name):
+        DBTableName = self.TablePrefix+self.InnerPrefix+table_name
+        Indexes = OrderedDict()
+        if self.DBType=="sqlite3":
+            Cursor = self.cursor("PRAGMA index_list([%s])" % DBTableName)
+            IndexNames = [iRslt[1] for iRslt in Cursor.fetchall()]
+            for iIndexName in IndexNames:
+                Cursor.execute("PRAGMA index_info([%s])" % iIndexName)
+                Indexes[iIndexName] = [iRslt[2] for iRslt in sorted(Cursor.fetchall())]
+            Cursor.close()
+        elif self.DBType=="MySQL":
+            for iRslt in self.fetchall("SHOW INDEX FROM "+DBTableName):
+                Indexes.setdefault(iRslt[2], []).append((iRslt[3], iRslt[4]))
+            Indexes = OrderedDict((iIndexName, [iField for _, iField in sorted(iFields)]) for iIndexName, iFields in Indexes.items())
+        return Indexes
+    # 检查表的复合索引, 缺失时创建: (datetime, code) 服务于按时点读取, (code, datetime) 服务于按 ID 读取
+    def checkIndex(self, table_name=None):
+        TableNames = (self.TableNames if table_name is None else [table_name])
+        for iTableName in TableNames:
+            iIndexes = self._getTableIndex(iTableName)
+            for jFields in (["datetime", "code"], ["code", "datetime"]):
+                if any(iFields[:len(jFields)]==jFields for iFields in iIndexes.values()): continue
+                jIndexName = self.InnerPrefix+iTableName+"_"+"_".join(jFields)
+                try:
+                    self.addIndex(jIndexName, self.InnerPrefix+iTableName, fields=jFields, index_type=("BTREE" if self.DBType=="MySQL" else None))
+                except Exception as e:
+                    self._QS_Logger.warning("'%s' 调用方法 checkIndex 为表 '%s' 创建索引时错误: %s" % (self.Name, iTableName, str(e)))
+        return 0
     def getTable(self, table_name, args={}):
         if table_name not in self._TableFactorDict:
             Msg = ("因子库 '%s' 调用方法 getTable 错误: 不存在因子表: '%s'!" % (self.Name, table_name))
@@ -810,7 +916,7 @@ class SQLDB(QSSQLObject, WritableFactorDB):
         elif self.DBType=="sqlite3":
             FieldTypes["datetime"] = field_types.pop("datetime", "text NOT NULL")
             FieldTypes["code"] = field_types.pop("code", "text NOT NULL")
-        self.createDBTable(self.InnerPrefix+table_name, FieldTypes, primary_keys=["datetime", "code"], index_fields=["datetime", "code"])
+        self.createDBTable(self.InnerPrefix+table_name, FieldTypes, primary_keys=["datetime", "code"], index_fields=["code", "datetime"], without_rowid=self.WithoutRowID)
         self._TableFactorDict[table_name] = pd.Series({iFactorName: ("string" if field_types[iFactorName].find("char")!=-1 else "double") for iFactorName in field_types})
         self._TableFieldDataType[table_name] = pd.Series(field_types)
         return 0
@@ -841,6 +947,7 @@ class SQLDB(QSSQLObject, WritableFactorDB):
         self.renameField(self.InnerPrefix+table_name, old_factor_name, new_factor_name)
         self._TableFactorDict[table_name][new_factor_name] = self._TableFactorDict[table_name].pop(old_factor_name)
         self._TableFieldDataType[table_name][new_factor_name] = self._TableFieldDataType[table_name].pop(old_factor_name)
+        if self.DBType=="sqlite3": self.checkIndex(table_name)# sqlite3 通过重建表修改字段, 需要重新检查索引
         return 0
     def deleteFactor(self, table_name, factor_names):
         if not factor_names: return 0
@@ -849,6 +956,29 @@ class SQLDB(QSSQLObject, WritableFactorDB):
         self.deleteField(self.InnerPrefix+table_name, factor_names)
         self._TableFactorDict[table_name] = self._TableFactorDict[table_name][FactorIndex]
         self._TableFieldDataType[table_name] = self._TableFieldDataType[table_name][FactorIndex]
+        if self.DBType=="sqlite3": self.checkIndex(table_name)# sqlite3 通过重建表删除字段, 需要重新检查索引
+        return 0
+    # 优化数据: 检查索引, 更新查询优化器的统计信息, 整理数据库文件
+    def optimizeData(self, table_name, factor_names=None):
+        if table_name not in self._TableFactorDict:
+            Msg = ("因子库 '%s' 调用方法 optimizeData 错误: 不存在因子表 '%s'!" % (self.Name, table_name))
+            self._QS_Logger.error(Msg)
+            raise __QS_Error__(Msg)
+        self.checkIndex(table_name)
+        DBTableName = self.TablePrefix+self.InnerPrefix+table_name
+        try:
+            if self.DBType=="sqlite3":
+                self.execute("ANALYZE "+DBTableName)
+                self.execute("VACUUM")
+            elif self.DBType=="MySQL":
+                self.fetchall("ANALYZE TABLE "+DBTableName)
+                self.fetchall("OPTIMIZE TABLE "+DBTableName)
+        except Exception as e:
+            Msg = ("'%s' 调用方法 optimizeData 优化表 '%s' 时错误: %s" % (self.Name, table_name, str(e)))
+            self._QS_Logger.error(Msg)
+            raise e
+        else:
+            self._QS_Logger.info("'%s' 调用方法 optimizeData 优化表 '%s'" % (self.Name, table_name))
         return 0
     def deleteData(self, table_name, ids=None, dts=None, dt_ids=None):
         if table_name not in self._TableFactorDict:
@@ -957,4 +1087,5 @@ class SQLDB(QSSQLObject, WritableFactorDB):
             Cursor.executemany(SQLStr, NewData.reset_index().values.tolist())
         self.Connection.commit()
         Cursor.close()
+        self.invalidateQueryCache()
         return 0
\ No newline at end of file
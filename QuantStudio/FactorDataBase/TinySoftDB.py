@@ -12,7 +12,7 @@ from traits.api import Str, Range, Directory, File, Password, Either, Int, Enum,
 from QuantStudio import __QS_Error__, __QS_LibPath__, __QS_MainPath__, __QS_ConfigPath__
 from QuantStudio.Tools.DateTimeFun import getDateTimeSeries
 from QuantStudio.FactorDataBase.FactorDB import FactorDB, FactorTable
-from QuantStudio.FactorDataBase.FDBFun import updateInfo, SQL_Table, SQL_WideTable, SQL_FeatureTable, SQL_MappingTable
+from QuantStudio.FactorDataBase.FDBFun import updateInfo, APICacheProxy, SQL_Table, SQL_WideTable, SQL_FeatureTable, SQL_MappingTable
 
 def _adjustID(ids):
     return pd.Series(ids, index=["".join(reversed(iID.split("."))) for iID in ids])
@@ -414,8 +414,11 @@ class TinySoftDB(FactorDB):
     Port = Range(low=0, high=65535, value=443, arg_type="Integer", label="端口", order=2)
     User = Str("", arg_type="String", label="用户名", order=3)
     Pwd = Password("", arg_type="String", label="密码", order=4)
+    CacheMode = Enum("在线", "记录", "回放", arg_type="SingleOption", label="缓存模式", order=5)
+    CacheDir = Directory(label="缓存目录", arg_type="Directory", order=6)
     DBInfoFile = File(label="库信息文件", arg_type="File", order=100)
     FTArgs = Dict(label="因子表参数", arg_type="Dict", order=101)
+    _TSLLocalFuns = ("DecodeDate", "DecodeDateTime", "EncodeDate", "EncodeDateTime")# TSLPy3 中不访问服务器的函数, 不经过缓存
     def __init__(self, sys_args={}, config_file=None, **kwargs):
         super().__init__(sys_args=sys_args, config_file=(__QS_ConfigPath__+os.sep+"TinySoftDBConfig.json" if config_file is None else config_file), **kwargs)
         self.Name = "TinySoftDB"
@@ -438,6 +441,9 @@ class TinySoftDB(FactorDB):
         if not (os.path.isdir(self.InstallDir)): raise __QS_Error__("TinySoft 的安装目录设置有误!")
         elif self.InstallDir not in sys.path: sys.path.append(self.InstallDir)
         import TSLPy3
+        if self.CacheMode=="回放":# 回放模式下不连接服务器, 只使用 TSLPy3 中的本地日期编解码函数
+            self._TSLPy = APICacheProxy(TSLPy3, self.CacheDir, mode="回放", passthrough=self._TSLLocalFuns)
+            return 0
         self._TSLPy = TSLPy3
         ErrorCode = self._TSLPy.ConnectServer(self.IPAddr, int(self.Port))
         if ErrorCode!=0:
@@ -451,13 +457,14 @@ class TinySoftDB(FactorDB):
                 raise __QS_Error__("TinySoft 登录失败: "+Msg)
         else:
             raise __QS_Error__("TinySoft 登录失败!")
+        if self.CacheMode=="记录": self._TSLPy = APICacheProxy(self._TSLPy, self.CacheDir, mode="记录", passthrough=self._TSLLocalFuns+("Disconnect", "Logined"))
         return 0
     def disconnect(self):
-        self._TSLPy.Disconnect()
+        if self.CacheMode!="回放": self._TSLPy.Disconnect()
         self._TSLPy = None
     def isAvailable(self):
         if self._TSLPy is not None:
-            return self._TSLPy.Logined()
+            return (self.CacheMode=="回放") or self._TSLPy.Logined()
         else:
             return False
     def fetchall(self, tsl_str, sys_param={}):
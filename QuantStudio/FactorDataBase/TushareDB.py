@@ -7,13 +7,13 @@ import datetime as dt
 import numpy as np
 import pandas as pd
 import tushare as ts
-from traits.api import Enum, Int, Str, Function
+from traits.api import Enum, Int, Str, Function, Directory
 
 from QuantStudio.Tools.DataPreprocessingFun import fillNaByLookback
 from QuantStudio.Tools.MathFun import CartesianProduct
 from QuantStudio import __QS_Error__, __QS_LibPath__, __QS_MainPath__, __QS_ConfigPath__
 from QuantStudio.FactorDataBase.FactorDB import FactorDB, FactorTable
-from QuantStudio.FactorDataBase.FDBFun import updateInfo
+from QuantStudio.FactorDataBase.FDBFun import updateInfo, APICacheProxy
 
 class _TSTable(FactorTable):
     def getMetaData(self, key=None, args={}):
@@ -381,6 +381,8 @@ class _AnnTable(_TSTable):
 class TushareDB(FactorDB):
     """tushare"""
     Token = Str("", label="Token", arg_type="String", order=0)
+    CacheMode = Enum("在线", "记录", "回放", arg_type="SingleOption", label="缓存模式", order=1)
+    CacheDir = Directory(label="缓存目录", arg_type="Directory", order=2)
     def __init__(self, sys_args={}, config_file=None, **kwargs):
         super().__init__(sys_args=sys_args, config_file=(__QS_ConfigPath__+os.sep+"TushareDBConfig.json" if config_file is None else config_file), **kwargs)
         self.Name = "TushareDB"
@@ -389,8 +391,12 @@ class TushareDB(FactorDB):
         self._InfoResourcePath = __QS_MainPath__+os.sep+"Resource"+os.sep+"TushareDBInfo.xlsx"# 数据库信息源文件路径
         self._TableInfo, self._FactorInfo = updateInfo(self._InfoFilePath, self._InfoResourcePath, self._QS_Logger)
     def connect(self):
+        if self.CacheMode=="回放":
+            self._ts = APICacheProxy(None, self.CacheDir, mode="回放")
+            return 0
         ts.set_token(self.Token)
         self._ts = ts.pro_api()
+        if self.CacheMode=="记录": self._ts = APICacheProxy(self._ts, self.CacheDir, mode="记录")
         return 0
     def disconnect(self):
         self._ts = None
@@ -3,6 +3,7 @@
 import re
 import os
 import shelve
+import hashlib
 import datetime as dt
 
 import numpy as np
@@ -16,7 +17,7 @@ from QuantStudio.Tools.FileFun import getShelveFileSuffix
 from QuantStudio.Tools.QSObjects import QSSQLObject
 from QuantStudio import __QS_Object__, __QS_Error__, __QS_LibPath__, __QS_MainPath__, __QS_ConfigPath__
 from QuantStudio.FactorDataBase.FactorDB import FactorDB, FactorTable
-from QuantStudio.FactorDataBase.FDBFun import updateInfo, adjustDateTime, adjustDataDTID
+from QuantStudio.FactorDataBase.FDBFun import updateInfo, adjustDateTime, adjustDataDTID, expandInterval, calcAnalystConsensus
 
 def RollBackNPeriod(report_date, n_period):
     Date = report_date
@@ -295,6 +296,14 @@ class _MarketTable(_DBTable):
             StartInd = operation_mode.DTRuler.index(DateConditionGroup[iDateConditions]["StartDT"])
             Groups.append((self, DateConditionGroup[iDateConditions]["FactorNames"], list(DateConditionGroup[iDateConditions]["RawFactorNames"]), operation_mode.DTRuler[StartInd:EndInd+1], DateConditionGroup[iDateConditions]["args"]))
         return Groups
+    # 生成原始数据的查询键, 查询键相同的请求可以由 readBatchData 合并为一条 SQL 语句, 返回: (查询键, 起始日期, 截止日期)
+    def _genRawDataKey(self, ids, dts, args={}):
+        if type(self).__QS_prepareRawData__ is not _MarketTable.__QS_prepareRawData__: return None
+        LookBack = args.get("回溯天数", self.LookBack)
+        if np.isinf(LookBack): return None
+        Conditions = ";".join([iConditionField+":"+str(args.get(iConditionField, self[iConditionField])) for iConditionField in self._ConditionFields])
+        StartDate = dts[0].date() - dt.timedelta(LookBack)
+        return ((id(self._FactorDB), self.Name, self.DateField, Conditions, tuple(ids)), StartDate, dts[-1].date())
     def __QS_prepareRawData__(self, factor_names, ids, dts, args={}):
         StartDate, EndDate = dts[0].date(), dts[-1].date()
         StartDate -= dt.timedelta(args.get("回溯天数", self.LookBack))
@@ -610,22 +619,21 @@ class _ConstituentTable(_DBTable):
     def __QS_calcData__(self, raw_data, factor_names, ids, dts, args={}):
         StartDate, EndDate = dts[0].date(), dts[-1].date()
         DateSeries = getDateSeries(StartDate, EndDate)
-        Data = {}
-        for iIndexID in factor_names:
-            iRawData = raw_data[raw_data[self._GroupField]==iIndexID].set_index([self._IDField])
-            iData = pd.DataFrame(0, index=DateSeries, columns=pd.unique(iRawData.index))
-            for jID in iData.columns:
-                jIDRawData = iRawData.loc[[jID]]
-                for k in range(jIDRawData.shape[0]):
-                    kStartDate = dt.datetime.strptime(jIDRawData[self._InDateField].iloc[k], "%Y%m%d").date()
-                    kEndDate = (dt.datetime.strptime(jIDRawData[self._OutDateField].iloc[k], "%Y%m%d").date()-dt.timedelta(1) if jIDRawData[self._OutDateField].iloc[k] is not None else dt.date.today())
-                    iData[jID].loc[kStartDate:kEndDate] = 1
-            Data[iIndexID] = iData
-        Data = pd.Panel(Data)
-        if Data.minor_axis.intersection(ids).shape[0]==0: return pd.Panel(0.0, items=factor_names, major_axis=dts, minor_axis=ids)
-        Data = Data.loc[factor_names, :, ids]
-        Data.major_axis = [dt.datetime.combine(iDate, dt.time(0)) for iDate in Data.major_axis]
-        Data.fillna(value=0, inplace=True)
+        Data = np.zeros(shape=(len(factor_names), len(DateSeries), len(ids)))
+        if raw_data.shape[0]>0:
+            FactorIdx = pd.Index(factor_names).get_indexer(raw_data[self._GroupField].values)
+            IDIdx = pd.Index(ids).get_indexer(raw_data[self._IDField].values)
+            Mask = ((FactorIdx>=0) & (IDIdx>=0))
+            # 纳入日期至剔除日期前一日为成份, 剔除日期缺失时至今日为成份
+            Dates = np.array(DateSeries, dtype="datetime64[D]")
+            InDates = pd.to_datetime(raw_data[self._InDateField], format="%Y%m%d").values.astype("datetime64[D]")
+            OutDates = pd.to_datetime(raw_data[self._OutDateField], format="%Y%m%d").values.astype("datetime64[D]")
+            OutDates[np.isnat(OutDates)] = np.datetime64(dt.date.today()+dt.timedelta(1), "D")
+            StartIdx = Dates.searchsorted(InDates, side="left")
+            EndIdx = np.where(Mask, Dates.searchsorted(OutDates, side="left"), StartIdx)
+            RowIdx, DTIdx = expandInterval(StartIdx, EndIdx)
+            Data[FactorIdx[RowIdx], DTIdx, IDIdx[RowIdx]] = 1
+        Data = pd.Panel(Data, items=factor_names, major_axis=[dt.datetime.combine(iDate, dt.time(0)) for iDate in DateSeries], minor_axis=ids)
         return adjustDateTime(Data, dts, fillna=True, method="bfill")
 class _MappingTable(_DBTable):
     """映射因子表"""
@@ -805,51 +813,81 @@ class _IndustryTable(_DBTable):
             StartInd = operation_mode.DTRuler.index(LevelGroup[iLevel]["StartDT"])
             Groups.append((self, LevelGroup[iLevel]["FactorNames"], list(LevelGroup[iLevel]["RawFactorNames"]), operation_mode.DTRuler[StartInd:EndInd+1], LevelGroup[iLevel]["args"]))
         return Groups
-    def __QS_prepareRawData__(self, factor_names, ids, dts, args={}):
-        IndustryLevel = args.get("分类级别", self.Level)
-        # 获取行业代码对应的行业名称
-        SQLStr = "SELECT "+self._SubStrFun+"("+self._FactorDB.TablePrefix+"AShareIndustriesCode.industriescode,1,"+str(2*(IndustryLevel+1))+"), "
+    # 读取完整行业代码的分类记录和各级行业代码对应的名称, 所有分类级别共用, 结果在会话内按行业分类标准缓存
+    # 返回: (DataFrame(columns=["ID", "行业代码", 纳入日期, 剔除日期]), {分类级别: {行业代码: 行业名称}})
+    def _getIndustryData(self, ids, start_date, end_date):
+        DBTableName = self._FactorDB.TablePrefix + self._FactorDB._TableInfo.loc[self.Name, "DBTableName"]
+        CacheKey = (DBTableName, self._IndustryCodeStart)
+        StartDate, EndDate = start_date.strftime("%Y%m%d"), end_date.strftime("%Y%m%d")
+        Cache = self._FactorDB._IndustryCache.get(CacheKey)
+        if Cache is not None:
+            if Cache["IDs"].issuperset(ids) and (Cache["StartDate"]<=StartDate) and (Cache["EndDate"]>=EndDate): return (Cache["RawData"], Cache["CodeName"])
+            ids = sorted(Cache["IDs"].union(ids))
+            StartDate, EndDate = min(Cache["StartDate"], StartDate), max(Cache["EndDate"], EndDate)
+        # 获取各级行业代码对应的行业名称
+        SQLStr = "SELECT "+self._FactorDB.TablePrefix+"AShareIndustriesCode.industriescode, "
+        SQLStr += self._FactorDB.TablePrefix+"AShareIndustriesCode.levelnum, "
         SQLStr += self._FactorDB.TablePrefix+"AShareIndustriesCode.industriesname "
         SQLStr += "FROM "+self._FactorDB.TablePrefix+"AShareIndustriesCode "
         SQLStr += "WHERE "+self._FactorDB.TablePrefix+"AShareIndustriesCode.industriescode LIKE '"+self._IndustryCodeStart+"%' "
-        SQLStr += "AND "+self._FactorDB.TablePrefix+"AShareIndustriesCode.levelnum="+str(IndustryLevel+1)
-        IndustryCodeName = {iCode:iName for iCode, iName in self._FactorDB.fetchall(SQLStr)}
-        StartDate, EndDate = dts[0].date(), dts[-1].date()
-        DBTableName = self._FactorDB.TablePrefix + self._FactorDB._TableInfo.loc[self.Name, "DBTableName"]
+        SQLStr += "AND "+self._FactorDB.TablePrefix+"AShareIndustriesCode.levelnum>1"
+        CodeName = {}
+        for iCode, iLevelNum, iName in self._FactorDB.fetchall(SQLStr):
+            CodeName.setdefault(int(iLevelNum)-1, {})[iCode[:2*int(iLevelNum)]] = iName
         FieldDict = self._FactorDB._FactorInfo["DBFieldName"].loc[self.Name].loc[[self._IDField, self._IndustryCodeField, self._InDateField, self._OutDateField]]
         # ID, 行业分类代码, 纳入日期, 剔除日期
         SQLStr = "SELECT "+DBTableName+"."+FieldDict[self._IDField]+", "
-        SQLStr += self._SubStrFun+"("+DBTableName+"."+FieldDict[self._IndustryCodeField]+",1,"+str(2*(IndustryLevel+1))+"), "
+        SQLStr += DBTableName+"."+FieldDict[self._IndustryCodeField]+", "
         SQLStr += DBTableName+"."+FieldDict[self._InDateField]+", "
         SQLStr += DBTableName+"."+FieldDict[self._OutDateField]+" "
         SQLStr += "FROM "+DBTableName+" "
-        SQLStr += "WHERE "+self._SubStrFun+"("+DBTableName+"."+FieldDict[self._IndustryCodeField]+",1,"+str(2*(IndustryLevel+1))+") IN ('"+"', '".join(IndustryCodeName.keys())+"') "
+        SQLStr += "WHERE "+DBTableName+"."+FieldDict[self._IndustryCodeField]+" LIKE '"+self._IndustryCodeStart+"%' "
         SQLStr += "AND ("+genSQLInCondition(DBTableName+"."+FieldDict[self._IDField], ids, is_str=True, max_num=1000)+") "
-        SQLStr += "AND (("+DBTableName+"."+FieldDict[self._OutDateField]+">'"+StartDate.strftime("%Y%m%d")+"') "
+        SQLStr += "AND (("+DBTableName+"."+FieldDict[self._OutDateField]+">'"+StartDate+"') "
         SQLStr += "OR ("+DBTableName+"."+FieldDict[self._OutDateField]+" IS NULL)) "
-        SQLStr += "AND "+DBTableName+"."+FieldDict[self._InDateField]+"<='"+EndDate.strftime("%Y%m%d")+"' "        
+        SQLStr += "AND "+DBTableName+"."+FieldDict[self._InDateField]+"<='"+EndDate+"' "
         SQLStr += "ORDER BY "+DBTableName+"."+FieldDict[self._IDField]+", "+DBTableName+"."+FieldDict[self._InDateField]
         RawData = self._FactorDB.fetchall(SQLStr)
         if not RawData: RawData = pd.DataFrame(columns=["ID", "行业代码", self._InDateField, self._OutDateField])
-        else: RawData = pd.DataFrame(np.array(RawData), columns=["ID", "行业代码", self._InDateField, self._OutDateField])
-        RawData["行业名称"] = RawData["行业代码"]
-        for iCode, iName in IndustryCodeName.items(): RawData["行业名称"][RawData["行业代码"]==iCode] = iName
-        return RawData
+        else: RawData = pd.DataFrame(np.array(RawData, dtype="O"), columns=["ID", "行业代码", self._InDateField, self._OutDateField])
+        self._FactorDB._IndustryCache[CacheKey] = {"IDs":set(ids), "StartDate":StartDate, "EndDate":EndDate, "RawData":RawData, "CodeName":CodeName}
+        return (RawData, CodeName)
+    def __QS_prepareRawData__(self, factor_names, ids, dts, args={}):
+        IndustryLevel = args.get("分类级别", self.Level)
+        StartDate, EndDate = dts[0].date(), dts[-1].date()
+        RawData, CodeName = self._getIndustryData(ids, StartDate, EndDate)
+        Codes = RawData["行业代码"].str.slice(0, 2*(IndustryLevel+1))
+        Names = Codes.map(CodeName.get(IndustryLevel, {}))
+        OutDates = RawData[self._OutDateField]
+        Mask = (pd.notnull(Names) & RawData["ID"].isin(ids) & (RawData[self._InDateField]<=EndDate.strftime("%Y%m%d")) & (pd.isnull(OutDates) | (OutDates>StartDate.strftime("%Y%m%d"))))
+        RawData = RawData[Mask].copy()
+        RawData["行业代码"], RawData["行业名称"] = Codes[Mask], Names[Mask]
+        return RawData.reset_index(drop=True)
+    # 按 (ID 序号, 纳入日期) 建立排序的区间索引, 对所有时点和 ID 一次性用 searchsorted 查找最近纳入的分类记录
     def __QS_calcData__(self, raw_data, factor_names, ids, dts, args={}):
         if raw_data.shape[0]==0: return pd.Panel(np.full(shape=(len(factor_names), len(dts), len(ids)), fill_value=None, dtype="O"), items=factor_names, major_axis=dts, minor_axis=ids)
-        raw_data[self._OutDateField] = raw_data[self._OutDateField].where(pd.notnull(raw_data[self._OutDateField]), dt.date.today().strftime("%Y%m%d"))
-        raw_data.set_index(["ID"], inplace=True)
-        DeltaDT = dt.timedelta(int(not self._OutDateIncluded))
-        Data, nFactor = {}, len(factor_names)
-        for iID in raw_data.index.unique():
-            iRawData = raw_data.loc[[iID]]
-            iData = pd.DataFrame(index=dts, columns=factor_names, dtype="O")
-            for j in range(iRawData.shape[0]):
-                ijRawData = iRawData.iloc[j]
-                jStartDate, jEndDate = dt.datetime.strptime(ijRawData[self._InDateField], "%Y%m%d"), dt.datetime.strptime(ijRawData[self._OutDateField], "%Y%m%d")-DeltaDT
-                iData.loc[jStartDate:jEndDate] = np.repeat(ijRawData[factor_names].values.reshape((1, nFactor)), iData.loc[jStartDate:jEndDate].shape[0], axis=0)
-            Data[iID] = iData
-        return pd.Panel(Data).swapaxes(0, 2).loc[:, :, ids]
+        OutDates = raw_data[self._OutDateField].where(pd.notnull(raw_data[self._OutDateField]), dt.date.today().strftime("%Y%m%d"))
+        IDIdx = pd.Index(ids).get_indexer(raw_data["ID"])
+        StartDays = pd.to_datetime(raw_data[self._InDateField], format="%Y%m%d").values.astype("datetime64[D]").astype(np.int64)
+        EndDays = pd.to_datetime(OutDates, format="%Y%m%d").values.astype("datetime64[D]").astype(np.int64) - int(not self._OutDateIncluded)
+        DayBase = 10**6
+        Keys = IDIdx.astype(np.int64) * DayBase + StartDays
+        Order = np.argsort(Keys, kind="mergesort")# 纳入日期相同时后出现的记录优先
+        DTs = np.array(dts, dtype="datetime64[us]")
+        DTDays = DTs.astype("datetime64[D]")
+        HasTime = (DTs!=DTDays).reshape((len(dts), 1))
+        DTDays = DTDays.astype(np.int64).reshape((len(dts), 1))
+        Pos = np.searchsorted(Keys[Order], np.arange(len(ids), dtype=np.int64).reshape((1, len(ids))) * DayBase + DTDays, side="right") - 1
+        Mask = (Pos>=0)
+        RowIdx = Order[np.clip(Pos, 0, None)]
+        Mask &= (IDIdx[RowIdx]==np.arange(len(ids)).reshape((1, len(ids))))
+        Mask &= ((DTDays<EndDays[RowIdx]) | ((DTDays==EndDays[RowIdx]) & (~HasTime)))
+        Data = {}
+        for iFactorName in factor_names:
+            iData = raw_data[iFactorName].values.astype("O")[RowIdx]
+            iData[~Mask] = None
+            Data[iFactorName] = pd.DataFrame(iData, index=dts, columns=ids)
+        return pd.Panel(Data).loc[factor_names]
 
 class _FeatureTable(_DBTable):
     """特征因子表"""
@@ -1061,10 +1099,15 @@ class _FinancialTable(_DBTable):
             if CalcType=="最新": CalcFun = self._calcIDData_LR_NPeriod
             elif CalcType=="单季度": CalcFun = self._calcIDData_SQ_NPeriod
             elif CalcType=="TTM": CalcFun = self._calcIDData_TTM_NPeriod
+        # 时点-报告期映射按原始数据分组缓存, 运算模式下同一组原始数据的因子逐个计算时共享, 遇到另一组原始数据时释放
+        GroupKey = (self._genPITGroupKey(raw_data), tuple(Dates), repr(ReportDate))
+        if self._TempData.get("PITMappingKey")!=GroupKey:
+            self._TempData["PITMappingKey"] = GroupKey
+            self._TempData["PITMapping"] = {}
         raw_data = raw_data.set_index(["ID"])
         Data = {}
-        for iID in raw_data.index.unique():
-            Data[iID] = CalcFun(Dates, raw_data.loc[[iID]], factor_names, ReportDate, YearLookBack, PeriodLookBack, IgnoreMissing)
+        for iID, iRawData in raw_data.groupby(level=0, sort=False):
+            Data[iID] = CalcFun(Dates, iRawData.copy(), factor_names, ReportDate, YearLookBack, PeriodLookBack, IgnoreMissing)
         Data = pd.Panel(Data)
         Data.major_axis = [dt.datetime.strptime(iDate, "%Y%m%d") for iDate in Dates]
         Data.minor_axis = factor_names
@@ -1150,117 +1193,119 @@ class _FinancialTable(_DBTable):
                     MaxReportDateInd = MaxNoteDateInd-i
                     Changed = True
         return (MaxReportDateInd, Changed)
+    # 原始数据分组的标识, 由 ID, 公告日期和报告期三列的内容决定, 不同因子的原始数据只要这三列相同即共享时点-报告期映射
+    def _genPITGroupKey(self, raw_data):
+        KeyData = pd.util.hash_pandas_object(raw_data[["ID", "AnnDate", "ReportDate"]], index=False).values
+        return (KeyData.shape[0], hashlib.sha1(KeyData.tobytes()).hexdigest())
+    # 生成单个 ID 的时点-报告期映射: (每个时点可见的最大公告位置, 最大报告期位置, 最大报告期是否变化, {报告期: 行位置})
+    # 映射只依赖于公告日期和报告期, 在 __QS_calcData__ 设定的原始数据分组内按 ID 缓存
+    def _getPITMapping(self, date_seq, raw_data, report_date):
+        IDKey = raw_data.index[0]
+        Mapping = self._TempData["PITMapping"].get(IDKey)
+        if Mapping is not None: return Mapping
+        AnnDates, ReportDates = raw_data["AnnDate"].values, raw_data["ReportDate"].values
+        NoteInds = np.searchsorted(AnnDates, date_seq, side="right") - 1
+        MaxReportDateInds, ChangedMask = np.full(shape=(len(date_seq),), fill_value=-1, dtype=np.int64), np.full(shape=(len(date_seq),), fill_value=False)
+        tempInd, MaxReportDateInd = -1, -1
+        for i, iDate in enumerate(date_seq):
+            tempPreInd, tempInd = tempInd, NoteInds[i]
+            MaxReportDateInd, ChangedMask[i] = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            MaxReportDateInds[i] = MaxReportDateInd
+        self._TempData.pop("LastTargetReportDate", None)
+        self._TempData.pop("LastTargetReportInd", None)
+        ReportRows = pd.Series(np.arange(ReportDates.shape[0])).groupby(ReportDates).indices
+        Mapping = self._TempData["PITMapping"][IDKey] = (NoteInds, MaxReportDateInds, ChangedMask, ReportRows)
+        return Mapping
+    # 提取截止到公告位置 note_ind 时报告期 report_date 的最新数据, 返回: array(shape=(0 或 1, 因子数))
+    def _getReportData(self, factor_data, report_rows, report_date, note_ind, fillna_method):
+        Rows = report_rows.get(report_date, np.array([], dtype=np.int64))
+        Rows = Rows[:np.searchsorted(Rows, note_ind, side="right")]
+        if Rows.shape[0]==0: return np.empty(shape=(0, factor_data.shape[1]))
+        if fillna_method=="bfill": return factor_data.iloc[Rows[-1:]].values# 最后一行之后没有数据可供向后填充
+        return factor_data.iloc[Rows].fillna(method=fillna_method).values[-1:]
     def _calcIDData_LR(self, date_seq, raw_data, factor_names, report_date, year_lookback, period_lookback, ignore_missing):
         StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan, dtype="O")
         FillnaMethod = ("pad" if ignore_missing else "bfill")
-        tempInd = -1# 指向目前看到的最大的公告期
-        tempLen = raw_data.shape[0]
-        MaxReportDateInd = -1# 指向目前看到的最大的报告期
+        NoteInds, MaxReportDateInds, ChangedMask, ReportRows = self._getPITMapping(date_seq, raw_data, report_date)
+        FactorData = raw_data[factor_names]
         for i, iDate in enumerate(date_seq):
-            tempPreInd = tempInd# 指向先前的最大公告期
-            while (tempInd<tempLen-1) and (iDate>=raw_data['AnnDate'].iloc[tempInd+1]): tempInd = tempInd+1
-            MaxReportDateInd, Changed = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            tempInd, MaxReportDateInd, Changed = NoteInds[i], MaxReportDateInds[i], ChangedMask[i]
             if not Changed:# 最大报告期没有变化
                 if MaxReportDateInd>=0: StdData[i] = StdData[i-1]
                 continue
             MaxReportDate = raw_data['ReportDate'].iloc[MaxReportDateInd]# 当前最大报告期
-            iRawData = raw_data.iloc[:tempInd+1]
-            StdData[i] = iRawData[iRawData["ReportDate"]==MaxReportDate][factor_names].fillna(method=FillnaMethod).values[-1]
-        self._TempData.pop("LastTargetReportDate", None)
-        self._TempData.pop("LastTargetReportInd", None)
+            StdData[i] = self._getReportData(FactorData, ReportRows, MaxReportDate, tempInd, FillnaMethod)[-1]
         return StdData
     def _calcIDData_SQ(self, date_seq, raw_data, factor_names, report_date, year_lookback, period_lookback, ignore_missing):
         StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
         FillnaMethod = ("pad" if ignore_missing else "bfill")
         raw_data[factor_names] = raw_data[factor_names].astype("float")
-        tempInd = -1# 指向目前看到的最大的公告期
-        tempLen = raw_data.shape[0]
-        MaxReportDateInd = -1# 指向目前看到的最大的报告期
+        NoteInds, MaxReportDateInds, ChangedMask, ReportRows = self._getPITMapping(date_seq, raw_data, report_date)
+        FactorData = raw_data[factor_names]
         for i, iDate in enumerate(date_seq):
-            tempPreInd = tempInd# 指向先前的最大公告期
-            while (tempInd<tempLen-1) and (iDate>=raw_data['AnnDate'].iloc[tempInd+1]): tempInd = tempInd+1
-            MaxReportDateInd, Changed = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            tempInd, MaxReportDateInd, Changed = NoteInds[i], MaxReportDateInds[i], ChangedMask[i]
             if not Changed:
                 if MaxReportDateInd>=0: StdData[i] = StdData[i-1]
                 continue
             MaxReportDate = raw_data['ReportDate'].iloc[MaxReportDateInd]# 当前最大报告期
-            iRawData = raw_data.iloc[:tempInd+1]
             if MaxReportDate[-4:]=="1231": iPreReportDate = MaxReportDate[0:4]+"0930"
             elif MaxReportDate[-4:]=="0930": iPreReportDate = MaxReportDate[0:4]+"0630"
             elif MaxReportDate[-4:]=="0630": iPreReportDate = MaxReportDate[0:4]+"0331"
             else:
-                StdData[i] = iRawData[iRawData["ReportDate"]==MaxReportDate][factor_names].fillna(method=FillnaMethod).values[-1]
+                StdData[i] = self._getReportData(FactorData, ReportRows, MaxReportDate, tempInd, FillnaMethod)[-1]
                 continue
-            iPreReportData = iRawData[iRawData["ReportDate"]==iPreReportDate][factor_names].fillna(method=FillnaMethod).values# 前一个报告期数据
+            iPreReportData = self._getReportData(FactorData, ReportRows, iPreReportDate, tempInd, FillnaMethod)# 前一个报告期数据
             if iPreReportData.shape[0]==0: continue
-            StdData[i] = iRawData[iRawData["ReportDate"]==MaxReportDate][factor_names].fillna(method=FillnaMethod).values[-1] - iPreReportData[-1]
-        self._TempData.pop("LastTargetReportDate", None)
-        self._TempData.pop("LastTargetReportInd", None)
+            StdData[i] = self._getReportData(FactorData, ReportRows, MaxReportDate, tempInd, FillnaMethod)[-1] - iPreReportData[-1]
         return StdData
     def _calcIDData_TTM(self, date_seq, raw_data, factor_names, report_date, year_lookback, period_lookback, ignore_missing):
         StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
         FillnaMethod = ("pad" if ignore_missing else "bfill")
         raw_data[factor_names] = raw_data[factor_names].astype("float")
-        tempInd = -1# 指向目前看到的最大的公告期
-        tempLen = raw_data.shape[0]
-        MaxReportDateInd = -1# 指向目前看到的最大的报告期
+        NoteInds, MaxReportDateInds, ChangedMask, ReportRows = self._getPITMapping(date_seq, raw_data, report_date)
+        FactorData = raw_data[factor_names]
         for i, iDate in enumerate(date_seq):
-            tempPreInd = tempInd# 指向先前的最大公告期
-            while (tempInd<tempLen-1) and (iDate>=raw_data['AnnDate'].iloc[tempInd+1]): tempInd = tempInd+1
-            MaxReportDateInd, Changed = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            tempInd, MaxReportDateInd, Changed = NoteInds[i], MaxReportDateInds[i], ChangedMask[i]
             if not Changed:
                 if MaxReportDateInd>=0: StdData[i] = StdData[i-1]
                 continue
             MaxReportDate = raw_data['ReportDate'].iloc[MaxReportDateInd]# 当前最大报告期
-            iRawData = raw_data.iloc[:tempInd+1]
             if MaxReportDate[-4:]=='1231':# 最新财报为年报
-                StdData[i] = iRawData[iRawData["ReportDate"]==MaxReportDate][factor_names].fillna(method=FillnaMethod).values[-1]
+                StdData[i] = self._getReportData(FactorData, ReportRows, MaxReportDate, tempInd, FillnaMethod)[-1]
             else:
                 iLastYear = str(int(MaxReportDate[0:4])-1)
-                iPreYearReport = iRawData[iRawData["ReportDate"]==iLastYear+"1231"][factor_names].fillna(method=FillnaMethod).values# 去年年报数据
-                iPreReportData = iRawData[iRawData["ReportDate"]==iLastYear+MaxReportDate[-4:]][factor_names].fillna(method=FillnaMethod).values# 去年同期数据
+                iPreYearReport = self._getReportData(FactorData, ReportRows, iLastYear+"1231", tempInd, FillnaMethod)# 去年年报数据
+                iPreReportData = self._getReportData(FactorData, ReportRows, iLastYear+MaxReportDate[-4:], tempInd, FillnaMethod)# 去年同期数据
                 if (iPreReportData.shape[0]==0) or (iPreYearReport.shape[0]==0): continue
-                StdData[i] = iRawData[iRawData["ReportDate"]==MaxReportDate][factor_names].fillna(method=FillnaMethod).values[-1] + iPreYearReport[-1] - iPreReportData[-1]
-        self._TempData.pop("LastTargetReportDate", None)
-        self._TempData.pop("LastTargetReportInd", None)
+                StdData[i] = self._getReportData(FactorData, ReportRows, MaxReportDate, tempInd, FillnaMethod)[-1] + iPreYearReport[-1] - iPreReportData[-1]
         return StdData
     def _calcIDData_LR_NYear(self, date_seq, raw_data, factor_names, report_date, year_lookback, period_lookback, ignore_missing):
         StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan, dtype="O")
         FillnaMethod = ("pad" if ignore_missing else "bfill")
-        tempInd = -1# 指向目前看到的最大的公告期
-        tempLen = raw_data.shape[0]
-        MaxReportDateInd = -1# 指向目前看到的最大的报告期
+        NoteInds, MaxReportDateInds, ChangedMask, ReportRows = self._getPITMapping(date_seq, raw_data, report_date)
+        FactorData = raw_data[factor_names]
         for i, iDate in enumerate(date_seq):
-            tempPreInd = tempInd# 指向先前的最大公告期
-            while (tempInd<tempLen-1) and (iDate>=raw_data['AnnDate'].iloc[tempInd+1]): tempInd = tempInd+1
-            MaxReportDateInd, Changed = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            tempInd, MaxReportDateInd, Changed = NoteInds[i], MaxReportDateInds[i], ChangedMask[i]
             if not Changed:
                 if MaxReportDateInd>=0: StdData[i] = StdData[i-1]
                 continue
             MaxReportDate = raw_data['ReportDate'].iloc[MaxReportDateInd]# 当前最大报告期
             iLastNYear = str(int(MaxReportDate[0:4])-year_lookback)
-            iRawData = raw_data.iloc[:tempInd+1]
-            iPreData = iRawData[iRawData["ReportDate"]==iLastNYear+MaxReportDate[-4:]][factor_names].fillna(method=FillnaMethod).values
+            iPreData = self._getReportData(FactorData, ReportRows, iLastNYear+MaxReportDate[-4:], tempInd, FillnaMethod)
             if iPreData.shape[0]>0: StdData[i] = iPreData[-1]
-        self._TempData.pop("LastTargetReportDate", None)
-        self._TempData.pop("LastTargetReportInd", None)
         return StdData
     def _calcIDData_SQ_NYear(self, date_seq, raw_data, factor_names, report_date, year_lookback, period_lookback, ignore_missing):
         StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
         FillnaMethod = ("pad" if ignore_missing else "bfill")
         raw_data[factor_names] = raw_data[factor_names].astype("float")
-        tempInd = -1# 指向目前看到的最大的公告期
-        tempLen = raw_data.shape[0]
-        MaxReportDateInd = -1# 指向目前看到的最大的报告期
+        NoteInds, MaxReportDateInds, ChangedMask, ReportRows = self._getPITMapping(date_seq, raw_data, report_date)
+        FactorData = raw_data[factor_names]
         for i, iDate in enumerate(date_seq):
-            tempPreInd = tempInd# 指向先前的最大公告期
-            while (tempInd<tempLen-1) and (iDate>=raw_data['AnnDate'].iloc[tempInd+1]): tempInd = tempInd+1
-            MaxReportDateInd, Changed = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            tempInd, MaxReportDateInd, Changed = NoteInds[i], MaxReportDateInds[i], ChangedMask[i]
             if not Changed:
                 if MaxReportDateInd>=0: StdData[i] = StdData[i-1]
             MaxReportDate = raw_data['ReportDate'].iloc[MaxReportDateInd]# 当前最大报告期
             iLastNYear = str(int(MaxReportDate[0:4])-year_lookback)
-            iRawData = raw_data.iloc[:tempInd+1]
             if MaxReportDate[-4:]=="1231":
                 iPreReportDate1 = iLastNYear+"1231"
                 iPreReportDate2 = iLastNYear+"0930"
@@ -1271,82 +1316,64 @@ class _FinancialTable(_DBTable):
                 iPreReportDate1 = iLastNYear+"0630"
                 iPreReportDate2 = iLastNYear+"0331"
             else:
-                iPreReportData1 = iRawData[iRawData["ReportDate"]==iLastNYear+"0331"][factor_names].fillna(method=FillnaMethod).values
+                iPreReportData1 = self._getReportData(FactorData, ReportRows, iLastNYear+"0331", tempInd, FillnaMethod)
                 if iPreReportData1.shape[0]>0: StdData[i] = iPreReportData1[-1]
                 continue
-            iPreReportData1 = iRawData[iRawData["ReportDate"]==iPreReportDate1][factor_names].fillna(method=FillnaMethod).values# 上N年同期财报数据
-            iPreReportData2 = iRawData[iRawData["ReportDate"]==iPreReportDate2][factor_names].fillna(method=FillnaMethod).values# 上N年同期的上一期财报数据
+            iPreReportData1 = self._getReportData(FactorData, ReportRows, iPreReportDate1, tempInd, FillnaMethod)# 上N年同期财报数据
+            iPreReportData2 = self._getReportData(FactorData, ReportRows, iPreReportDate2, tempInd, FillnaMethod)# 上N年同期的上一期财报数据
             if (iPreReportData1.shape[0]==0) or (iPreReportData2.shape[0]==0): continue
             StdData[i] = iPreReportData1[-1] - iPreReportData2[-1]
-        self._TempData.pop("LastTargetReportDate", None)
-        self._TempData.pop("LastTargetReportInd", None)
         return StdData
     def _calcIDData_TTM_NYear(self, date_seq, raw_data, factor_names, report_date, year_lookback, period_lookback, ignore_missing):
         StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
         FillnaMethod = ("pad" if ignore_missing else "bfill")
         raw_data[factor_names] = raw_data[factor_names].astype("float")
-        tempInd = -1# 指向目前看到的最大的公告期
-        tempLen = raw_data.shape[0]
-        MaxReportDateInd = -1# 指向目前看到的最大的报告期
+        NoteInds, MaxReportDateInds, ChangedMask, ReportRows = self._getPITMapping(date_seq, raw_data, report_date)
+        FactorData = raw_data[factor_names]
         for i, iDate in enumerate(date_seq):
-            tempPreInd = tempInd# 指向先前的最大公告期
-            while (tempInd<tempLen-1) and (iDate>=raw_data['AnnDate'].iloc[tempInd+1]): tempInd = tempInd+1
-            MaxReportDateInd, Changed = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            tempInd, MaxReportDateInd, Changed = NoteInds[i], MaxReportDateInds[i], ChangedMask[i]
             if not Changed:
                 if MaxReportDateInd>=0: StdData[i] = StdData[i-1]
                 continue
             MaxReportDate = raw_data['ReportDate'].iloc[MaxReportDateInd]# 当前最大报告期
             iLastNYear = int(MaxReportDate[0:4])-year_lookback
-            iRawData = raw_data.iloc[:tempInd+1]
             if MaxReportDate[-4:]=="1231":# 最新财报为年报
-                iPreNReportData = iRawData[iRawData["ReportDate"]==str(iLastNYear)+"1231"][factor_names].fillna(method=FillnaMethod).values
+                iPreNReportData = self._getReportData(FactorData, ReportRows, str(iLastNYear)+"1231", tempInd, FillnaMethod)
                 if iPreNReportData.shape[0]>0: StdData[i] = iPreNReportData[-1]
                 continue
-            iPreNReportData = iRawData[iRawData["ReportDate"]==str(iLastNYear)+MaxReportDate[-4:]][factor_names].fillna(method=FillnaMethod).values# 上N年同期数据
-            iPreN_1YearReportData = iRawData[iRawData["ReportDate"]==str(iLastNYear-1)+"1231"][factor_names].fillna(method=FillnaMethod).values# 上N+1年年报数据
-            iPreN_1ReportData = iRawData[iRawData["ReportDate"]==str(iLastNYear-1)+MaxReportDate[-4:]][factor_names].fillna(method=FillnaMethod).values# 上N+1年同期数据
+            iPreNReportData = self._getReportData(FactorData, ReportRows, str(iLastNYear)+MaxReportDate[-4:], tempInd, FillnaMethod)# 上N年同期数据
+            iPreN_1YearReportData = self._getReportData(FactorData, ReportRows, str(iLastNYear-1)+"1231", tempInd, FillnaMethod)# 上N+1年年报数据
+            iPreN_1ReportData = self._getReportData(FactorData, ReportRows, str(iLastNYear-1)+MaxReportDate[-4:], tempInd, FillnaMethod)# 上N+1年同期数据
             if (iPreNReportData.shape[0]==0) or (iPreN_1YearReportData.shape[0]==0) or (iPreN_1ReportData.shape[0]==0): continue
             StdData[i] = iPreNReportData[-1] + iPreN_1YearReportData[-1] - iPreN_1ReportData[-1]
-        self._TempData.pop("LastTargetReportDate", None)
-        self._TempData.pop("LastTargetReportInd", None)
         return StdData
     def _calcIDData_LR_NPeriod(self, date_seq, raw_data, factor_names, report_date, year_lookback, period_lookback, ignore_missing):
         StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan, dtype="O")
         FillnaMethod = ("pad" if ignore_missing else "bfill")
-        tempInd = -1# 指向目前看到的最大的公告期
-        tempLen = raw_data.shape[0]
-        MaxReportDateInd = -1# 指向目前看到的最大的报告期
+        NoteInds, MaxReportDateInds, ChangedMask, ReportRows = self._getPITMapping(date_seq, raw_data, report_date)
+        FactorData = raw_data[factor_names]
         for i, iDate in enumerate(date_seq):
-            tempPreInd = tempInd# 指向先前的最大公告期
-            while (tempInd<tempLen-1) and (iDate>=raw_data['AnnDate'].iloc[tempInd+1]): tempInd = tempInd+1
-            MaxReportDateInd, Changed = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            tempInd, MaxReportDateInd, Changed = NoteInds[i], MaxReportDateInds[i], ChangedMask[i]
             if not Changed:
                 if MaxReportDateInd>=0: StdData[i] = StdData[i-1]
             MaxReportDate = raw_data['ReportDate'].iloc[MaxReportDateInd]# 当前最大报告期
-            iRawData = raw_data.iloc[:tempInd+1]
             ObjectReportDate = RollBackNPeriod(MaxReportDate, period_lookback)
-            iPreData = iRawData[iRawData["ReportDate"]==ObjectReportDate][factor_names].fillna(method=FillnaMethod).values
+            iPreData = self._getReportData(FactorData, ReportRows, ObjectReportDate, tempInd, FillnaMethod)
             if iPreData.shape[0]>0: StdData[i] = iPreData[-1]
-        self._TempData.pop("LastTargetReportDate", None)
-        self._TempData.pop("LastTargetReportInd", None)
         return StdData
     def _calcIDData_SQ_NPeriod(self, date_seq, raw_data, factor_names, report_date, year_lookback, period_lookback, ignore_missing):
         StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
         FillnaMethod = ("pad" if ignore_missing else "bfill")
         raw_data[factor_names] = raw_data[factor_names].astype("float")
-        tempInd = -1# 指向目前看到的最大的公告期
-        tempLen = raw_data.shape[0]
-        MaxReportDateInd = -1# 指向目前看到的最大的报告期
+        NoteInds, MaxReportDateInds, ChangedMask, ReportRows = self._getPITMapping(date_seq, raw_data, report_date)
+        FactorData = raw_data[factor_names]
         for i, iDate in enumerate(date_seq):
-            tempPreInd = tempInd# 指向先前的最大公告期
-            while (tempInd<tempLen-1) and (iDate>=raw_data['AnnDate'].iloc[tempInd+1]): tempInd = tempInd+1
-            MaxReportDateInd, Changed = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            tempInd, MaxReportDateInd, Changed = NoteInds[i], MaxReportDateInds[i], ChangedMask[i]
             if not Changed:
                 if MaxReportDateInd>=0: StdData[i] = StdData[i-1]
                 continue
             MaxReportDate = raw_data['ReportDate'].iloc[MaxReportDateInd]# 当前最大报告期
             ObjectReportDate = RollBackNPeriod(MaxReportDate, period_lookback)# 上N期报告期
-            iRawData = raw_data.iloc[:tempInd+1]
             if ObjectReportDate[-4:]=="1231":
                 iPreReportDate = ObjectReportDate[0:4]+"0930"
             elif ObjectReportDate[-4:]=="0930":
@@ -1354,43 +1381,35 @@ class _FinancialTable(_DBTable):
             elif ObjectReportDate[-4:]=="0630":
                 iPreReportDate = ObjectReportDate[0:4]+"0331"
             else:
-                iPreReportData1 = iRawData[iRawData["ReportDate"]==ObjectReportDate][factor_names].fillna(method=FillnaMethod).values
+                iPreReportData1 = self._getReportData(FactorData, ReportRows, ObjectReportDate, tempInd, FillnaMethod)
                 if iPreReportData1.shape[0]>0: StdData[i] = iPreReportData1[-1]
                 continue
-            iPreReportData1 = iRawData[iRawData["ReportDate"]==ObjectReportDate][factor_names].fillna(method=FillnaMethod).values# 上N期财报数据
-            iPreReportData2 = iRawData[iRawData["ReportDate"]==iPreReportDate][factor_names].fillna(method=FillnaMethod).values# 上N+1期财报数据
+            iPreReportData1 = self._getReportData(FactorData, ReportRows, ObjectReportDate, tempInd, FillnaMethod)# 上N期财报数据
+            iPreReportData2 = self._getReportData(FactorData, ReportRows, iPreReportDate, tempInd, FillnaMethod)# 上N+1期财报数据
             if (iPreReportData1.shape[0]==0) or (iPreReportData2.shape[0]==0): continue
             StdData[i] = iPreReportData1[-1] - iPreReportData2[-1]
-        self._TempData.pop("LastTargetReportDate", None)
-        self._TempData.pop("LastTargetReportInd", None)
         return StdData
     def _calcIDData_TTM_NPeriod(self, date_seq, raw_data, factor_names, report_date, year_lookback, period_lookback, ignore_missing):
         StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
         FillnaMethod = ("pad" if ignore_missing else "bfill")
         raw_data[factor_names] = raw_data[factor_names].astype("float")
-        tempInd = -1# 指向目前看到的最大的公告期
-        tempLen = raw_data.shape[0]
-        MaxReportDateInd = -1# 指向目前看到的最大的报告期
+        NoteInds, MaxReportDateInds, ChangedMask, ReportRows = self._getPITMapping(date_seq, raw_data, report_date)
+        FactorData = raw_data[factor_names]
         for i, iDate in enumerate(date_seq):
-            tempPreInd = tempInd# 指向先前的最大公告期
-            while (tempInd<tempLen-1) and (iDate>=raw_data['AnnDate'].iloc[tempInd+1]): tempInd = tempInd+1
-            MaxReportDateInd, Changed = self._findMaxReportDateInd(iDate, raw_data, report_date, MaxReportDateInd, tempInd, tempPreInd)
+            tempInd, MaxReportDateInd, Changed = NoteInds[i], MaxReportDateInds[i], ChangedMask[i]
             if not Changed:
                 if MaxReportDateInd>=0: StdData[i] = StdData[i-1]
             MaxReportDate = raw_data['ReportDate'].iloc[MaxReportDateInd]# 当前最大报告期
-            iRawData = raw_data.iloc[:tempInd+1]
             ObjectReportDate = RollBackNPeriod(MaxReportDate, period_lookback)
             if ObjectReportDate[-4:]=='1231':# 上N期财报为年报
-                iPreNPeriodReportData = iRawData[iRawData["ReportDate"]==ObjectReportDate][factor_names].fillna(method=FillnaMethod).values
+                iPreNPeriodReportData = self._getReportData(FactorData, ReportRows, ObjectReportDate, tempInd, FillnaMethod)
                 if iPreNPeriodReportData.shape[0]>0: StdData[i] = iPreNPeriodReportData[-1]
                 continue
-            iPreNPeriodReportData = iRawData[iRawData["ReportDate"]==ObjectReportDate][factor_names].fillna(method=FillnaMethod).values# 上N期数据
-            iPreNPeriodYear_1YearReportData = iRawData[iRawData["ReportDate"]==str(int(ObjectReportDate[0:4])-1)+"1231"][factor_names].fillna(method=FillnaMethod).values# 上N期上一年年报数据
-            iPreNPeriodYear_1ReportData = iRawData[iRawData["ReportDate"]==str(int(ObjectReportDate[0:4])-1)+ObjectReportDate[-4:]][factor_names].fillna(method=FillnaMethod).values# 上N期上一年同期数据
+            iPreNPeriodReportData = self._getReportData(FactorData, ReportRows, ObjectReportDate, tempInd, FillnaMethod)# 上N期数据
+            iPreNPeriodYear_1YearReportData = self._getReportData(FactorData, ReportRows, str(int(ObjectReportDate[0:4])-1)+"1231", tempInd, FillnaMethod)# 上N期上一年年报数据
+            iPreNPeriodYear_1ReportData = self._getReportData(FactorData, ReportRows, str(int(ObjectReportDate[0:4])-1)+ObjectReportDate[-4:], tempInd, FillnaMethod)# 上N期上一年同期数据
             if (iPreNPeriodReportData.shape[0]==0) or (iPreNPeriodYear_1YearReportData.shape[0]==0) or (iPreNPeriodYear_1ReportData.shape[0]==0): continue
             StdData[i] = iPreNPeriodReportData[-1] + iPreNPeriodYear_1YearReportData[-1] - iPreNPeriodYear_1ReportData[-1]
-        self._TempData.pop("LastTargetReportDate", None)
-        self._TempData.pop("LastTargetReportInd", None)
         return StdData
 
 class _AnalystConsensusTable(_DBTable):
@@ -1461,30 +1480,16 @@ class _AnalystConsensusTable(_DBTable):
         Dates = sorted({iDT.strftime("%Y%m%d") for iDT in dts})
         CalcType, LookBack = args.get("计算方法", self.CalcType), args.get("回溯天数", self.LookBack)
         if CalcType=="Fwd12M":
-            CalcFun, FYNum, ANNReportData = self._calcIDData_Fwd12M, None, None
+            FYNum, ANNReportData = None, None
         else:
-            CalcFun, FYNum = self._calcIDData_FY, int(CalcType[-1])
+            FYNum = int(CalcType[-1])
             ANNReportPath = raw_data.columns.name
             if (ANNReportPath is not None) and os.path.isfile(ANNReportPath+("."+self._ANN_ReportFileSuffix if self._ANN_ReportFileSuffix else "")):
                 with shelve.open(ANNReportPath) as ANN_ReportFile:
                     ANNReportData = ANN_ReportFile["RawData"]
             else:
                 ANNReportData = _prepareReportANNRawData(self._FactorDB, ids)
-            ANNReportData = ANNReportData.set_index(["ID"])
-        raw_data = raw_data.set_index(["ID"])
-        Data = {}
-        for iID in raw_data.index.unique():
-            if ANNReportData is not None:
-                if iID in ANNReportData.index:
-                    iANNReportData = ANNReportData.loc[[iID]]
-                else:
-                    continue
-            else:
-                iANNReportData = None
-            Data[iID] = CalcFun(Dates, raw_data.loc[[iID]], iANNReportData, factor_names, LookBack, FYNum)
-        Data = pd.Panel(Data, minor_axis=factor_names)
-        Data.major_axis = [dt.datetime.strptime(iDate, "%Y%m%d") for iDate in Dates]
-        Data = Data.swapaxes(0, 2)
+        Data = calcAnalystConsensus(raw_data, ANNReportData, factor_names, Dates, LookBack, FYNum)
         if LookBack==0: return Data.loc[:, dts, ids]
         AllDTs = Data.major_axis.union(set(dts)).sort_values()
         Data = Data.loc[:, AllDTs, ids]
@@ -1492,59 +1497,6 @@ class _AnalystConsensusTable(_DBTable):
         for i, iFactorName in enumerate(Data.items):
             Data.iloc[i] = fillNaByLookback(Data.iloc[i], lookback=Limits)
         return Data.loc[:, dts]
-    def _calcIDData_FY(self, date_seq, raw_data, report_ann_data, factor_names, lookback, fy_num):
-        StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
-        tempInd = -1
-        tempLen = raw_data.shape[0]
-        NoteDate = None
-        for i, iDate in enumerate(date_seq):
-            while (tempInd<tempLen-1) and (iDate>=raw_data['日期'].iloc[tempInd+1]): tempInd = tempInd+1
-            if tempInd<0: continue
-            LastYear = str(int(iDate[0:4])-1)
-            NoteDate = findNoteDate(LastYear+'1231', report_ann_data)
-            if (NoteDate is None) or (NoteDate>iDate):
-                ObjectDate = str(int(LastYear)+fy_num)+'1231'
-            else:
-                ObjectDate = str(int(iDate[0:4])+fy_num)+'1231'
-            iDate = dt.date(int(iDate[0:4]), int(iDate[4:6]), int(iDate[6:])) 
-            for j in range(0, tempInd+1):
-                if raw_data['报告期'].iloc[tempInd-j]==ObjectDate:
-                    FYNoteDate = raw_data['日期'].iloc[tempInd-j]
-                    if (iDate - dt.date(int(FYNoteDate[0:4]), int(FYNoteDate[4:6]), int(FYNoteDate[6:]))).days<=lookback:
-                        StdData[i] = raw_data[factor_names].iloc[tempInd-j].values
-                        break
-        return StdData
-    def _calcIDData_Fwd12M(self, date_seq, raw_data, report_ann_data, factor_names, lookback, fy_num):
-        StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
-        tempInd = -1
-        tempLen = raw_data.shape[0]
-        NoteDate = None
-        for i, iDate in enumerate(date_seq):
-            while (tempInd<tempLen-1) and (iDate>=raw_data['日期'].iloc[tempInd+1]): tempInd = tempInd+1
-            if tempInd<0: continue
-            ObjectDate1 = iDate[0:4]+'1231'
-            ObjectDate2 = str(int(iDate[0:4])+1)+'1231'
-            ObjectData1 = None
-            ObjectData2 = None
-            iDate = dt.date(int(iDate[0:4]), int(iDate[4:6]), int(iDate[6:]))
-            for j in range(0, tempInd+1):
-                if (ObjectData1 is None) and (raw_data['报告期'].iloc[tempInd-j]==ObjectDate1):
-                    NoteDate = raw_data['日期'].iloc[tempInd-j]
-                    if (iDate-dt.date(int(NoteDate[0:4]), int(NoteDate[4:6]), int(NoteDate[6:]))).days<=lookback:
-                        ObjectData1 = raw_data[factor_names].iloc[tempInd-j].values
-                if (ObjectData2 is None) and (raw_data['报告期'].iloc[tempInd-j]==ObjectDate2):
-                    NoteDate = raw_data['日期'].iloc[tempInd-j]
-                    if (iDate-dt.date(int(NoteDate[0:4]), int(NoteDate[4:6]), int(NoteDate[6:]))).days<=lookback:
-                        ObjectData2 = raw_data[factor_names].iloc[tempInd-j].values
-                if (ObjectData1 is not None) and (ObjectData2 is not None):
-                    break
-            if (ObjectData1 is not None) and (ObjectData2 is not None):
-                Weight1 = (dt.date(int(ObjectDate1[0:4]), 12, 31) - iDate).days
-                if (iDate.month==2) and (iDate.day==29): Weight1 = Weight1/366
-                else:
-                    Weight1 = Weight1/(dt.date(iDate.year+1, iDate.month, iDate.day)-iDate).days
-                StdData[i] = Weight1*ObjectData1.astype("float") + (1-Weight1)*ObjectData2.astype("float")
-        return StdData
 class _AnalystRatingDetailTable(_DBTable):
     """分析师投资评级明细表"""
     Operator = Function(default_value=_DefaultOperator, arg_type="Function", label="算子", order=0)
@@ -1715,44 +1667,55 @@ class _AnalystEstDetailTable(_DBTable):
         ANNReportData = ANNReportData.set_index(["ID"])
         raw_data[self._CapitalField] = raw_data[self._CapitalField].astype("float")
         AllIDs = set(raw_data.index)
+        DateStrs = [iDate.strftime("%Y%m%d") for iDate in Dates]
+        StartDateStrs = [(iDate - dt.timedelta(Period)).strftime("%Y%m%d") for iDate in Dates]
+        Fields = {}
+        for kFactorName in factor_names:
+            Fields[kFactorName] = ["日期", self._ReportDateField, self._CapitalField, kFactorName]+AdditionalFields
         Data = {}
         for kFactorName in factor_names:
-            if DataType=="double": kData = np.full(shape=(len(Dates), len(ids)), fill_value=np.nan)
-            else: kData = np.full(shape=(len(Dates), len(ids)), fill_value=None, dtype="O")
-            kFields = ["日期", self._ReportDateField, self._CapitalField, kFactorName]+AdditionalFields
-            for j, jID in enumerate(ids):
-                if jID not in AllIDs:
-                    x = [pd.DataFrame(columns=kFields)]*len(ForwardYears)
+            if DataType=="double": Data[kFactorName] = np.full(shape=(len(Dates), len(ids)), fill_value=np.nan)
+            else: Data[kFactorName] = np.full(shape=(len(Dates), len(ids)), fill_value=None, dtype="O")
+        for j, jID in enumerate(ids):
+            if jID not in AllIDs:
+                for kFactorName in factor_names:
+                    x = [pd.DataFrame(columns=Fields[kFactorName])]*len(ForwardYears)
                     for i, iDate in enumerate(Dates):
-                        kData[i, j] = Operator(self, iDate, jID, x, ModelArgs)
-                    continue
-                if jID in ANNReportData.index:
-                    jReportNoteDate = ANNReportData.loc[[jID]].reset_index()
+                        Data[kFactorName][i, j] = Operator(self, iDate, jID, x, ModelArgs)
+                continue
+            if jID in ANNReportData.index:
+                jNoteDates = ANNReportData.loc[[jID]].drop_duplicates(subset=["报告期"], keep="first").set_index(["报告期"])["公告日期"]
+            else:
+                jNoteDates = pd.Series()
+            jRawData = raw_data.loc[[jID]]
+            jDates = jRawData["日期"].values
+            # 窗口内的记录在 jRawData 中连续, 窗口和目标报告期不变时复用已经生成的数据
+            jXCache = {}
+            for i, iDate in enumerate(Dates):
+                iStartInd, iEndInd = jDates.searchsorted(StartDateStrs[i], side="right"), jDates.searchsorted(DateStrs[i], side="right")
+                iLastYear = str(iDate.year-1)
+                ijNoteDate = jNoteDates.get(iLastYear+"1231", None)
+                if (ijNoteDate is None) or (ijNoteDate>DateStrs[i]):
+                    iObjectDates = tuple(str(int(iLastYear)+iiNFY)+"1231" for iiNFY in ForwardYears)
                 else:
-                    jReportNoteDate = pd.DataFrame(columns=ANNReportData.columns)
-                jRawData = raw_data.loc[[jID], kFields]
-                ijNoteDate = None
-                for i, iDate in enumerate(Dates):
-                    iStartDate = (iDate - dt.timedelta(Period)).strftime("%Y%m%d")
-                    ijRawData = jRawData[(jRawData["日期"]<=iDate.strftime("%Y%m%d")) & (jRawData["日期"]>iStartDate)]
-                    iLastYear = str(iDate.year-1)
-                    ijNoteDate = findNoteDate(iLastYear+"1231", jReportNoteDate)
-                    x = []
-                    for iiNFY in ForwardYears:
-                        if (ijNoteDate is None) or ((ijNoteDate is not None) and (ijNoteDate>iDate.strftime("%Y%m%d"))):
-                            ObjectDate = str(int(iLastYear)+iiNFY)+"1231"
-                        else:
-                            ObjectDate = str(iDate.year+iiNFY)+"1231"
-                        iijRawData = ijRawData[ijRawData[self._ReportDateField]==ObjectDate].copy()
-                        if iijRawData.shape[0]==0: x.append(iijRawData)
-                        else:
-                            if DeduplicationFields:
-                                ijTemp = iijRawData.groupby(by=DeduplicationFields)[["日期"]].max()
+                    iObjectDates = tuple(str(iDate.year+iiNFY)+"1231" for iiNFY in ForwardYears)
+                iKey = (iStartInd, iEndInd, iObjectDates)
+                if iKey not in jXCache:
+                    ijRawData = jRawData.iloc[iStartInd:iEndInd]
+                    ijX = {kFactorName: [] for kFactorName in factor_names}
+                    for iObjectDate in iObjectDates:
+                        iijRawData = ijRawData[ijRawData[self._ReportDateField]==iObjectDate]
+                        for kFactorName in factor_names:
+                            kiijRawData = iijRawData.loc[:, Fields[kFactorName]].copy()
+                            if (kiijRawData.shape[0]>0) and DeduplicationFields:
+                                ijTemp = kiijRawData.groupby(by=DeduplicationFields)[["日期"]].max()
                                 ijTemp = ijTemp.reset_index()
-                                iijRawData = pd.merge(ijTemp, iijRawData, how="left", left_on=DeduplicationFields+["日期"], right_on=DeduplicationFields+["日期"])
-                            x.append(iijRawData)
-                    kData[i, j] = Operator(self, iDate, jID, x, ModelArgs)
-            Data[kFactorName] = kData
+                                kiijRawData = pd.merge(ijTemp, kiijRawData, how="left", left_on=DeduplicationFields+["日期"], right_on=DeduplicationFields+["日期"])
+                            ijX[kFactorName].append(kiijRawData)
+                    jXCache[iKey] = ijX
+                # 缓存的数据会被多个时点复用, 传给算子的是副本, 以免算子的修改影响其他时点
+                for kFactorName in factor_names:
+                    Data[kFactorName][i, j] = Operator(self, iDate, jID, [iX.copy() for iX in jXCache[iKey][kFactorName]], ModelArgs)
         return pd.Panel(Data, major_axis=Dates, minor_axis=ids).loc[factor_names, dts]
 # 公告信息表, 表结构特征:
 # 公告日期, 表示获得信息的时点;
@@ -1962,6 +1925,7 @@ class WindDB2(QSSQLObject, FactorDB):
         self._InfoFilePath = __QS_LibPath__+os.sep+"WindDB2Info.hdf5"# 数据库信息文件路径
         self._InfoResourcePath = __QS_MainPath__+os.sep+"Resource"+os.sep+"WindDB2Info.xlsx"# 数据库信息源文件路径
         self._TableInfo, self._FactorInfo = updateInfo(self._InfoFilePath, self._InfoResourcePath, self._QS_Logger)# 数据库表信息, 数据库字段信息
+        self._IndustryCache = {}# 行业分类数据的会话缓存, {(表名, 行业代码前缀): {...}}
         self.Name = "WindDB2"
         return
     @property
@@ -66,6 +66,7 @@ class _ErgodicMode(__QS_Object__):
         super().__init__(sys_args=sys_args, **kwargs)
         self._isStarted = False
         self._CurDT = None
+        self._AlignIndex = None# 测试时点序列中的每个时点在 _DateTimes 中对应的最近(不晚于该时点)的位置, array(int)
         self._CacheData = {}
     def __getstate__(self):
         state = self.__dict__.copy()
@@ -171,6 +172,7 @@ class RiskTable(__QS_Object__):
         self.ErgodicMode._IDs = (self.getID() if not self.ErgodicMode.ErgodicIDs else list(self.ErgodicMode.ErgodicIDs))
         if not self.ErgodicMode._IDs: raise __QS_Error__("风险表: '%s' 的默认 ID 序列为空, 请设置参数 '遍历模式-遍历ID' !" % self._Name)
         self.ErgodicMode._CurInd = -1
+        self.ErgodicMode._AlignIndex = None
         self.ErgodicMode._DTNum = self.ErgodicMode._DateTimes.shape[0]# 时点数
         self.ErgodicMode._CacheDTs = []
         self.ErgodicMode._CacheData = {}
@@ -188,11 +190,16 @@ class RiskTable(__QS_Object__):
             if os.name=="nt": self._MMAPCacheData = mmap.mmap(-1, int(self.ErgodicMode.CacheSize*2**20), tagname=self.ErgodicMode._TagName)# 当前共享内存缓冲区
         self.ErgodicMode._isStarted = True
         return 0
-    def move(self, idt, *args, **kwargs):
+    # 设置对齐映射, dts: 之后调用 move 时 dt_index 参数所指的时点序列, 需要在 start 之后调用
+    def alignDateTime(self, dts):
+        self.ErgodicMode._AlignIndex = self.ErgodicMode._DateTimes.searchsorted(np.array(dts, dtype="O"), side="right") - 1
+        return 0
+    def move(self, idt, *args, dt_index=None, **kwargs):
         if idt==self.ErgodicMode._CurDT: return 0
         self.ErgodicMode._CurDT = idt
         PreInd = self.ErgodicMode._CurInd
-        self.ErgodicMode._CurInd = PreInd + np.sum(self.ErgodicMode._DateTimes[PreInd+1:]<=idt)
+        if (dt_index is not None) and (self.ErgodicMode._AlignIndex is not None): self.ErgodicMode._CurInd = int(self.ErgodicMode._AlignIndex[dt_index])
+        else: self.ErgodicMode._CurInd = PreInd + np.sum(self.ErgodicMode._DateTimes[PreInd+1:]<=idt)
         if (self.ErgodicMode.CacheSize>0) and (self.ErgodicMode._CurInd>-1) and ((not self.ErgodicMode._CacheDTs) or (self.ErgodicMode._DateTimes[self.ErgodicMode._CurInd]>self.ErgodicMode._CacheDTs[-1])):# 需要读入缓冲区的数据
             self.ErgodicMode._Queue2SubProcess.put((None,None))
             DataLen = self.ErgodicMode._Queue2MainProcess.get()
@@ -218,6 +225,7 @@ class RiskTable(__QS_Object__):
         self.ErgodicMode._Queue2SubProcess = self.ErgodicMode._Queue2MainProcess = self.ErgodicMode._CacheDataProcess = None
         self.ErgodicMode._isStarted = False
         self.ErgodicMode._CurDT = None
+        self.ErgodicMode._AlignIndex = None
         self._MMAPCacheData = None
         return 0
 
@@ -396,6 +404,7 @@ class FactorRT(RiskTable):
         self.ErgodicMode._IDs = (self.getID() if not self.ErgodicMode.ErgodicIDs else list(self.ErgodicMode.ErgodicIDs))
         if not self.ErgodicMode._IDs: raise __QS_Error__("风险表: '%s' 的默认 ID 序列为空, 请设置参数 '遍历模式-遍历ID' !" % self._Name)
         self.ErgodicMode._CurInd = -1
+        self.ErgodicMode._AlignIndex = None
         self.ErgodicMode._DTNum = self.ErgodicMode._DateTimes.shape[0]# 时点数
         self.ErgodicMode._CacheDTs = []
         self.ErgodicMode._CacheData = {}
@@ -119,6 +119,7 @@ class SQLRDB(QSSQLObject, RiskDB):
         Cursor.execute(SQLStr, (idt, icov.to_json(orient="split", index=False)))
         self._Connection.commit()
         Cursor.close()
+        self.invalidateQueryCache()
         return 0
 
 class _FactorRiskTable(FactorRT):
@@ -359,4 +360,5 @@ class SQLFRDB(QSSQLObject, FactorRDB):
         Cursor.execute(SQLStr, tuple(Data))
         self._Connection.commit()
         Cursor.close()
+        self.invalidateQueryCache()
         return 0
\ No newline at end of file
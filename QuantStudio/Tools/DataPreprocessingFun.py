@@ -237,6 +237,23 @@ def fillNaByLookback(data, lookback, dts=None):
     data.where(((Ind.values-Ind1.values)/10**9<=lookback), np.nan, inplace=True)
     if isDF: return data
     else: return data.values
+# 以之前的值进行缺失值填充, 一次性处理三维数据
+# data: 待填充的数据, array(shape=(因子, 时点, ID)); dts: 时间序列, array; lookback: 回溯的时间, 以秒为单位, 标量或者 array(shape=(时点, ID)), inf 表示不限回溯
+def fillNaByLookback3D(data, dts, lookback):
+    nDT = data.shape[1]
+    LastIdx = np.where(pd.notnull(data), np.arange(nDT).reshape((1, nDT, 1)), -1)
+    np.maximum.accumulate(LastIdx, axis=1, out=LastIdx)
+    Mask = (LastIdx>=0)
+    LastIdx[~Mask] = 0
+    Rslt = np.take_along_axis(data, LastIdx, axis=1)
+    if np.any(np.isfinite(lookback)):
+        dts = np.array(dts, dtype="datetime64[ns]").astype(np.int64)
+        Mask &= ((dts.reshape((1, nDT, 1)) - dts[LastIdx]) / 10**9<=lookback)
+    if np.issubdtype(Rslt.dtype, np.floating) or (Rslt.dtype==np.dtype("O")):
+        Rslt[~Mask] = np.nan
+    else:
+        Rslt = np.where(Mask, Rslt, np.nan)
+    return Rslt
 # 以固定值进行缺失值填充
 # data: 待填充的数据, array; mask: True-False mask, 标记需要填充的范围, array; value: 缺失填充值, double or string
 def fillNaNByVal(data, mask=None, value=0.0):
@@ -5,18 +5,105 @@ import mmap
 import uuid
 from multiprocessing import Queue, Lock
 from collections import OrderedDict
+import time
 import pickle
+import sqlite3
+import hashlib
+import shutil
+import atexit
+import logging
+import tempfile
 import datetime as dt
 
 import numpy as np
 import pandas as pd
-from traits.api import Enum, Str, Range, Password, File, Bool
+from traits.api import Enum, Str, Range, Password, File, Bool, Float, Directory, on_trait_change
 
-from QuantStudio import __QS_Object__, __QS_Error__
+from QuantStudio import __QS_Object__, __QS_Error__, __QS_ConfigPath__
 from QuantStudio.Tools.AuxiliaryFun import genAvailableName
 
 os.environ["NLS_LANG"] = "SIMPLIFIED CHINESE_CHINA.UTF8"
 
+# 基于 sqlite 的本地查询结果缓存
+# cache_file: 缓存文件路径, ttl: 有效期, 单位是秒, 非正数表示不过期, size_limit: 缓存上限, 单位是 MB
+class QSQueryCache(object):
+    """查询结果缓存"""
+    def __init__(self, cache_file, ttl=86400, size_limit=1024):
+        self._CacheFile = cache_file
+        self._TTL = ttl
+        self._SizeLimit = int(size_limit*2**20)
+        self._Connection = None
+        self._PID = None
+        self.HitNum, self.MissNum = 0, 0
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_Connection"] = None
+        return state
+    @property
+    def Connection(self):
+        if (self._Connection is None) or (os.getpid()!=self._PID):
+            CacheDir = os.path.split(self._CacheFile)[0]
+            if CacheDir and (not os.path.isdir(CacheDir)): os.makedirs(CacheDir)
+            self._Connection = sqlite3.connect(self._CacheFile, timeout=30)
+            self._Connection.execute("CREATE TABLE IF NOT EXISTS QS_QueryCache (CacheKey TEXT PRIMARY KEY, Identity TEXT, Data BLOB, Size INTEGER, CreateTime REAL, AccessTime REAL)")
+            self._Connection.execute("CREATE INDEX IF NOT EXISTS QS_QueryCache_Identity ON QS_QueryCache (Identity)")
+            self._Connection.commit()
+            self._PID = os.getpid()
+        return self._Connection
+    @property
+    def Stats(self):
+        TotalNum = self.HitNum + self.MissNum
+        return {"命中次数": self.HitNum, "未命中次数": self.MissNum, "命中率": (self.HitNum / TotalNum if TotalNum>0 else np.nan)}
+    # 生成缓存键, identity: 数据源标识, sql_str: SQL 语句, params: SQL 参数
+    @staticmethod
+    def genKey(identity, sql_str, params=None):
+        KeyStr = identity+"\n"+re.sub(r"\s+", " ", sql_str.strip())+"\n"+repr(params)
+        return hashlib.sha1(KeyStr.encode("utf-8")).hexdigest()
+    # 返回 (是否命中, 数据)
+    def get(self, key):
+        Conn = self.Connection
+        Rslt = Conn.execute("SELECT Data, CreateTime FROM QS_QueryCache WHERE CacheKey=?", (key,)).fetchone()
+        Now = time.time()
+        if (Rslt is None) or ((self._TTL>0) and (Now-Rslt[1]>self._TTL)):
+            self.MissNum += 1
+            return (False, None)
+        Conn.execute("UPDATE QS_QueryCache SET AccessTime=? WHERE CacheKey=?", (Now, key))
+        Conn.commit()
+        self.HitNum += 1
+        return (True, pickle.loads(Rslt[0]))
+    # identity: 数据源标识, 用于在数据源发生写操作时失效其全部缓存
+    def put(self, key, data, identity=""):
+        DataByte = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(DataByte)>self._SizeLimit: return 0
+        Conn, Now = self.Connection, time.time()
+        Conn.execute("REPLACE INTO QS_QueryCache (CacheKey, Identity, Data, Size, CreateTime, AccessTime) VALUES (?, ?, ?, ?, ?, ?)", (key, identity, sqlite3.Binary(DataByte), len(DataByte), Now, Now))
+        if self._TTL>0: Conn.execute("DELETE FROM QS_QueryCache WHERE CreateTime<?", (Now-self._TTL,))
+        # 超出缓存上限时按最近最少使用的顺序淘汰
+        TotalSize = Conn.execute("SELECT SUM(Size) FROM QS_QueryCache").fetchone()[0]
+        if TotalSize>self._SizeLimit:
+            Cursor = Conn.execute("SELECT CacheKey, Size FROM QS_QueryCache ORDER BY AccessTime")
+            ExpiredKeys = []
+            for iKey, iSize in Cursor:
+                if TotalSize<=self._SizeLimit: break
+                ExpiredKeys.append((iKey,))
+                TotalSize -= iSize
+            Conn.executemany("DELETE FROM QS_QueryCache WHERE CacheKey=?", ExpiredKeys)
+        Conn.commit()
+        return 0
+    # 删除某个数据源的全部缓存
+    def invalidate(self, identity):
+        Conn = self.Connection
+        Conn.execute("DELETE FROM QS_QueryCache WHERE Identity=?", (identity,))
+        Conn.commit()
+        return 0
+    def clear(self):
+        Conn = self.Connection
+        Conn.execute("DELETE FROM QS_QueryCache")
+        Conn.commit()
+        Conn.execute("VACUUM")
+        self.HitNum, self.MissNum = 0, 0
+        return 0
+
 class QSSQLObject(__QS_Object__):
     """基于关系数据库的对象"""
     Name = Str("关系数据库")
@@ -32,16 +119,24 @@ class QSSQLObject(__QS_Object__):
     DSN = Str("", arg_type="String", label="数据源", order=9)
     SQLite3File = File(label="sqlite3文件", arg_type="File", order=10)
     AdjustTableName = Bool(False, arg_type="Bool", label="调整表名", order=11)
+    QueryCache = Bool(False, arg_type="Bool", label="查询缓存", order=12)
+    QueryCacheDir = Directory(__QS_ConfigPath__+os.sep+"QueryCache", arg_type="Directory", label="查询缓存目录", order=13)
+    QueryCacheTTL = Float(86400, arg_type="Double", label="缓存有效期", order=14)
+    QueryCacheSize = Float(1024, arg_type="Double", label="缓存上限", order=15)
     def __init__(self, sys_args={}, config_file=None, **kwargs):
         self._Connection = None# 连接对象
         self._Connector = None# 实际使用的数据库链接器
         self._AllTables = []# 数据库中的所有表名, 用于查询时解决大小写敏感问题
         self._PID = None# 保存数据库连接创建时的进程号
+        self._QueryCache = None# 查询结果缓存对象
         return super().__init__(sys_args=sys_args, config_file=config_file, **kwargs)
     def __getstate__(self):
         state = self.__dict__.copy()
         state["_Connection"] = (True if self.isAvailable() else False)
         return state
+    @on_trait_change("QueryCacheDir, QueryCacheTTL, QueryCacheSize")
+    def _on_QueryCache_changed(self, obj, name, old, new):
+        self._QueryCache = None
     def __setstate__(self, state):
         super().__setstate__(state)
         if self._Connection: self._connect()
@@ -146,7 +241,15 @@ class QSSQLObject(__QS_Object__):
         return 0
     def isAvailable(self):
         return (self._Connection is not None)
-    def cursor(self, sql_str=None):
+    # 将以 %(name)s 为参数占位符的 SQL 语句转换为连接器支持的参数风格, 返回 (SQL 语句, 参数)
+    def _adaptParamStyle(self, sql_str, params):
+        if self._Connector in ("sqlite3", "cx_Oracle"):
+            return re.sub(r"%\((\w+)\)s", r":\1", sql_str), params
+        elif self._Connector=="pyodbc":
+            return re.sub(r"%\((\w+)\)s", "?", sql_str), [params[iName] for iName in re.findall(r"%\((\w+)\)s", sql_str)]
+        else:# pyformat 风格, 转义 SQL 语句中的 %
+            return re.sub(r"%(?!\(\w+\)s)", "%%", sql_str), params
+    def cursor(self, sql_str=None, params=None):
         if self._Connection is None:
             Msg = ("'%s' 获取 cursor 失败: 数据库尚未连接!" % (self.Name,))
             self._QS_Logger.error(Msg)
@@ -161,13 +264,75 @@ class QSSQLObject(__QS_Object__):
         if self.AdjustTableName:
             for iTable in self._AllTables:
                 sql_str = re.sub(iTable, iTable, sql_str, flags=re.IGNORECASE)
-        Cursor.execute(sql_str)
+        if not params:
+            Cursor.execute(sql_str)
+        else:
+            Cursor.execute(*self._adaptParamStyle(sql_str, params))
+        if not re.match(r"\s*(SELECT|WITH|PRAGMA|SHOW|EXPLAIN|DESC|DESCRIBE)\b", sql_str, flags=re.IGNORECASE): self.invalidateQueryCache()
         return Cursor
+    @property
+    def QueryCacheStats(self):
+        if self._QueryCache is None: return {"命中次数": 0, "未命中次数": 0, "命中率": np.nan}
+        return self._QueryCache.Stats
+    def _getQueryCache(self):
+        if self._QueryCache is None:
+            CacheFile = self.QueryCacheDir+os.sep+self.__class__.__name__+".sqlite3"
+            self._QueryCache = QSQueryCache(CacheFile, ttl=self.QueryCacheTTL, size_limit=self.QueryCacheSize)
+        return self._QueryCache
+    def clearQueryCache(self):
+        return self._getQueryCache().clear()
+    # 数据源标识, 区分不同数据库连接的查询缓存
+    def _getQueryCacheIdentity(self):
+        return "%s|%s|%s|%d|%s|%s|%s" % (self.DBType, self.DBName, self.IPAddr, self.Port, self.User, self.DSN, self.SQLite3File)
+    # 可以缓存的查询返回 (缓存对象, 数据源标识, 缓存键), 否则返回 None
+    def _genQueryCacheKey(self, sql_str, params=None):
+        if not (self.QueryCache and re.match(r"\s*(SELECT|WITH)\b", sql_str, flags=re.IGNORECASE)): return None
+        QueryCache, Identity = self._getQueryCache(), self._getQueryCacheIdentity()
+        return (QueryCache, Identity, QueryCache.genKey(Identity, sql_str, params=params))
+    # 失效当前数据源的查询缓存, 写操作和 DDL 后调用
+    def invalidateQueryCache(self):
+        if not self.QueryCache: return 0
+        try:
+            self._getQueryCache().invalidate(self._getQueryCacheIdentity())
+        except Exception as e:
+            self._QS_Logger.warning("'%s' 失效查询缓存时错误: %s" % (self.Name, str(e)))
+        return 0
     def fetchall(self, sql_str):
+        Cache = self._genQueryCacheKey(sql_str)
+        if Cache is not None:
+            QueryCache, Identity, CacheKey = Cache
+            isHit, Data = QueryCache.get(CacheKey)
+            if isHit: return Data
         Cursor = self.cursor(sql_str=sql_str)
         Data = Cursor.fetchall()
         Cursor.close()
+        if Cache is not None:
+            try:
+                QueryCache.put(CacheKey, [tuple(iRow) for iRow in Data], identity=Identity)
+            except Exception as e:
+                self._QS_Logger.warning("'%s' 调用方法 fetchall 写入查询缓存时错误: %s" % (self.Name, str(e)))
         return Data
+    # 执行参数化查询并按列返回结果, sql_str: 以 %(name)s 为参数占位符的 SQL 语句, params: {参数名: 参数值}
+    # 返回: [array], 每个元素为一列数据
+    def fetchColumns(self, sql_str, params={}):
+        Cache = self._genQueryCacheKey(sql_str, params=sorted(params.items()))
+        if Cache is None: return self._fetchColumns(sql_str, params)
+        QueryCache, Identity, CacheKey = Cache
+        isHit, Data = QueryCache.get(CacheKey)
+        if isHit: return Data
+        Data = self._fetchColumns(sql_str, params)
+        try:
+            QueryCache.put(CacheKey, Data, identity=Identity)
+        except Exception as e:
+            self._QS_Logger.warning("'%s' 调用方法 fetchColumns 写入查询缓存时错误: %s" % (self.Name, str(e)))
+        return Data
+    def _fetchColumns(self, sql_str, params):
+        Cursor = self.cursor(sql_str=sql_str, params=params)
+        Data = Cursor.fetchall()
+        nCol = len(Cursor.description)
+        Cursor.close()
+        if not Data: return [np.array([], dtype="O") for i in range(nCol)]
+        return [np.array(iCol, dtype="O") for iCol in zip(*Data)]
     def execute(self, sql_str):
         if self._Connection is None:
             Msg = ("'%s' 执行 SQL 命令失败: 数据库尚未连接!" % (self.Name,))
@@ -182,6 +347,7 @@ class QSSQLObject(__QS_Object__):
         Cursor.execute(sql_str)
         self._Connection.commit()
         Cursor.close()
+        self.invalidateQueryCache()
         return 0
     def getDBTable(self, table_format=None):
         try:
@@ -219,8 +385,8 @@ class QSSQLObject(__QS_Object__):
         else:
             self._QS_Logger.info("'%s' 调用方法 renameDBTable 将表 '%s' 重命名为 '%s'" % (self.Name, old_table_name, new_table_name))
         return 0
-    # 创建表, field_types: {字段名: 数据类型}
-    def createDBTable(self, table_name, field_types, primary_keys=[], index_fields=[]):
+    # 创建表, field_types: {字段名: 数据类型}, without_rowid: 对于 sqlite3, 是否创建 WITHOUT ROWID 表
+    def createDBTable(self, table_name, field_types, primary_keys=[], index_fields=[], without_rowid=False):
         if self.DBType=="MySQL":
             SQLStr = "CREATE TABLE IF NOT EXISTS %s (" % (self.TablePrefix+table_name)
             for iField, iDataType in field_types.items():SQLStr += "`%s` %s, " % (iField, iDataType)
@@ -235,6 +401,7 @@ class QSSQLObject(__QS_Object__):
             for iField, iDataType in field_types.items(): SQLStr += "`%s` %s, " % (iField, iDataType)
             if primary_keys:
                 SQLStr += "PRIMARY KEY (`"+"`,`".join(primary_keys)+"`))"
+                if without_rowid: SQLStr += " WITHOUT ROWID"
             else:
                 SQLStr += ")"
             IndexType = None
@@ -463,4 +630,70 @@ class QSPipe(object):
             DataLen = self._PutQueue.get()
         return pickle.loads(DataByte)
     def empty(self):
-        return self._PutQueue.empty()
\ No newline at end of file
+        return self._PutQueue.empty()
+# 对容器中的每个元素调用 fun, 返回同类型的新容器
+def _mapContainer(obj, fun):
+    if isinstance(obj, dict): return obj.__class__((iKey, fun(iVal)) for iKey, iVal in obj.items())
+    return obj.__class__(fun(iVal) for iVal in obj)
+
+# 内存映射文件中的数组描述, 通过队列传递, 接收端据此重建数据
+class _MMAPArray(object):
+    def __init__(self, file_path, kind, index=None, columns=None, name=None):
+        self.FilePath, self.Kind, self.Index, self.Columns, self.Name = file_path, kind, index, columns, name
+    def load(self):
+        # 写时复制, 接收端修改数据不影响文件; Windows 下被映射的文件无法删除, 直接读入内存
+        Data = np.load(self.FilePath, mmap_mode=("c" if os.name!="nt" else None), allow_pickle=False)
+        if self.Kind=="DataFrame": return pd.DataFrame(Data, index=self.Index, columns=self.Columns, copy=False)
+        elif self.Kind=="Series": return pd.Series(Data, index=self.Index, name=self.Name, copy=False)
+        return Data
+
+class QSMMAPPipe(QSPipe):
+    """进程间 Pipe, 大的数值型数组通过临时内存映射文件传递"""
+    # cache_size: 缓存大小, 单位是 MB; min_size: 写入内存映射文件的数组的最小大小, 单位是 MB, 更小的数组仍然通过 pickle 传递
+    def __init__(self, cache_size=100, min_size=1):
+        super().__init__(cache_size=cache_size)
+        self._MinSize = int(min_size*2**20)
+        self._DirPath = tempfile.mkdtemp()
+    @property
+    def DirPath(self):
+        return self._DirPath
+    def _dumpArray(self, data):
+        FilePath = self._DirPath+os.sep+str(uuid.uuid4())+".npy"
+        np.save(FilePath, data, allow_pickle=False)
+        return FilePath
+    # 只有 numpy 原生的非 object 类型可以写入内存映射文件, pandas 的扩展类型(带时区的时间, 分类等)转换成数组时会丢失类型信息, 仍然通过 pickle 传递
+    def _isMMAPDType(self, dtype):
+        return isinstance(dtype, np.dtype) and (dtype!=np.dtype("O"))
+    def _isMMAPArray(self, values):
+        return isinstance(values, np.ndarray) and self._isMMAPDType(values.dtype) and (values.nbytes>=self._MinSize)
+    # 将对象中的数值型数组替换为内存映射文件的描述, 支持嵌套的 dict, list, tuple
+    def _pack(self, obj):
+        if type(obj) in (dict, OrderedDict, list, tuple): return _mapContainer(obj, self._pack)
+        elif isinstance(obj, pd.DataFrame):
+            # 多种数据类型的 DataFrame 合并成数组时会改变数据类型
+            if (obj.shape[1]==0) or (obj.dtypes.nunique()>1) or (not self._isMMAPDType(obj.dtypes.iloc[0])) or (not self._isMMAPArray(obj.values)): return obj
+            return _MMAPArray(self._dumpArray(np.ascontiguousarray(obj.values)), "DataFrame", index=obj.index, columns=obj.columns)
+        elif isinstance(obj, pd.Series):
+            if (not self._isMMAPDType(obj.dtype)) or (not self._isMMAPArray(obj.values)): return obj
+            return _MMAPArray(self._dumpArray(np.ascontiguousarray(obj.values)), "Series", index=obj.index, name=obj.name)
+        elif isinstance(obj, np.ndarray):
+            if not self._isMMAPArray(obj): return obj
+            return _MMAPArray(self._dumpArray(obj), "ndarray")
+        return obj
+    def _unpack(self, obj):
+        if isinstance(obj, _MMAPArray): return obj.load()
+        elif type(obj) in (dict, OrderedDict, list, tuple): return _mapContainer(obj, self._unpack)
+        return obj
+    def put(self, obj):
+        return super().put(self._pack(obj))
+    def get(self):
+        return self._unpack(super().get())
+    # 删除临时文件, 已经重建的数据仍然可用; 有文件未能删除时记录警告, 并在进程退出时再次尝试删除
+    def close(self):
+        if not os.path.isdir(self._DirPath): return 0
+        FailedPaths = []
+        shutil.rmtree(self._DirPath, onerror=lambda fun, path, exc_info: FailedPaths.append(path))
+        if FailedPaths:
+            logging.getLogger().warning("QSMMAPPipe 的临时文件未能删除: %s, 将在进程退出时再次尝试删除" % (", ".join(FailedPaths), ))
+            atexit.register(shutil.rmtree, self._DirPath, True)
+        return 0
@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import pickle
+import shutil
+import tempfile
+import datetime as dt
+import unittest
+
+import numpy as np
+import pandas as pd
+from traits.api import Int, Enum, TraitError
+
+from QuantStudio import __QS_Error__
+import QuantStudio.FactorDataBase.FactorDB as FactorDB
+from QuantStudio.FactorDataBase.FactorDB import CustomFT, DataFactor
+from QuantStudio.BackTest.BackTestModel import BaseModule, BackTestModel, BackTestProfiler, OutputSpool, _StepReadBroker, _copyModule
+from QuantStudio.BackTest.TimeSeriesFactor.Correlation import TimeSeriesCorrelation
+from QuantStudio.BackTest.Strategy.StrategyModule import Account, Strategy
+
+class TestBackTestModel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # 分钟级测试时点, 每天 1440 个
+        StartDT = dt.datetime(2000, 1, 1)
+        TestBackTestModel.DTs = [StartDT + dt.timedelta(minutes=i) for i in range(5000)]
+    def _runNoOpModules(self, dts):
+        Model = BackTestModel()
+        Model.Modules = [BaseModule(name="空模块"+str(i)) for i in range(3)]
+        StartT = time.perf_counter()
+        Model.run(dts=dts)
+        return Model, time.perf_counter() - StartT
+    def test_1_run_NoOpModules(self):
+        Model, _ = self._runNoOpModules(self.DTs)
+        Dates = pd.Series(np.arange(len(self.DTs)), index=[iDT.date() for iDT in self.DTs])
+        Dates = Dates[~Dates.index.duplicated(keep="last")]
+        self.assertEqual(Model.DateTimeIndex, len(self.DTs) - 1)
+        self.assertListEqual(Model.DateIndexSeries.index.tolist(), Dates.index.tolist())
+        self.assertListEqual(Model.DateIndexSeries.tolist(), Dates.tolist())
+    # 耗时测试, 设置环境变量 QS_BENCHMARK 后运行
+    @unittest.skipUnless(os.environ.get("QS_BENCHMARK"), "set QS_BENCHMARK to run benchmark tests")
+    def test_2_run_NoOpModules_Scaling(self):
+        StartDT = dt.datetime(2000, 1, 1)
+        nDT = 50000
+        _, ShortT = self._runNoOpModules([StartDT + dt.timedelta(minutes=i) for i in range(nDT)])
+        _, LongT = self._runNoOpModules([StartDT + dt.timedelta(minutes=i) for i in range(nDT*4)])
+        # 逐时点的日期索引维护是常数时间, 耗时应随时点数线性增长, 若退化为平方复杂度, 比值将接近 16
+        self.assertLess(LongT / ShortT, 8)
+
+class TestBatchMode(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        nDT = 40
+        TestBatchMode.DTs = [dt.datetime(2018, 1, 1)+dt.timedelta(i) for i in range(nDT)]
+        TestBatchMode.FactorIDs, TestBatchMode.PriceIDs = ["F0", "F1"], ["000001.SZ", "000002.SZ", "600000.SH"]
+        np.random.seed(0)
+        TestBatchMode.FactorData = pd.DataFrame(np.random.randn(nDT, len(TestBatchMode.FactorIDs)), index=TestBatchMode.DTs, columns=TestBatchMode.FactorIDs)
+        TestBatchMode.PriceData = pd.DataFrame(10 + np.random.rand(nDT, len(TestBatchMode.PriceIDs)), index=TestBatchMode.DTs, columns=TestBatchMode.PriceIDs)
+    def _runCorrelation(self, batch_mode, calc_dts):
+        FactorFT = CustomFT(name="FactorFT")
+        FactorFT.addFactors(factor_list=[DataFactor(name="Factor0", data=self.FactorData)])
+        FactorFT.setID(self.FactorIDs)
+        FactorFT.setDateTime(self.DTs)
+        PriceFT = CustomFT(name="PriceFT")
+        PriceFT.addFactors(factor_list=[DataFactor(name="Price", data=self.PriceData)])
+        PriceFT.setID(self.PriceIDs)
+        PriceFT.setDateTime(self.DTs)
+        Module = TimeSeriesCorrelation(FactorFT, PriceFT, sys_args={"计算时点": calc_dts, "预测期数": 2, "滞后期数": 1, "统计窗口": 10})
+        Model = BackTestModel(sys_args={"批量模式": batch_mode})
+        Model.Modules = [Module]
+        Model.run(dts=self.DTs)
+        return Module.output()
+    def _assertOutputEqual(self, output1, output2):
+        self.assertSetEqual(set(output1), set(output2))
+        for iKey, iVal in output1.items():
+            if isinstance(iVal, dict): self._assertOutputEqual(iVal, output2[iKey])
+            else: pd.testing.assert_frame_equal(iVal, output2[iKey])
+    # 测试批量模式与逐时点计算的结果一致
+    def test_1_batchEqualsMove(self):
+        self._assertOutputEqual(self._runCorrelation(True, []), self._runCorrelation(False, []))
+    # 测试指定计算时点时批量模式与逐时点计算的结果一致
+    def test_2_batchEqualsMove_CalcDTs(self):
+        CalcDTs = self.DTs[::3]
+        self._assertOutputEqual(self._runCorrelation(True, CalcDTs), self._runCorrelation(False, CalcDTs))
+
+class _ReadModule(BaseModule):
+    def __init__(self, ft, name, fail_dt=None):
+        self._FT = ft
+        self._FailDT = fail_dt
+        super().__init__(name=name)
+    def __QS_start__(self, mdl, dts, **kwargs):
+        super().__QS_start__(mdl=mdl, dts=dts, **kwargs)
+        self._Output = {}
+        return (self._FT, )
+    def __QS_move__(self, idt, **kwargs):
+        super().__QS_move__(idt, **kwargs)
+        if idt==self._FailDT: raise ValueError("模块运行出错")
+        self._Output[idt] = self._FT.readData(factor_names=["Factor0"], ids=self._FT.getID(), dts=[idt]).iloc[0, 0].tolist()
+        return 0
+
+class TestReadBroker(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        TestReadBroker.DTs = [dt.datetime(2018, 1, 1)+dt.timedelta(i) for i in range(10)]
+        TestReadBroker.IDs = ["000001.SZ", "000002.SZ"]
+        np.random.seed(0)
+        TestReadBroker.Data = pd.DataFrame(np.random.randn(len(TestReadBroker.DTs), len(TestReadBroker.IDs)), index=TestReadBroker.DTs, columns=TestReadBroker.IDs)
+    def _genFT(self):
+        FT = CustomFT(name="TestFT")
+        FT.addFactors(factor_list=[DataFactor(name="Factor0", data=self.Data)])
+        FT.setID(self.IDs)
+        FT.setDateTime(self.DTs)
+        FT.ReadNum = 0
+        RawReadFun = FT._readData_ErgodicMode
+        def countRead(*args, **kwargs):
+            FT.ReadNum += 1
+            return RawReadFun(*args, **kwargs)
+        FT._readData_ErgodicMode = countRead
+        return FT
+    # 测试同一时点内多个模块的相同读取请求只触发一次底层读取
+    def test_1_mergeSameRead(self):
+        FT = self._genFT()
+        Model = BackTestModel()
+        Model.Modules = [_ReadModule(FT, name="读取模块"+str(i)) for i in range(2)]
+        Model.run(dts=self.DTs)
+        self.assertEqual(FT.ReadNum, len(self.DTs))
+        for jModule in Model.Modules:
+            self.assertListEqual([jModule.output()[iDT] for iDT in self.DTs], self.Data.values.tolist())
+        self.assertIsNone(FT.ErgodicMode._ReadBroker)
+    # 测试运行出错时解除因子表与读取代理的关联
+    def test_2_detachOnError(self):
+        FT = self._genFT()
+        Model = BackTestModel()
+        Model.Modules = [_ReadModule(FT, name="读取模块", fail_dt=self.DTs[3])]
+        with self.assertRaises(ValueError):
+            Model.run(dts=self.DTs)
+        self.assertIsNone(FT.ErgodicMode._ReadBroker)
+    # 测试同时读取数值和字符串因子时各因子保留自己的数据类型
+    def test_3_mixedDataType(self):
+        FT = self._genFT()
+        StrData = pd.DataFrame("a", index=self.DTs, columns=self.IDs)
+        FT.addFactors(factor_list=[DataFactor(name="Factor1", data=StrData, sys_args={"数据类型": "string"})])
+        Broker = _StepReadBroker()
+        FT.start(dts=self.DTs)
+        try:
+            FT.move(self.DTs[0])
+            Data = Broker.readData(FT, factor_names=["Factor0", "Factor1"], ids=self.IDs, dts=[self.DTs[0]])
+            Cached = Broker.readData(FT, factor_names=["Factor0"], ids=self.IDs, dts=[self.DTs[0]])
+        finally:
+            FT.end()
+        self.assertEqual(FT.ReadNum, 1)
+        self.assertTrue(all(np.issubdtype(iDType, np.floating) for iDType in Data.iloc[0].dtypes))
+        self.assertTrue(all(np.issubdtype(iDType, np.floating) for iDType in Cached.iloc[0].dtypes))
+        self.assertListEqual(Data.iloc[0].values.tolist(), self.Data.iloc[:1].values.tolist())
+        self.assertListEqual(Data.iloc[1].values.tolist(), [["a", "a"]])
+
+class _SweepModule(BaseModule):
+    Window = Int(1, arg_type="Integer", label="窗口", order=0)
+    def __init__(self, ft, name="扫描模块", sys_args={}, **kwargs):
+        self._FT = ft
+        super().__init__(name=name, sys_args=sys_args, **kwargs)
+    def __QS_initArgs__(self):
+        self.add_trait("Method", Enum("mean", "max", arg_type="SingleOption", label="方法", order=1))
+    def __QS_start__(self, mdl, dts, **kwargs):
+        super().__QS_start__(mdl=mdl, dts=dts, **kwargs)
+        self._Output = {"结果": []}
+        return (self._FT, )
+    def __QS_move__(self, idt, **kwargs):
+        super().__QS_move__(idt, **kwargs)
+        iData = self._FT.readData(factor_names=["Factor0"], ids=self._FT.getID(), dts=[idt]).iloc[0, 0]
+        self._Output["结果"].append(getattr(iData, self.Method)() * self.Window)
+        return 0
+
+class TestSweep(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        TestSweep.DTs = [dt.datetime(2018, 1, 1)+dt.timedelta(i) for i in range(5)]
+        np.random.seed(0)
+        TestSweep.Data = pd.DataFrame(np.random.randn(len(TestSweep.DTs), 3), index=TestSweep.DTs, columns=["000001.SZ", "000002.SZ", "600000.SH"])
+        TestSweep.FT = CustomFT(name="TestFT")
+        TestSweep.FT.addFactors(factor_list=[DataFactor(name="Factor0", data=TestSweep.Data)])
+        TestSweep.FT.setID(TestSweep.Data.columns.tolist())
+        TestSweep.FT.setDateTime(TestSweep.DTs)
+    # 测试复制的模块独立于模板, 保留参数校验, 并共享因子表
+    def test_1_copyModule(self):
+        Template = _SweepModule(self.FT)
+        Module = _copyModule(Template)
+        self.assertIs(Module._FT, self.FT)
+        self.assertIsNot(Module._LabelTrait, Template._LabelTrait)
+        self.assertIsNot(Module._ArgOrder, Template._ArgOrder)
+        Module["方法"] = "max"
+        self.assertEqual(Template["方法"], "mean")
+        with self.assertRaises(TraitError):
+            Module["方法"] = "min"
+    # 测试参数扫描的结果与参数组一一对应
+    def test_2_sweep(self):
+        OutputDir = tempfile.mkdtemp()
+        Template = _SweepModule(self.FT)
+        Model = BackTestModel()
+        Result = Model.sweep(self.DTs, Template, {"窗口": [1, 2], "方法": ["mean", "max"]}, batch_size=3, output_dir=OutputDir)
+        self.assertEqual(len(Result), 4)
+        self.assertListEqual(Result.Index.columns.tolist(), ["窗口", "方法"])
+        self.assertListEqual(Model.Modules, [])
+        self.assertEqual(Template["窗口"], 1)
+        self.assertDictEqual(Template._Output, {})
+        for i in Result.Index.index:
+            iWindow, iMethod = Result.Index.loc[i, "窗口"], Result.Index.loc[i, "方法"]
+            self.assertListEqual(Result.query(窗口=iWindow, 方法=iMethod), [i])
+            self.assertTrue(np.allclose(Result[i]["结果"], getattr(self.Data, iMethod)(axis=1).values * iWindow))
+        with self.assertRaises(__QS_Error__):
+            Result[len(Result)]
+        Result.clear()
+        self.assertFalse(os.path.isdir(OutputDir))
+    # 测试 batch_size 必须为正整数
+    def test_3_invalidBatchSize(self):
+        with self.assertRaises(__QS_Error__):
+            BackTestModel().sweep(self.DTs, _SweepModule(self.FT), {"窗口": [1]}, batch_size=0)
+
+_ScheduleCalls = []# 调度测试模块的调用记录, [(模块名, 阶段)]
+class _ScheduleModule(BaseModule):
+    def __init__(self, ft, name, cost=None, batch=False):
+        self._FT = ft
+        self._Cost = cost
+        self._Batch = batch
+        super().__init__(name=name)
+    def __QS_start__(self, mdl, dts, **kwargs):
+        super().__QS_start__(mdl=mdl, dts=dts, **kwargs)
+        self._Output = {"时点": []}
+        return (self._FT, )
+    def __QS_move__(self, idt, **kwargs):
+        super().__QS_move__(idt, **kwargs)
+        _ScheduleCalls.append((self.Name, "move"))
+        self._Output["时点"].append(idt)
+        self._Model.UserData[self.Name] = idt
+        return 0
+    def __QS_batchRequests__(self, dts):
+        if not self._Batch: return None
+        return [(self._FT, ["Factor0"], self._FT.getID(), list(dts), {})]
+    def __QS_batch__(self, dts, data):
+        super().__QS_batch__(dts=dts, data=data)
+        _ScheduleCalls.append((self.Name, "batch"))
+        return 0
+    def __QS_estimateCost__(self, dts):
+        return self._Cost
+
+class TestScheduleModules(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        TestScheduleModules.DTs = [dt.datetime(2018, 1, 1)+dt.timedelta(i) for i in range(5)]
+        Data = pd.DataFrame(np.random.randn(len(TestScheduleModules.DTs), 2), index=TestScheduleModules.DTs, columns=["000001.SZ", "000002.SZ"])
+        TestScheduleModules.FTs = []
+        for i in range(2):
+            iFT = CustomFT(name="TestFT"+str(i))
+            iFT.addFactors(factor_list=[DataFactor(name="Factor0", data=Data)])
+            iFT.setID(Data.columns.tolist())
+            iFT.setDateTime(TestScheduleModules.DTs)
+            TestScheduleModules.FTs.append(iFT)
+    def _genModel(self, modules, batch_mode=False):
+        Model = BackTestModel(sys_args={"批量模式": batch_mode})
+        Model.Modules = modules
+        Model._QS_TestDateTimes = self.DTs
+        Model._initDateIndex()
+        return Model
+    # 测试不试运行时也按使用的因子表分组
+    def test_1_groupByFT(self):
+        Modules = [_ScheduleModule(self.FTs[j // 2], name="模块"+str(j), cost=1) for j in range(4)]
+        Model = self._genModel(Modules)
+        self.assertListEqual(Model._scheduleModules(2, pilot_num=0), [[0, 1], [2, 3]])
+        for jModule in Modules: self.assertFalse(jModule._isStarted)
+    # 测试按模块声明的计算量均衡分配
+    def test_2_balanceCost(self):
+        Modules = [_ScheduleModule(self.FTs[j], name="模块"+str(j), cost=jCost) for j, jCost in enumerate([3, 1])]
+        Modules += [_ScheduleModule(self.FTs[1], name="模块2", cost=2)]
+        Model = self._genModel(Modules)
+        self.assertListEqual(Model._scheduleModules(2, pilot_num=0), [[0], [1, 2]])
+    # 测试试运行在模块副本上进行, 不改变模块和模型的状态, 并且遵循批量模式
+    def test_3_pilotRun(self):
+        del _ScheduleCalls[:]
+        Modules = [_ScheduleModule(self.FTs[0], name="逐时点模块"), _ScheduleModule(self.FTs[1], name="批量模块", batch=True)]
+        Model = self._genModel(Modules, batch_mode=True)
+        Model.UserData = {"用户": 1}
+        Partition = Model._scheduleModules(2, pilot_num=3)
+        self.assertListEqual(sorted(Partition), [[0], [1]])
+        self.assertListEqual(_ScheduleCalls, [("批量模块", "batch")]+[("逐时点模块", "move")]*3)
+        self.assertDictEqual(Model.UserData, {"用户": 1})
+        self.assertEqual(Model.DateTimeIndex, -1)
+        for jModule in Modules:
+            self.assertFalse(jModule._isStarted)
+            self.assertDictEqual(jModule._Output, {})
+
+class _RecordAccount(BaseModule):
+    def __QS_start__(self, mdl, dts, **kwargs):
+        super().__QS_start__(mdl=mdl, dts=dts, **kwargs)
+        self._Records = []
+        return ()
+    def __QS_move__(self, idt, **kwargs):
+        super().__QS_move__(idt, **kwargs)
+        self._Records.append(idt)
+        return 0
+class _RecordStrategy(BaseModule):
+    def __init__(self, name, accounts, fail_dt=None):
+        self.Accounts = accounts
+        self.UserData = {}
+        self.FailDT = fail_dt
+        super().__init__(name=name)
+    def __QS_start__(self, mdl, dts, **kwargs):
+        Rslt = ()
+        for iAccount in self.Accounts: Rslt += iAccount.__QS_start__(mdl=mdl, dts=dts, **kwargs)
+        self.UserData = {"移动次数": 0}
+        return Rslt + super().__QS_start__(mdl=mdl, dts=dts, **kwargs)
+    def __QS_move__(self, idt, **kwargs):
+        super().__QS_move__(idt, **kwargs)
+        if idt==self.FailDT: raise ValueError("模拟运行中断")
+        for iAccount in self.Accounts: iAccount.__QS_move__(idt, **kwargs)
+        self.UserData["移动次数"] += 1
+        self._Model.UserData["最后时点"] = idt
+        return 0
+    def output(self, recalculate=False):
+        return {"账户记录": [list(iAccount._Records) for iAccount in self.Accounts], "移动次数": self.UserData["移动次数"]}
+
+class TestCheckpoint(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        TestCheckpoint.DTs = [dt.datetime(2018, 1, 1)+dt.timedelta(i) for i in range(10)]
+        TestCheckpoint.TempDir = tempfile.mkdtemp()
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestCheckpoint.TempDir, ignore_errors=True)
+    def _genModel(self, checkpoint_file, fail_dt=None):
+        Model = BackTestModel(sys_args={"检查点文件": checkpoint_file, "检查点间隔": 0})
+        Model.Modules = [_RecordStrategy("策略", [_RecordAccount(name="账户"+str(i)) for i in range(2)], fail_dt=fail_dt)]
+        return Model
+    # 测试中断后从检查点恢复, 子模块的状态和模块的用户数据都得到恢复
+    def test_1_crashAndResume(self):
+        CheckpointFile = self.TempDir+os.sep+"checkpoint.pkl"
+        Model = self._genModel(CheckpointFile, fail_dt=self.DTs[5])
+        with self.assertRaises(ValueError):
+            Model.run(dts=self.DTs)
+        self.assertTrue(os.path.isfile(CheckpointFile))
+        Model = self._genModel(CheckpointFile)
+        Model.run(dts=self.DTs, resume=True)
+        Output = Model.Modules[0].output()
+        self.assertListEqual(Output["账户记录"], [self.DTs, self.DTs])
+        self.assertEqual(Output["移动次数"], len(self.DTs))
+        self.assertEqual(Model.UserData["最后时点"], self.DTs[-1])
+        self.assertFalse(os.path.isfile(CheckpointFile))
+    # 测试策略和账户的状态保存
+    def test_2_strategyState(self):
+        iAccount = Account(name="账户")
+        iStrategy = Strategy(name="策略", accounts=[iAccount])
+        iAccount._Cash, iAccount._Debt = np.array([1.0, 2.0]), np.array([0.0, 0.5])
+        iAccount._TradingRecord = pd.DataFrame([[self.DTs[0], "000001.SZ", 100]], columns=["时点", "ID", "买卖数量"])
+        iStrategy.UserData = {"信号": [1, 2]}
+        State = pickle.loads(pickle.dumps(iStrategy.__QS_getState__()))
+        iAccount._Cash, iAccount._Debt, iAccount._TradingRecord = None, None, None
+        iStrategy.UserData = {}
+        iStrategy.__QS_setState__(State)
+        self.assertListEqual(iAccount._Cash.tolist(), [1.0, 2.0])
+        self.assertListEqual(iAccount._Debt.tolist(), [0.0, 0.5])
+        self.assertListEqual(iAccount._TradingRecord["ID"].tolist(), ["000001.SZ"])
+        self.assertDictEqual(iStrategy.UserData, {"信号": [1, 2]})
+    # 测试多进程运行不支持从检查点恢复
+    def test_3_resumeWithSubprocess(self):
+        Model = self._genModel(self.TempDir+os.sep+"checkpoint_mp.pkl")
+        with self.assertRaises(__QS_Error__):
+            Model.run(dts=self.DTs, subprocess_num=2, resume=True)
+
+class _ProfileModule(BaseModule):
+    def __init__(self, ergodic_ft, direct_ft, name="分析模块"):
+        self._ErgodicFT = ergodic_ft
+        self._DirectFT = direct_ft
+        super().__init__(name=name)
+    def __QS_start__(self, mdl, dts, **kwargs):
+        super().__QS_start__(mdl=mdl, dts=dts, **kwargs)
+        return (self._ErgodicFT, )
+    def __QS_move__(self, idt, **kwargs):
+        super().__QS_move__(idt, **kwargs)
+        self._ErgodicFT.readData(factor_names=["Factor0"], ids=self._ErgodicFT.getID(), dts=[idt])
+        self._DirectFT.getFilteredID(idt=idt, id_filter_str="@Factor0>0")
+        self._DirectFT.readData(factor_names=["Factor0"], ids=self._DirectFT.getID(), dts=[idt])
+        return 0
+
+class TestProfiler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        TestProfiler.DTs = [dt.datetime(2018, 1, 1)+dt.timedelta(i) for i in range(5)]
+        TestProfiler.TempDir = tempfile.mkdtemp()
+        np.random.seed(0)
+        Data = pd.DataFrame(np.random.randn(len(TestProfiler.DTs), 3), index=TestProfiler.DTs, columns=["000001.SZ", "000002.SZ", "600000.SH"])
+        TestProfiler.FTs = []
+        for i in range(2):
+            iFT = CustomFT(name="TestFT"+str(i))
+            iFT.addFactors(factor_list=[DataFactor(name="Factor0", data=Data)])
+            iFT.setID(Data.columns.tolist())
+            iFT.setDateTime(TestProfiler.DTs)
+            TestProfiler.FTs.append(iFT)
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestProfiler.TempDir, ignore_errors=True)
+    # 测试汇总表的统计量和排序, 以及嵌套读取只计入最外层
+    def test_1_summary(self):
+        Profiler = BackTestProfiler()
+        Profiler.record("模块A", "move", 0.0, 2.0)
+        Profiler.record("模块A", "move", 2.0, 3.0)
+        Profiler.record("模块B", "end", 0.0, 4.0)
+        Profiler.callRead(self.FTs[0], "read", lambda: Profiler.callRead(self.FTs[1], "read", lambda: np.zeros(3)))
+        Summary = Profiler.summary()
+        self.assertListEqual(Summary.columns.tolist(), ["耗时", "调用次数", "平均耗时", "读取字节数"])
+        self.assertListEqual(Summary.index.tolist()[:2], [("模块B", "end"), ("模块A", "move")])
+        self.assertAlmostEqual(Summary.loc[("模块A", "move"), "耗时"], 3.0)
+        self.assertEqual(Summary.loc[("模块A", "move"), "调用次数"], 2)
+        self.assertAlmostEqual(Summary.loc[("模块A", "move"), "平均耗时"], 1.5)
+        self.assertNotIn(("TestFT1", "read"), Summary.index.tolist())
+        self.assertEqual(Summary.loc[("TestFT0", "read"), "调用次数"], 1)
+        self.assertEqual(BackTestProfiler().summary().shape[0], 0)
+    # 测试保存 Chrome Trace 时间线文件
+    def test_2_saveChromeTrace(self):
+        Profiler = BackTestProfiler(max_events=2)
+        for i in range(3): Profiler.record("模块A", "move", Profiler._StartT+i, Profiler._StartT+i+0.5)
+        TraceFile = self.TempDir+os.sep+"trace.json"
+        Profiler.saveChromeTrace(TraceFile)
+        with open(TraceFile, "r", encoding="utf-8") as File:
+            Trace = json.load(File)
+        self.assertEqual(len(Trace["traceEvents"]), 2)
+        self.assertEqual(Trace["traceEvents"][1]["name"], "模块A")
+        self.assertEqual(Trace["traceEvents"][1]["cat"], "move")
+        self.assertAlmostEqual(Trace["traceEvents"][1]["ts"], 1e6)
+        self.assertAlmostEqual(Trace["traceEvents"][1]["dur"], 0.5e6)
+        self.assertEqual(Profiler.summary().loc[("模块A", "move"), "调用次数"], 3)
+    # 测试回测中记录遍历和非遍历模式的读取以及 ID 过滤
+    def test_3_profileRun(self):
+        Model = BackTestModel(sys_args={"性能分析": True})
+        Model.Modules = [_ProfileModule(self.FTs[0], self.FTs[1])]
+        Model.run(dts=self.DTs)
+        Summary = Model._Profiler.summary()
+        self.assertEqual(Summary.loc[("0-分析模块", "read"), "调用次数"], 2*len(self.DTs))
+        self.assertEqual(Summary.loc[("0-分析模块", "getFilteredID"), "调用次数"], len(self.DTs))
+        self.assertGreater(Summary.loc[("0-分析模块", "read"), "读取字节数"], 0)
+        self.assertIsNone(FactorDB._ReadProfiler)
+
+class TestOutputSpool(unittest.TestCase):
+    def test_insertion_order(self):
+        DTs = [dt.datetime(2018, 1, 1)+dt.timedelta(i) for i in range(3)]
+        Spool = OutputSpool(buffer_size=2)
+        Spool.append(DTs[0], pd.Series([1.0, 2.0], index=["b", "a"]))
+        Spool.append(DTs[1], pd.Series([3.0], index=["c"]))
+        Spool.append(DTs[2], pd.Series([4.0, 5.0], index=["a", "b"]))
+        Data = Spool.toDataFrame()
+        Spool.clear()
+        self.assertEqual(list(Data.columns), ["b", "a", "c"])
+        Target = pd.DataFrame([[1.0, 2.0, np.nan], [np.nan, np.nan, 3.0], [5.0, 4.0, np.nan]], index=DTs, columns=["b", "a", "c"])
+        pd.testing.assert_frame_equal(Data, Target)
+        self.assertEqual(len(Spool), 0)
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+
+from QuantStudio import __QS_Error__
+from QuantStudio.FactorDataBase.FDBFun import APICacheProxy, calcAnalystConsensus, expandInterval, pivotNarrowData
+
+class _StubAPI(object):
+    def __init__(self):
+        self.CallNum = 0
+    def query(self, name, start_date=None):
+        self.CallNum += 1
+        return pd.DataFrame({"name": [name], "start_date": [start_date], "value": [float(self.CallNum)]})
+    def localFun(self, x):
+        return x+1
+
+class TestAPICacheProxy(unittest.TestCase):
+    def setUp(self):
+        self.TempDir = tempfile.mkdtemp()
+        self.CacheDir = self.TempDir+os.sep+"APICache"
+    def tearDown(self):
+        shutil.rmtree(self.TempDir, ignore_errors=True)
+    # 测试记录后回放, 回放时不访问 API, 缓存缺失时报错
+    def test_1_recordReplay(self):
+        API = _StubAPI()
+        Proxy = APICacheProxy(API, self.CacheDir, mode="记录")
+        Data1 = Proxy.query("daily", start_date="20180101")
+        Data2 = Proxy.query("daily", start_date="20180102")
+        self.assertEqual(API.CallNum, 2)
+        self.assertEqual(len(os.listdir(self.CacheDir)), 2)
+        Proxy = APICacheProxy(None, self.CacheDir, mode="回放")
+        self.assertTrue(Proxy.query("daily", start_date="20180101").equals(Data1))
+        self.assertTrue(Proxy.query("daily", start_date="20180102").equals(Data2))
+        with self.assertRaises(__QS_Error__):
+            Proxy.query("daily", start_date="20180103")
+        with self.assertRaises(__QS_Error__):
+            Proxy.query("daily", "20180101")# 调用签名不同
+    # 测试记录模式覆盖已有的缓存
+    def test_2_recordOverwrite(self):
+        API = _StubAPI()
+        Proxy = APICacheProxy(API, self.CacheDir, mode="记录")
+        Proxy.query("daily")
+        Data = Proxy.query("daily")
+        self.assertEqual(API.CallNum, 2)
+        self.assertTrue(APICacheProxy(None, self.CacheDir, mode="回放").query("daily").equals(Data))
+    # 测试直接调用的方法不经过缓存, 回放模式下没有 API 对象时报错
+    def test_3_passthrough(self):
+        API = _StubAPI()
+        Proxy = APICacheProxy(API, self.CacheDir, mode="记录", passthrough=("localFun", ))
+        self.assertEqual(Proxy.localFun(1), 2)
+        self.assertListEqual(os.listdir(self.CacheDir), [])
+        Proxy = APICacheProxy(API, self.CacheDir, mode="回放", passthrough=("localFun", ))
+        self.assertEqual(Proxy.localFun(1), 2)
+        Proxy = APICacheProxy(None, self.CacheDir, mode="回放", passthrough=("localFun", ))
+        with self.assertRaises(__QS_Error__):
+            Proxy.localFun(1)
+    # 测试参数检查
+    def test_4_invalidArgs(self):
+        with self.assertRaises(__QS_Error__):
+            APICacheProxy(None, self.CacheDir, mode="回放")# 缓存目录不存在
+        with self.assertRaises(__QS_Error__):
+            APICacheProxy(_StubAPI(), self.CacheDir, mode="其他")
+        with self.assertRaises(AttributeError):
+            APICacheProxy(_StubAPI(), self.CacheDir)._Private
+
+# 逐 ID 逐日期回溯查找的一致预期计算, 作为向量化实现的对照
+def _findNoteDate(report_date, report_note_dates):
+    for i in range(0, report_note_dates.shape[0]):
+        if report_date==report_note_dates['报告期'].iloc[i]: return report_note_dates['公告日期'].iloc[i]
+    return None
+def _calcIDData_FY(date_seq, raw_data, report_ann_data, factor_names, lookback, fy_num):
+    StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
+    tempInd = -1
+    tempLen = raw_data.shape[0]
+    for i, iDate in enumerate(date_seq):
+        while (tempInd<tempLen-1) and (iDate>=raw_data['日期'].iloc[tempInd+1]): tempInd = tempInd+1
+        if tempInd<0: continue
+        LastYear = str(int(iDate[0:4])-1)
+        NoteDate = _findNoteDate(LastYear+'1231', report_ann_data)
+        if (NoteDate is None) or (NoteDate>iDate): ObjectDate = str(int(LastYear)+fy_num)+'1231'
+        else: ObjectDate = str(int(iDate[0:4])+fy_num)+'1231'
+        iDate = dt.date(int(iDate[0:4]), int(iDate[4:6]), int(iDate[6:]))
+        for j in range(0, tempInd+1):
+            if raw_data['报告期'].iloc[tempInd-j]==ObjectDate:
+                FYNoteDate = raw_data['日期'].iloc[tempInd-j]
+                if (iDate - dt.date(int(FYNoteDate[0:4]), int(FYNoteDate[4:6]), int(FYNoteDate[6:]))).days<=lookback:
+                    StdData[i] = raw_data[factor_names].iloc[tempInd-j].values
+                    break
+    return StdData
+def _calcIDData_Fwd12M(date_seq, raw_data, report_ann_data, factor_names, lookback, fy_num):
+    StdData = np.full(shape=(len(date_seq), len(factor_names)), fill_value=np.nan)
+    tempInd = -1
+    tempLen = raw_data.shape[0]
+    for i, iDate in enumerate(date_seq):
+        while (tempInd<tempLen-1) and (iDate>=raw_data['日期'].iloc[tempInd+1]): tempInd = tempInd+1
+        if tempInd<0: continue
+        ObjectDate1, ObjectDate2 = iDate[0:4]+'1231', str(int(iDate[0:4])+1)+'1231'
+        ObjectData1 = ObjectData2 = None
+        iDate = dt.date(int(iDate[0:4]), int(iDate[4:6]), int(iDate[6:]))
+        for j in range(0, tempInd+1):
+            if (ObjectData1 is None) and (raw_data['报告期'].iloc[tempInd-j]==ObjectDate1):
+                NoteDate = raw_data['日期'].iloc[tempInd-j]
+                if (iDate-dt.date(int(NoteDate[0:4]), int(NoteDate[4:6]), int(NoteDate[6:]))).days<=lookback:
+                    ObjectData1 = raw_data[factor_names].iloc[tempInd-j].values
+            if (ObjectData2 is None) and (raw_data['报告期'].iloc[tempInd-j]==ObjectDate2):
+                NoteDate = raw_data['日期'].iloc[tempInd-j]
+                if (iDate-dt.date(int(NoteDate[0:4]), int(NoteDate[4:6]), int(NoteDate[6:]))).days<=lookback:
+                    ObjectData2 = raw_data[factor_names].iloc[tempInd-j].values
+            if (ObjectData1 is not None) and (ObjectData2 is not None): break
+        if (ObjectData1 is not None) and (ObjectData2 is not None):
+            Weight1 = (dt.date(int(ObjectDate1[0:4]), 12, 31) - iDate).days
+            if (iDate.month==2) and (iDate.day==29): Weight1 = Weight1/366
+            else: Weight1 = Weight1/(dt.date(iDate.year+1, iDate.month, iDate.day)-iDate).days
+            StdData[i] = Weight1*ObjectData1.astype("float") + (1-Weight1)*ObjectData2.astype("float")
+    return StdData
+
+class TestAnalystConsensus(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(0)
+        cls.FactorNames = ["EPS", "NetProfit"]
+        cls.Dates = [iDT.strftime("%Y%m%d") for iDT in pd.date_range("2015-12-01", "2016-04-30")]# 包含 2 月 29 日
+        AllDates = [iDT.strftime("%Y%m%d") for iDT in pd.date_range("2015-09-01", "2016-04-30")]
+        RawData = []
+        for iID in ["000001.SZ", "000002.SZ", "000003.SZ"]:
+            for iDate in np.random.choice(AllDates, size=40):
+                RawData.append((iDate, iID, np.random.choice(["20151231", "20161231", "20171231"]))+tuple(np.random.randn(2)))
+            # 同一日期的多条记录, 以后出现的记录为准
+            RawData.append(("20160105", iID, "20161231", 1.0, 1.0))
+            RawData.append(("20160105", iID, "20161231", 2.0, 2.0))
+            RawData.append(("20160105", iID, "20151231", 3.0, 3.0))
+        RawData = pd.DataFrame(RawData, columns=["日期", "ID", "报告期"]+cls.FactorNames)
+        cls.RawData = RawData.sort_values(by=["ID", "日期"], kind="mergesort").reset_index(drop=True)
+        # 000002.SZ 缺少 2015 年年报的公告日期, 000003.SZ 没有年报公告数据
+        cls.ReportANNData = pd.DataFrame([("000001.SZ", "20150320", "20141231"), ("000001.SZ", "20160315", "20151231"),
+                                          ("000002.SZ", "20150410", "20141231")], columns=["ID", "公告日期", "报告期"])
+    def _calcTarget(self, calc_fun, report_ann_data, ids, lookback, fy_num):
+        RawData = self.RawData.set_index(["ID"])
+        Target = {}
+        for iID in ids:
+            iReportANNData = (None if report_ann_data is None else report_ann_data.set_index(["ID"]).loc[[iID]])
+            Target[iID] = calc_fun(self.Dates, RawData.loc[[iID]], iReportANNData, self.FactorNames, lookback, fy_num)
+        return Target
+    def _checkData(self, data, target):
+        self.assertListEqual(list(data.minor_axis), list(target.keys()))
+        self.assertListEqual(list(data.major_axis), [dt.datetime.strptime(iDate, "%Y%m%d") for iDate in self.Dates])
+        for j, iID in enumerate(target):
+            np.testing.assert_allclose(data.values[:, :, j].T, target[iID], equal_nan=True)
+    # 测试 FY 计算, 包括回溯期截断, 缺失的年报公告日期和同一日期的多条记录
+    def test_1_FY(self):
+        for iLookBack in (30, 180):
+            for iFYNum in (0, 1, 2):
+                Data = calcAnalystConsensus(self.RawData, self.ReportANNData, self.FactorNames, self.Dates, iLookBack, iFYNum)
+                Target = self._calcTarget(_calcIDData_FY, self.ReportANNData, ["000001.SZ", "000002.SZ"], iLookBack, iFYNum)
+                self._checkData(Data, Target)
+    # 测试 Fwd12M 计算
+    def test_2_Fwd12M(self):
+        for iLookBack in (30, 180):
+            Data = calcAnalystConsensus(self.RawData, None, self.FactorNames, self.Dates, iLookBack)
+            Target = self._calcTarget(_calcIDData_Fwd12M, None, ["000001.SZ", "000002.SZ", "000003.SZ"], iLookBack, None)
+            self._checkData(Data, Target)
+    # 测试没有匹配 ID 时返回空的结果
+    def test_3_NoID(self):
+        Data = calcAnalystConsensus(self.RawData, self.ReportANNData.iloc[:0], self.FactorNames, self.Dates, 30, 1)
+        self.assertEqual(Data.shape, (len(self.FactorNames), len(self.Dates), 0))
+
+class TestExpandInterval(unittest.TestCase):
+    # 测试展开结果与逐条记录展开一致, 区间不包含终点, 终点不大于起点的记录不展开
+    def test_1_expand(self):
+        StartIdx = np.array([0, 3, 5, 2, 4, 1], dtype=np.int64)
+        EndIdx = np.array([2, 3, 4, 6, 5, 1], dtype=np.int64)
+        RowIdx, DTIdx = expandInterval(StartIdx, EndIdx)
+        TargetRowIdx, TargetDTIdx = [], []
+        for i in range(StartIdx.shape[0]):
+            for j in range(StartIdx[i], EndIdx[i]):
+                TargetRowIdx.append(i)
+                TargetDTIdx.append(j)
+        self.assertListEqual(RowIdx.tolist(), TargetRowIdx)
+        self.assertListEqual(DTIdx.tolist(), TargetDTIdx)
+    # 测试空输入
+    def test_2_empty(self):
+        RowIdx, DTIdx = expandInterval(np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+        self.assertEqual(RowIdx.shape, (0, ))
+        self.assertEqual(DTIdx.shape, (0, ))
+        RowIdx, DTIdx = expandInterval(np.array([2, 3], dtype=np.int64), np.array([2, 1], dtype=np.int64))
+        self.assertEqual(RowIdx.shape, (0, ))
+
+class TestPivotNarrowData(unittest.TestCase):
+    def setUp(self):
+        DTs = [dt.datetime(2020, 1, 2), dt.datetime(2020, 1, 3)]
+        self.RawData = pd.DataFrame([(DTs[1], "000002.SZ", "A", 1.5),
+                                     (DTs[0], "000001.SZ", "A", 2.5),
+                                     (DTs[0], "000001.SZ", "B", "x"),
+                                     (DTs[1], "000001.SZ", "C", 9.0),
+                                     (DTs[1], "000002.SZ", "B", "y")], columns=["QS_DT", "ID", "FactorName", "Value"])
+        self.DTs = DTs
+    # 测试 data_type 为字典时各因子分别转换类型, 未请求的因子被丢弃
+    def test_1_mixedDataType(self):
+        Data = pivotNarrowData(self.RawData, ["B", "A"], "FactorName", "Value", data_type={"A": "double", "B": "string"})
+        self.assertListEqual(list(Data.items), ["B", "A"])
+        self.assertListEqual(list(Data.major_axis), self.DTs)
+        self.assertListEqual(list(Data.minor_axis), ["000001.SZ", "000002.SZ"])
+        A, B = Data["A"], Data["B"]
+        self.assertTrue(np.all(A.dtypes==np.dtype("float")))
+        self.assertFalse(np.any(B.dtypes==np.dtype("float")))
+        self.assertEqual(A.iloc[0, 0], 2.5)
+        self.assertEqual(A.iloc[1, 1], 1.5)
+        self.assertTrue(np.isnan(A.iloc[1, 0]) and np.isnan(A.iloc[0, 1]))
+        self.assertEqual(B.iloc[0, 0], "x")
+        self.assertEqual(B.iloc[1, 1], "y")
+        self.assertTrue(pd.isnull(B.iloc[1, 0]))
+    # 测试全部为数值型因子, 未请求因子 C 所在的时点和 ID 不出现在结果中
+    def test_2_double(self):
+        RawData = self.RawData[self.RawData["FactorName"]!="B"]
+        RawData = RawData[RawData["ID"]!="000002.SZ"]
+        Data = pivotNarrowData(RawData, ["A"], "FactorName", "Value")
+        self.assertListEqual(list(Data.items), ["A"])
+        self.assertListEqual(list(Data.major_axis), self.DTs[:1])
+        self.assertListEqual(list(Data.minor_axis), ["000001.SZ"])
+        self.assertEqual(Data.values.dtype, np.dtype("float"))
+        self.assertEqual(Data.values[0, 0, 0], 2.5)
+    # 测试没有请求因子的数据时返回 None
+    def test_3_noData(self):
+        self.assertIsNone(pivotNarrowData(self.RawData, ["D"], "FactorName", "Value"))
+        self.assertIsNone(pivotNarrowData(self.RawData.iloc[:0], ["A"], "FactorName", "Value"))
+    # 测试存在重复的 (时点, ID, 因子) 时报错, 重复记录属于未请求的因子时不报错
+    def test_4_duplicate(self):
+        RawData = pd.concat([self.RawData, self.RawData.iloc[[1]]], ignore_index=True)
+        with self.assertRaises(__QS_Error__):
+            pivotNarrowData(RawData, ["A", "B"], "FactorName", "Value", data_type={"A": "double", "B": "string"})
+        RawData = pd.concat([self.RawData, self.RawData.iloc[[3]]], ignore_index=True)
+        Data = pivotNarrowData(RawData, ["A"], "FactorName", "Value")
+        self.assertEqual(Data.values.shape, (1, 2, 2))
+
+if __name__=="__main__":
+    unittest.main()
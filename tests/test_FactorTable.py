@@ -58,6 +58,34 @@ class TestFactorTable(unittest.TestCase):
             Err = (TestData.loc[iFactorName] - TargetData.loc[iFactorName]).abs()
             self.assertAlmostEqual(Err.max().max(), 0)
         FDB.disconnect()
+    # 测试时点对齐: 因子表的时点比测试时点稀疏, 遍历读取当前时点时取不晚于该时点的最新数据
+    def test_4_AlignDateTime(self):
+        TableDTs = self.DTs[::3]
+        CFT = CustomFT(name="CoarseTable")
+        CFT.addFactors(factor_list=[self.Factor0])
+        CFT.setID(self.IDs)
+        CFT.setDateTime(TableDTs)
+        IDs = self.IDs[:5]
+        CFT.start(self.DTs)
+        CFT.alignDateTime(self.DTs)
+        self.assertListEqual(CFT.ErgodicMode._AlignIndex.tolist(), [i//3 for i in range(len(self.DTs))])
+        for i, iDT in enumerate(self.DTs):
+            CFT.move(iDT, dt_index=i)
+            self.assertEqual(CFT.ErgodicMode._CurInd, i//3)
+            iData = CFT.readData(factor_names=[self.FactorNames[0]], ids=IDs, dts=[iDT]).iloc[0]
+            self.assertListEqual(iData.index.tolist(), [iDT])
+            self.assertListEqual(iData.columns.tolist(), IDs)
+            self.assertAlmostEqual(np.abs(iData.values - self.Data0.loc[[TableDTs[i//3]], IDs].values).max(), 0)
+        # 一次读取多个时点
+        iData = CFT.readData(factor_names=[self.FactorNames[0]], ids=IDs, dts=self.DTs[4:8]).iloc[0]
+        self.assertAlmostEqual(np.abs(iData.values - self.Data0.loc[[TableDTs[i//3] for i in range(4, 8)], IDs].values).max(), 0)
+        CFT.end()
+        # 不给定 dt_index 时逐步查找的位置与对齐映射一致
+        CFT.start(self.DTs)
+        for i, iDT in enumerate(self.DTs):
+            CFT.move(iDT)
+            self.assertEqual(CFT.ErgodicMode._CurInd, i//3)
+        CFT.end()
 
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file
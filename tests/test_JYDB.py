@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import shutil
+import sqlite3
 import zipfile
 import tempfile
 import datetime as dt
@@ -9,7 +11,7 @@ import unittest
 import numpy as np
 import pandas as pd
 
-from QuantStudio.FactorDataBase.JYDB import JYDB
+from QuantStudio.FactorDataBase.JYDB import JYDB, _ConstituentTable
 
 __TestDirPath__ = os.path.split(os.path.realpath(__file__))[0]
 
@@ -280,6 +282,64 @@ class TestJYDB(unittest.TestCase):
         Err = self._compareDataFrame(TestData, TargetData)
         self.assertAlmostEqual(Err.max().max(), 0)
 
+class TestJYDBMirror(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        TestJYDBMirror.TempDir = tempfile.mkdtemp()
+        TestJYDBMirror.SourceFile = TestJYDBMirror.TempDir+os.sep+"source.sqlite3"
+        TestJYDBMirror.MirrorFile = TestJYDBMirror.TempDir+os.sep+"mirror.sqlite3"
+        # 源库中的指标代码以浮点数存储, 时间字段带有时间部分
+        Conn = sqlite3.connect(TestJYDBMirror.SourceFile)
+        Conn.execute("CREATE TABLE C_ED_MacroIndicatorData (ID INTEGER, IndicatorCode REAL, InfoPublDate JYDATETIME, EndDate JYDATETIME, DataValue REAL, PowerNumber INTEGER, XGRQ JYDATETIME)")
+        Conn.executemany("INSERT INTO C_ED_MacroIndicatorData VALUES (?, ?, ?, ?, ?, ?, ?)", [
+            (1, 110000001.0, "2018-02-10 15:30:00", "2018-01-31", 1.0, 0, "2018-02-10 15:30:00"),
+            (2, 110000001.0, "2018-03-10", "2018-02-28", 2.0, 0, "2018-03-10"),
+            (3, 110002855.0, "2018-02-05", "2018-01-31", 3.0, 0, "2018-02-05")])
+        Conn.commit()
+        Conn.close()
+        TestJYDBMirror.SourceDB = JYDB(sys_args={"数据库类型": "sqlite3", "连接器": "sqlite3", "sqlite3文件": TestJYDBMirror.SourceFile})
+        TestJYDBMirror.SourceDB.connect()
+    @classmethod
+    def tearDownClass(cls):
+        TestJYDBMirror.SourceDB.disconnect()
+        shutil.rmtree(TestJYDBMirror.TempDir, ignore_errors=True)
+    # 测试镜像到 sqlite3 后读取的 ID, 时点和数据
+    def test_1_mirrorRoundTrip(self):
+        self.SourceDB.mirrorTables(self.MirrorFile, ["宏观基础指标数据"])
+        MirrorDB = JYDB(sys_args={"数据库类型": "sqlite3", "连接器": "sqlite3", "sqlite3文件": self.MirrorFile})
+        MirrorDB.connect()
+        try:
+            FT = MirrorDB.getTable("宏观基础指标数据", args={"回溯天数": np.inf})
+            IDs = FT.getID()
+            self.assertListEqual(IDs, ["110000001", "110002855"])
+            DTs = FT.getDateTime()
+            self.assertListEqual(DTs, [dt.datetime(2018, 2, 5), dt.datetime(2018, 2, 10), dt.datetime(2018, 3, 10)])
+            self.assertListEqual(FT.getDateTime(args={"忽略时间": False}), [dt.datetime(2018, 2, 5), dt.datetime(2018, 2, 10, 15, 30), dt.datetime(2018, 3, 10)])
+            Data = FT.readData(factor_names=["指标数据"], ids=IDs, dts=[dt.datetime(2018, 2, 6), dt.datetime(2018, 2, 10), dt.datetime(2018, 3, 15)]).iloc[0]
+            TargetData = pd.DataFrame([[np.nan, 3.0], [1.0, 3.0], [2.0, 3.0]], index=[dt.datetime(2018, 2, 6), dt.datetime(2018, 2, 10), dt.datetime(2018, 3, 15)], columns=IDs)
+            self.assertTrue(np.allclose(Data.values.astype(float), TargetData.values, equal_nan=True))
+        finally:
+            MirrorDB.disconnect()
+
+class TestJYDBConstituent(unittest.TestCase):
+    # 测试成份数据的计算: 剔除日期当天不再是成份, 剔除日期缺失时至今日为成份, 不在请求中的 ID 被忽略
+    def test_calcData(self):
+        Today = dt.date.today()
+        DTs = [dt.datetime.combine(Today-dt.timedelta(5-i), dt.time(0)) for i in range(6)]
+        RawData = pd.DataFrame([(3145, "000001.SZ", DTs[1], DTs[3], 0),
+                                (3145, "000002.SZ", DTs[2], None, 1),
+                                (3145, "000003.SZ", DTs[0], None, 1),
+                                (4978, "000001.SZ", DTs[0], DTs[1], 0),
+                                (4978, "000002.SZ", DTs[4], DTs[4], 0)], columns=["IndexID", "SecurityID", "InDate", "OutDate", "CurSign"], dtype="O")
+        # 计算不依赖因子表的状态, 直接调用
+        Data = _ConstituentTable.__QS_calcData__(None, RawData, factor_names=["3145", "4978"], ids=["000001.SZ", "000002.SZ"], dts=DTs)
+        self.assertListEqual(list(Data.items), ["3145", "4978"])
+        self.assertListEqual(list(Data.minor_axis), ["000001.SZ", "000002.SZ"])
+        self.assertListEqual(Data["3145"]["000001.SZ"].tolist(), [0, 1, 1, 0, 0, 0])
+        self.assertListEqual(Data["3145"]["000002.SZ"].tolist(), [0, 0, 1, 1, 1, 1])
+        self.assertListEqual(Data["4978"]["000001.SZ"].tolist(), [1, 0, 0, 0, 0, 0])
+        self.assertListEqual(Data["4978"]["000002.SZ"].tolist(), [0, 0, 0, 0, 0, 0])
+
 if __name__=="__main__":
     unittest.main()
     #Suite = unittest.TestSuite()
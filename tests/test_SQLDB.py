@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
+import tempfile
 import datetime as dt
 import unittest
 
@@ -30,6 +32,15 @@ class TestSQLDB(unittest.TestCase):
         # 以 append 方式写入数据
         self.Data.iloc[0, 2:4, 2] = 2.0
         self.FDB.writeData(self.Data.iloc[:, 2:4, 0:3], self.TargetTable, if_exists="append")
+    # 测试参数化的按列读取功能
+    def test_3_fetchColumns(self):
+        SQLStr = "SELECT datetime, code, Factor0 FROM qs_"+self.TargetTable+" WHERE code=%(ID)s AND datetime>=%(StartDT)s ORDER BY datetime"
+        # sqlite3 中时点以文本存储, 参数按 writeData 写入时的格式生成
+        StartDT = pd.DatetimeIndex(self.DTs).astype(str)[1]
+        Columns = self.FDB.fetchColumns(SQLStr, params={"ID": self.IDs[0], "StartDT": StartDT})
+        self.assertEqual(len(Columns), 3)
+        self.assertListEqual(Columns[1].tolist(), [self.IDs[0]]*(len(self.DTs)-1))
+        self.assertListEqual(Columns[2].tolist(), self.Data.iloc[0, 1:, 0].tolist())
     # 测试读取功能
     def test_3_readData(self):
         self.assertEqual(self.FDB.TableNames, [self.TargetTable])
@@ -64,5 +75,60 @@ class TestSQLDB(unittest.TestCase):
         self.FDB.deleteTable(table_name=self.TargetTable)
         self.assertListEqual(self.FDB.TableNames, [])
 
+class TestSQLDBQueryCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        TestSQLDBQueryCache.TempDir = tempfile.mkdtemp()
+        TestSQLDBQueryCache.FDB = SQLDB(sys_args={"数据库类型": "sqlite3", "连接器":"sqlite3", "sqlite3文件": TestSQLDBQueryCache.TempDir+os.sep+"test.sqlite3", "查询缓存": True, "查询缓存目录": TestSQLDBQueryCache.TempDir})
+        TestSQLDBQueryCache.FDB.connect()
+    @classmethod
+    def tearDownClass(cls):
+        TestSQLDBQueryCache.FDB.disconnect()
+        shutil.rmtree(TestSQLDBQueryCache.TempDir, ignore_errors=True)
+    # 测试写入后查询缓存失效
+    def test_1_writeThenRead(self):
+        self.FDB.execute("CREATE TABLE qs_CacheTable (datetime text, code text, Factor0 real)")
+        SQLStr = "SELECT Factor0 FROM qs_CacheTable ORDER BY datetime"
+        self.assertListEqual(list(self.FDB.fetchall(SQLStr)), [])
+        self.FDB.execute("INSERT INTO qs_CacheTable VALUES ('2018-01-01', '000001.SZ', 1.0)")
+        self.assertListEqual([tuple(iRow) for iRow in self.FDB.fetchall(SQLStr)], [(1.0,)])
+        self.assertListEqual([tuple(iRow) for iRow in self.FDB.fetchall(SQLStr)], [(1.0,)])
+        self.assertEqual(self.FDB.QueryCacheStats["命中次数"], 1)
+        self.FDB.execute("INSERT INTO qs_CacheTable VALUES ('2018-01-02', '000001.SZ', 2.0)")
+        self.assertListEqual([tuple(iRow) for iRow in self.FDB.fetchall(SQLStr)], [(1.0,), (2.0,)])
+        Columns = self.FDB.fetchColumns("SELECT Factor0 FROM qs_CacheTable WHERE code=%(ID)s ORDER BY datetime", params={"ID": "000001.SZ"})
+        self.assertListEqual(Columns[0].tolist(), [1.0, 2.0])
+        self.FDB.execute("DELETE FROM qs_CacheTable WHERE datetime='2018-01-01'")
+        Columns = self.FDB.fetchColumns("SELECT Factor0 FROM qs_CacheTable WHERE code=%(ID)s ORDER BY datetime", params={"ID": "000001.SZ"})
+        self.assertListEqual(Columns[0].tolist(), [2.0])
+        self.FDB.execute("DROP TABLE qs_CacheTable")
+    # 测试元数据缓存: 重复连接时读取缓存, 表结构变化后失效
+    def test_2_metaCache(self):
+        Args = {"数据库类型": "sqlite3", "连接器":"sqlite3", "sqlite3文件": self.TempDir+os.sep+"meta.sqlite3", "查询缓存": True, "查询缓存目录": self.TempDir, "元数据缓存": True}
+        FDB = SQLDB(sys_args=Args)
+        FDB.connect()
+        MetaFile = FDB._getMetaCacheFile()
+        self.assertTrue(os.path.isfile(MetaFile))
+        FDB.execute("CREATE TABLE qs_MetaTable (datetime text, code text, Factor0 real)")
+        FDB.disconnect()
+        for i in range(2):
+            FDB = SQLDB(sys_args=Args)
+            FDB.connect()
+            self.assertListEqual(FDB.TableNames, ["MetaTable"])
+            self.assertSetEqual(set(FDB._TableFactorDict["MetaTable"].index), {"Factor0"})
+            FDB.disconnect()
+        # 第二次连接应直接使用缓存文件
+        MTime = os.path.getmtime(MetaFile)
+        FDB = SQLDB(sys_args=Args)
+        FDB.connect()
+        self.assertEqual(os.path.getmtime(MetaFile), MTime)
+        FDB.execute("ALTER TABLE qs_MetaTable ADD COLUMN Factor1 real")
+        FDB.disconnect()
+        FDB = SQLDB(sys_args=Args)
+        FDB.connect()
+        self.assertSetEqual(set(FDB._TableFactorDict["MetaTable"].index), {"Factor0", "Factor1"})
+        self.assertTrue({"Factor0", "Factor1"}.issubset(FDB.getTable("MetaTable").FactorNames))
+        FDB.disconnect()
+
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file
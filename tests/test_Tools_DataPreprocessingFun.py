@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from QuantStudio.Tools.DataPreprocessingFun import fillNaByLookback, fillNaByLookback3D
+
+class TestFillNaByLookback3D(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(0)
+        nFactor, nDT, nID = 3, 20, 6
+        # 时点间隔不等, 检验回溯按时间而不是按位置计算
+        cls.DTs = pd.DatetimeIndex([dt.datetime(2018, 1, 1)+dt.timedelta(int(iDay)) for iDay in np.cumsum(np.random.randint(1, 4, size=nDT))]).astype("datetime64[ns]")
+        Data = np.random.randn(nFactor, nDT, nID)
+        Data[np.random.rand(nFactor, nDT, nID)<0.6] = np.nan
+        Data[:, 0, 0] = np.nan# 第一个时点缺失, 没有可供填充的值
+        cls.Data = Data
+    def _checkEqual(self, data, target):
+        self.assertEqual(data.shape, target.shape)
+        self.assertTrue(np.array_equal(pd.isnull(data), pd.isnull(target)))
+        self.assertTrue(np.all(data[pd.notnull(target)]==target[pd.notnull(target)]))
+    def _calcTarget(self, data, lookback):
+        return np.array([fillNaByLookback(pd.DataFrame(data[i], index=self.DTs), lookback=lookback).values for i in range(data.shape[0])])
+    # 测试标量回溯期
+    def test_1_ScalarLookback(self):
+        for iLookBack in (0, 2*24*3600.0, 5*24*3600.0):
+            self._checkEqual(fillNaByLookback3D(self.Data, self.DTs.values, iLookBack), self._calcTarget(self.Data, iLookBack))
+    # 测试每个 (时点, ID) 不同的回溯期
+    def test_2_ArrayLookback(self):
+        LookBack = np.random.randint(0, 6, size=self.Data.shape[1:]) * 24 * 3600.0
+        self._checkEqual(fillNaByLookback3D(self.Data, self.DTs.values, LookBack), self._calcTarget(self.Data, LookBack))
+    # 测试不限回溯期
+    def test_3_InfLookback(self):
+        Target = np.array([pd.DataFrame(self.Data[i]).fillna(method="pad").values for i in range(self.Data.shape[0])])
+        self._checkEqual(fillNaByLookback3D(self.Data, self.DTs.values, np.inf), Target)
+        self._checkEqual(fillNaByLookback3D(self.Data, self.DTs.values, np.full(self.Data.shape[1:], np.inf)), Target)
+    # 测试混合类型的数据
+    def test_4_ObjectData(self):
+        Data = self.Data.astype("O")
+        Data[1] = np.where(pd.isnull(self.Data[1]), None, np.round(self.Data[1], 2).astype(str)).astype("O")
+        Data[1][pd.isnull(self.Data[1])] = np.nan
+        for iLookBack in (3*24*3600.0, np.inf):
+            Rslt = fillNaByLookback3D(Data, self.DTs.values, iLookBack)
+            self.assertEqual(Rslt.dtype, np.dtype("O"))
+            self._checkEqual(Rslt, self._calcTarget(Data, iLookBack))
+            self.assertTrue(all(isinstance(iVal, str) for iVal in Rslt[1][pd.notnull(Rslt[1])]))
+
+if __name__=="__main__":
+    unittest.main()
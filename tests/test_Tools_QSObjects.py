@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from QuantStudio.Tools.QSObjects import QSMMAPPipe, _MMAPArray
+
+class TestQSMMAPPipe(unittest.TestCase):
+    def setUp(self):
+        self.Pipe = QSMMAPPipe(cache_size=1, min_size=0)
+    def tearDown(self):
+        self.Pipe.close()
+    def _roundTrip(self, obj):
+        Thread = threading.Thread(target=self.Pipe.put, args=(obj, ))
+        Thread.start()
+        Rslt = self.Pipe.get()
+        Thread.join()
+        return Rslt
+    # 测试 DataFrame, Series 和 ndarray 经过内存映射文件传递
+    def test_1_roundTrip(self):
+        np.random.seed(0)
+        DataFrame = pd.DataFrame(np.random.randn(200, 3), index=pd.date_range("2018-01-01", periods=200), columns=["a", "b", "c"])
+        Series = pd.Series(np.arange(100, dtype=np.int64), index=["ID"+str(i) for i in range(100)], name="s")
+        Array = np.random.rand(50, 4)
+        for iObj in (DataFrame, Series, Array): self.assertIsInstance(self.Pipe._pack(iObj), _MMAPArray)
+        Rslt = self._roundTrip({"DataFrame": DataFrame, "Data": [Series, (Array, 1)]})
+        self.assertTrue(Rslt["DataFrame"].equals(DataFrame))
+        self.assertTrue(Rslt["Data"][0].equals(Series))
+        self.assertEqual(Rslt["Data"][0].name, Series.name)
+        self.assertTrue(np.array_equal(Rslt["Data"][1][0], Array))
+        self.assertEqual(Rslt["Data"][1][1], 1)
+    # 测试扩展类型和混合类型不写入内存映射文件, 通过 pickle 原样传递
+    def test_2_extensionDType(self):
+        TZSeries = pd.Series(pd.date_range("2018-01-01", periods=10, tz="Asia/Shanghai"))
+        CategorySeries = pd.Series(["a", "b", "a"], dtype="category")
+        MixedDataFrame = pd.DataFrame({"a": [1.0, 2.0], "b": ["x", "y"]})
+        TZDataFrame = pd.DataFrame({"a": TZSeries})
+        for iObj in (TZSeries, CategorySeries, MixedDataFrame, TZDataFrame): self.assertIs(self.Pipe._pack(iObj), iObj)
+        Rslt = self._roundTrip([TZSeries, CategorySeries, MixedDataFrame, TZDataFrame])
+        for i, iObj in enumerate((TZSeries, CategorySeries, MixedDataFrame, TZDataFrame)):
+            self.assertTrue(Rslt[i].equals(iObj))
+            self.assertTrue((Rslt[i].dtypes==iObj.dtypes).all() if isinstance(iObj, pd.DataFrame) else (Rslt[i].dtype==iObj.dtype))
+    # 测试关闭后删除临时目录
+    def test_3_close(self):
+        self._roundTrip(np.random.rand(10))
+        self.Pipe.close()
+        self.assertFalse(os.path.isdir(self.Pipe.DirPath))
+
+if __name__=="__main__":
+    unittest.main()